@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+"""
+DDNS 更新器基准测试
+
+在本地启动一个模拟的 ESA OpenAPI 服务（GetRecord / UpdateRecord / ListRecords）
+以及一个返回固定IP的公网IP提供方，用真实的 run_ddns_update 驱动 1 / 100 / 10000
+条记录，统计吞吐、周期耗时 p50/p99、每周期的接口调用次数与峰值内存。
+
+    python benchmark.py                          # 默认规模 1,100,10000
+    python benchmark.py --sizes 100 --latency 20 --throttle-rate 0.05
+    python benchmark.py --json result.json       # 输出机器可读结果
+    python benchmark.py --compare baseline.json  # 与历史结果对比，退化时返回1
+
+每个规模在独立子进程中运行，峰值内存互不影响；模拟服务运行在父进程中。
+"""
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Optional, List, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import yaml
+
+DEFAULT_SIZES = [1, 100, 10000]
+BASE_RECORD_ID = 1000000
+BENCH_SITE_ID = 1
+
+
+class FakeESAState:
+    """模拟服务的记录表、调用统计与故障注入参数"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0,
+                 throttle_rate: float = 0.0, error_rate: float = 0.0):
+        self.lock = threading.Lock()
+        self.records: Dict[int, Dict[str, Any]] = {}
+        self.calls: Dict[str, int] = {}
+        self.faults: Dict[str, int] = {}
+        self.ip = "198.51.100.1"
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        # 按顺序逐个返回的确定性故障 (错误码, HTTP状态码)，优先于按比例注入的故障
+        self.scripted: List[Tuple[str, int]] = []
+
+    def inject(self, code: str, status: int, times: int = 1):
+        """让接下来的 times 个接口请求依次返回指定错误"""
+        with self.lock:
+            self.scripted.extend([(code, status)] * times)
+
+    def seed(self, count: int, value: str):
+        with self.lock:
+            self.records = {
+                BASE_RECORD_ID + i: {
+                    "RecordId": BASE_RECORD_ID + i, "RecordName": f"h{i}.bench.example.com",
+                    "RecordType": "A/AAAA", "SiteId": BENCH_SITE_ID, "Ttl": 1, "Proxied": False,
+                    "Data": {"Value": value},
+                }
+                for i in range(count)
+            }
+            self.calls.clear()
+            self.faults.clear()
+            self.scripted.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"calls": dict(self.calls), "faults": dict(self.faults)}
+
+
+class _FakeESAHandler(BaseHTTPRequestHandler):
+    """按 x-acs-action 分发请求；/__* 路径供基准测试进程控制模拟服务"""
+
+    protocol_version = "HTTP/1.1"
+    state: FakeESAState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self) -> Dict[str, str]:
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            params.update(urllib.parse.parse_qsl(self.rfile.read(length).decode("utf-8")))
+        return params
+
+    def _send(self, status: int, body: Any, content_type: str = "application/json"):
+        data = body.encode("utf-8") if isinstance(body, str) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        path = urllib.parse.urlparse(self.path).path
+        params = self._params()
+        if path == "/__ip":
+            return self._send(200, self.state.ip, "text/plain")
+        if path.startswith("/__"):
+            return self._control(path, params)
+        action = self.headers.get("x-acs-action") or params.get("Action", "")
+        self._api(action, params)
+
+    def _control(self, path: str, params: Dict[str, str]):
+        state = self.state
+        if path == "/__seed":
+            state.seed(int(params["count"]), params["value"])
+        elif path == "/__set_ip":
+            state.ip = params["ip"]
+        elif path == "/__reset":
+            with state.lock:
+                state.calls.clear()
+                state.faults.clear()
+        elif path != "/__stats":
+            return self._send(404, {"error": "not found"})
+        self._send(200, state.stats())
+
+    def _api(self, action: str, params: Dict[str, str]):
+        state = self.state
+        with state.lock:
+            state.calls[action] = state.calls.get(action, 0) + 1
+        if state.latency or state.jitter:
+            time.sleep(state.latency + random.uniform(0, state.jitter))
+
+        with state.lock:
+            scripted = state.scripted.pop(0) if state.scripted else None
+        if scripted:
+            return self._fault(*scripted)
+        # 故障注入：限流与服务端错误，均为ESA的真实错误码
+        roll = random.random()
+        if roll < state.throttle_rate:
+            return self._fault("Throttling.User", 429)
+        if roll < state.throttle_rate + state.error_rate:
+            return self._fault("ServiceUnavailable", 503)
+
+        if action == "GetRecord":
+            record = state.records.get(int(params.get("RecordId", 0)))
+            if record is None:
+                return self._send(400, {"Code": "Record.NotExist", "Message": "record not found"})
+            return self._send(200, {"RequestId": "bench-get", "RecordModel": record})
+        if action == "UpdateRecord":
+            record = state.records.get(int(params.get("RecordId", 0)))
+            if record is None:
+                return self._send(400, {"Code": "Record.NotExist", "Message": "record not found"})
+            data = json.loads(params.get("Data") or "{}")
+            with state.lock:
+                record["Data"]["Value"] = data.get("Value")
+            return self._send(200, {"RequestId": "bench-update"})
+        if action == "ListRecords":
+            records = [r for r in state.records.values() if str(r["SiteId"]) == params.get("SiteId")]
+            if params.get("RecordName"):
+                records = [r for r in records if r["RecordName"] == params["RecordName"]]
+            page, size = int(params.get("PageNumber", 1)), int(params.get("PageSize", 20))
+            return self._send(200, {"RequestId": "bench-list", "TotalCount": len(records),
+                                    "PageNumber": page, "PageSize": size,
+                                    "Records": records[(page - 1) * size:page * size]})
+        self._send(400, {"Code": "InvalidAction.NotFound", "Message": action})
+
+    def _fault(self, code: str, status: int):
+        with self.state.lock:
+            self.state.faults[code] = self.state.faults.get(code, 0) + 1
+        self._send(status, {"Code": code, "Message": "injected by benchmark"})
+
+
+def start_fake_esa(state: FakeESAState, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """在后台线程中启动模拟ESA服务"""
+    handler = type("FakeESAHandler", (_FakeESAHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-esa", daemon=True).start()
+    return server
+
+
+def _control(base_url: str, path: str, **params) -> Dict[str, Any]:
+    data = urllib.parse.urlencode(params).encode("utf-8")
+    with urllib.request.urlopen(base_url + path, data=data, timeout=30) as resp:
+        return json.loads(resp.read().decode("utf-8"))
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """最近秩法百分位"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def peak_rss_kb() -> Optional[int]:
+    """当前进程的峰值常驻内存（KB）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 上单位为字节
+    return int(peak / 1024) if sys.platform == "darwin" else int(peak)
+
+
+def build_config(base_url: str, size: int, args) -> Dict[str, Any]:
+    host = urllib.parse.urlparse(base_url).netloc
+    return {
+        "aliyun": {"access_key_id": "bench", "access_key_secret": "bench", "region": "cn-hangzhou",
+                   "endpoint": host, "protocol": "http"},
+        "records": [{"record_id": BASE_RECORD_ID + i, "site_id": BENCH_SITE_ID} for i in range(size)],
+        "batch": {"max_workers": args.workers, "bulk_compare": args.bulk_compare},
+        "state_cache": {"enabled": args.state_cache},
+        "ip_providers": {"providers": [{"name": "bench", "url": base_url + "/__ip", "parser": "text"}]},
+        "resilience": {"base_delay": args.retry_delay, "max_delay": args.retry_delay * 8},
+        "logging": {"level": "ERROR", "file": "bench.log"},
+    }
+
+
+def run_scenario(base_url: str, size: int, args_dict: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    在当前（子）进程中运行单个规模的基准测试
+
+    change 阶段每个周期都更换公网IP，所有记录都需要写入；
+    steady 阶段IP不变，衡量日常无变化周期的开销。
+    """
+    args = argparse.Namespace(**args_dict)
+    workdir = tempfile.mkdtemp(prefix="ddns-bench-")
+    os.chdir(workdir)
+    with open("config.yml", "w", encoding="utf-8") as f:
+        yaml.safe_dump(build_config(base_url, size, args), f)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as ddns
+    ddns.setup_logging(ddns.load_config()["logging"])
+
+    if args.trace_alloc:
+        import tracemalloc
+        tracemalloc.start()
+
+    _control(base_url, "/__seed", count=size, value="198.51.100.1")
+    rows = []
+    ip_counter = 0
+    for phase in ("change", "steady"):
+        durations, calls, faults, failed = [], {}, {}, 0
+        alloc_peaks = []
+        for _ in range(args.cycles):
+            if phase == "change" or ip_counter == 0:
+                ip_counter += 1
+                _control(base_url, "/__set_ip", ip=f"203.0.{ip_counter // 256}.{ip_counter % 256}")
+            _control(base_url, "/__reset")
+            if args.trace_alloc:
+                tracemalloc.reset_peak()
+            start = time.perf_counter()
+            # 终端表格输出不计入测试对象，丢弃
+            with redirect_stdout(io.StringIO()):
+                results = ddns.run_ddns_update()
+            durations.append(time.perf_counter() - start)
+            if args.trace_alloc:
+                alloc_peaks.append(tracemalloc.get_traced_memory()[1])
+            stats = _control(base_url, "/__stats")
+            for key, total in (("calls", calls), ("faults", faults)):
+                for name, count in stats[key].items():
+                    total[name] = total.get(name, 0) + count
+            failed += sum(1 for r in results if "error" in r)
+
+        row = {
+            "records": size,
+            "phase": phase,
+            "cycles": args.cycles,
+            "p50_ms": round(percentile(durations, 50) * 1000, 2),
+            "p99_ms": round(percentile(durations, 99) * 1000, 2),
+            "throughput_rps": round(size * len(durations) / sum(durations), 1) if sum(durations) else 0.0,
+            "api_calls_per_cycle": {k: round(v / args.cycles, 2) for k, v in sorted(calls.items())},
+            "faults_per_cycle": {k: round(v / args.cycles, 2) for k, v in sorted(faults.items())},
+            "errors_per_cycle": round(failed / args.cycles, 2),
+        }
+        if alloc_peaks:
+            row["alloc_peak_kb"] = round(max(alloc_peaks) / 1024, 1)
+        rows.append(row)
+
+    for row in rows:
+        row["peak_rss_kb"] = peak_rss_kb()
+    ddns.stop_logging()
+    return rows
+
+
+def _scenario_entry(out_queue, base_url: str, size: int, args_dict: Dict[str, Any]):
+    try:
+        out_queue.put(("ok", run_scenario(base_url, size, args_dict)))
+    except Exception as e:
+        out_queue.put(("error", f"{type(e).__name__}: {e}"))
+
+
+def run_isolated(base_url: str, size: int, args) -> List[Dict[str, Any]]:
+    """在新的解释器进程中运行，保证峰值内存只属于该规模"""
+    ctx = multiprocessing.get_context("spawn")
+    out_queue = ctx.Queue()
+    proc = ctx.Process(target=_scenario_entry, args=(out_queue, base_url, size, vars(args)))
+    proc.start()
+    while True:
+        try:
+            status, payload = out_queue.get(timeout=1.0)
+            break
+        except queue.Empty:
+            # 子进程被杀死（如OOM）或异常退出时不会写入结果，不能无限等待
+            if proc.is_alive():
+                continue
+            proc.join()
+            try:
+                # 子进程可能在写入结果后、本次轮询超时前刚好退出
+                status, payload = out_queue.get(timeout=0.5)
+                break
+            except queue.Empty:
+                raise RuntimeError(f"{size} 条记录的测试进程意外退出，退出码 {proc.exitcode}") from None
+    proc.join()
+    if status != "ok":
+        raise RuntimeError(f"{size} 条记录的测试失败: {payload}")
+    return payload
+
+
+def print_rows(rows: List[Dict[str, Any]]):
+    header = f"{'records':>8} {'phase':<7} {'p50 ms':>10} {'p99 ms':>10} {'rec/s':>10} " \
+             f"{'errors':>7} {'rss KB':>9}  api calls/cycle"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        calls = ", ".join(f"{k}={v:g}" for k, v in row["api_calls_per_cycle"].items()) or "-"
+        print(f"{row['records']:>8} {row['phase']:<7} {row['p50_ms']:>10.2f} {row['p99_ms']:>10.2f} "
+              f"{row['throughput_rps']:>10.1f} {row['errors_per_cycle']:>7g} "
+              f"{row['peak_rss_kb'] or 0:>9}  {calls}")
+
+
+def compare_rows(rows: List[Dict[str, Any]], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """与历史结果对比，返回退化项（耗时或接口调用次数超出容差）"""
+    previous = {(r["records"], r["phase"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for row in rows:
+        old = previous.get((row["records"], row["phase"]))
+        if not old:
+            continue
+        label = f"{row['records']} 条/{row['phase']}"
+        if old["p50_ms"] and row["p50_ms"] > old["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{label}: p50 {old['p50_ms']} -> {row['p50_ms']} ms")
+        old_calls = sum(old["api_calls_per_cycle"].values())
+        new_calls = sum(row["api_calls_per_cycle"].values())
+        if new_calls > old_calls:
+            regressions.append(f"{label}: 每周期接口调用 {old_calls:g} -> {new_calls:g}")
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Aliyun ESA DDNS 基准测试")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="记录数量，逗号分隔（默认 1,100,10000）")
+    parser.add_argument("--cycles", type=int, default=3, help="每个阶段运行的周期数")
+    parser.add_argument("--workers", type=int, default=8, help="batch.max_workers")
+    parser.add_argument("--bulk-compare", action="store_true", help="启用 batch.bulk_compare")
+    parser.add_argument("--state-cache", action="store_true", help="启用本地状态缓存")
+    parser.add_argument("--latency", type=float, default=0.0, help="模拟接口延迟（毫秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="额外随机延迟上限（毫秒）")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="返回 Throttling 的比例")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 503 的比例")
+    parser.add_argument("--retry-delay", type=float, default=0.05, help="resilience.base_delay（秒）")
+    parser.add_argument("--trace-alloc", action="store_true", help="使用 tracemalloc 统计每周期分配峰值")
+    parser.add_argument("--json", metavar="PATH", help="将结果写入JSON文件，- 表示标准输出")
+    parser.add_argument("--compare", metavar="PATH", help="与之前保存的JSON结果对比")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="对比时允许的耗时退化比例")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    state = FakeESAState(latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+                         throttle_rate=args.throttle_rate, error_rate=args.error_rate)
+    server = start_fake_esa(state)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    rows = []
+    try:
+        for size in sizes:
+            print(f"运行 {size} 条记录...", file=sys.stderr)
+            rows.extend(run_isolated(base_url, size, args))
+    finally:
+        server.shutdown()
+
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "options": {k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+        "results": rows,
+    }
+    if args.json == "-":
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_rows(rows)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare_rows(rows, json.load(f), args.tolerance)
+        for item in regressions:
+            print(f"退化: {item}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,83 @@
 # -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import time
+
+# 进程开始加载本模块的时间，用于统计启动耗时
+_module_load_started = time.perf_counter()
+
+import asyncio
 import json
+import random
 import sys
-import yaml
-import ast
-import requests
-import time
-import schedule
+import select
 import signal
+import socket
+import struct
 import sys
+import tempfile
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
-from alibabacloud_esa20240910.client import Client as ESA20240910Client
-from alibabacloud_tea_openapi import models as open_api_models
-from alibabacloud_esa20240910 import models as esa20240910_models
-from alibabacloud_tea_util import models as util_models
-from alibabacloud_credentials.client import Client as CredClient
-from alibabacloud_credentials.models import Config as CredConfig
+from typing import Dict, Any, Optional, List, Union
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING
+import argparse
+import atexit
+import base64
+import collections
+import contextlib
+import contextvars
 import functools
+import gzip
+import hashlib
+import hmac
+import http.client
+import importlib
+import ipaddress
 import threading
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import shutil
+import socketserver
+import sqlite3
+import ssl
+import urllib.parse
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+if TYPE_CHECKING:
+    from alibabacloud_esa20240910.client import Client as ESA20240910Client
+
+
+class _LazyModule:
+    """
+    延迟导入的模块代理：首次访问属性时才真正导入
+
+    ESA SDK 与凭证客户端的导入耗时远超一次无变化的检查，只在真正需要访问ESA时才加载。
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+esa20240910_models = _LazyModule("alibabacloud_esa20240910.models")
+open_api_models = _LazyModule("alibabacloud_tea_openapi.models")
+util_models = _LazyModule("alibabacloud_tea_util.models")
+yaml = _LazyModule("yaml")
 
 
 # 颜色定义
@@ -49,7 +107,7 @@ class Colors:
 
 # 配置日志
 class ColoredFormatter(logging.Formatter):
-    """彩色日志格式化器"""
+    """彩色日志格式化器（在记录副本上着色，不影响其它处理器）"""
     LEVEL_COLORS = {
         'DEBUG': Colors.CYAN,
         'INFO': Colors.GREEN,
@@ -59,18 +117,31 @@ class ColoredFormatter(logging.Formatter):
     }
 
     def format(self, record):
-        # 保存原始级别
-        levelname = record.levelname
-        # 添加颜色
-        if levelname in self.LEVEL_COLORS:
-            record.levelname = f"{self.LEVEL_COLORS[levelname]}{levelname}{Colors.RESET}"
-            record.msg = f"{self.LEVEL_COLORS[levelname]}{record.msg}{Colors.RESET}"
-
-        # 调用父类格式化
-        result = super().format(record)
-        # 恢复原始级别
-        record.levelname = levelname
-        return result
+        color = self.LEVEL_COLORS.get(record.levelname)
+        if not color:
+            return super().format(record)
+        # 复制一份记录再着色，原记录保持不变
+        colored = logging.makeLogRecord(record.__dict__)
+        colored.levelname = f"{color}{record.levelname}{Colors.RESET}"
+        colored.msg = f"{color}{record.getMessage()}{Colors.RESET}"
+        colored.args = None
+        return super().format(colored)
+
+
+class JsonFormatter(logging.Formatter):
+    """JSON Lines 日志格式化器"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
 
 
 # 创建彩色打印函数
@@ -81,60 +152,1309 @@ def cprint(text, color=Colors.RESET, bold=False, end='\n'):
 
 
 # 配置日志处理器
-def setup_logging():
-    """配置彩色日志"""
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+DEFAULT_LOG_FILE = 'ddns_updater.log'
+
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _gzip_rotator(source: str, dest: str):
+    """轮转时将旧日志压缩为 .gz"""
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def _create_file_handler(log_cfg: Dict[str, Any]) -> logging.Handler:
+    """按配置创建（可轮转的）文件处理器"""
+    filename = log_cfg.get("file", DEFAULT_LOG_FILE)
+    rotate = log_cfg.get("rotate", "size")
+    backup_count = int(log_cfg.get("backup_count", 5))
+
+    if rotate == "time":
+        handler = logging.handlers.TimedRotatingFileHandler(
+            filename, when=log_cfg.get("when", "midnight"), backupCount=backup_count, encoding="utf-8")
+    elif rotate == "size":
+        handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=int(log_cfg.get("max_bytes", 10 * 1024 * 1024)),
+            backupCount=backup_count, encoding="utf-8")
+    else:
+        handler = logging.FileHandler(filename, encoding="utf-8")
+
+    if rotate in ("size", "time") and log_cfg.get("compress"):
+        handler.namer = lambda name: name + ".gz"
+        handler.rotator = _gzip_rotator
+    return handler
+
+
+def stop_logging():
+    """停止后台日志线程并写出队列中剩余的日志"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+def setup_logging(log_cfg: Optional[Dict[str, Any]] = None):
+    """
+    配置彩色日志
+
+    文件日志经 QueueHandler/QueueListener 交给后台线程写入，业务线程只负责入队；
+    支持按大小或时间轮转（可压缩）以及 JSON Lines 格式。控制台日志默认同步输出，
+    以保持与终端彩色提示的先后顺序。
+    """
+    log_cfg = log_cfg or {}
+    level = getattr(logging, str(log_cfg.get("level", "INFO")).upper(), logging.INFO)
+
     logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
+    logger.setLevel(level)
 
-    # 移除所有现有的处理器
-    logger.handlers.clear()
+    # 移除所有现有的处理器，并停止旧的后台日志线程
+    stop_logging()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        if not isinstance(handler, logging.handlers.QueueHandler):
+            handler.close()
 
     # 创建控制台处理器
     console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(logging.INFO)
-    console_formatter = ColoredFormatter(
-        '%(asctime)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    console_handler.setFormatter(console_formatter)
+    console_handler.setLevel(level)
+    console_handler.setFormatter(ColoredFormatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
 
     # 创建文件处理器
-    file_handler = logging.FileHandler('ddns_updater.log')
-    file_handler.setLevel(logging.INFO)
-    file_formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    file_handler.setFormatter(file_formatter)
+    file_handler = _create_file_handler(log_cfg)
+    file_handler.setLevel(level)
+    if log_cfg.get("format") == "json":
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+
+    # 文件（以及可选的控制台）写入交给后台线程
+    background = [file_handler]
+    if log_cfg.get("async_console"):
+        background.append(console_handler)
+    else:
+        logger.addHandler(console_handler)
 
-    # 添加处理器
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    global _log_listener
+    log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(log_queue, *background, respect_handler_level=True)
+    _log_listener.start()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
     return logger
 
 
-# 初始化日志
-logger = setup_logging()
+# 日志在 main() 读取配置后初始化，导入模块本身不产生副作用
+logger = logging.getLogger()
+atexit.register(stop_logging)
 
 # 全局变量
+DEFAULT_BATCH_WORKERS = 8
+DEFAULT_FLEET_WORKERS = 16
+DEFAULT_SCHEDULE_CRON = "0 * * * *"
+DEFAULT_JOB = "default"
+MANUAL_JOB = "manual"
+DEFAULT_LIST_PAGE_SIZE = 500
+DEFAULT_STATE_CACHE_PATH = "ddns_state.json"
+DEFAULT_STATE_REVALIDATE_TTL = 6 * 3600
+DEFAULT_RECORD_INDEX_PATH = "ddns_record_index.json"
+DEFAULT_RECORD_INDEX_TTL = 7 * 24 * 3600
+DEFAULT_RECORD_INDEX_SCAN_THRESHOLD = 5
+DEFAULT_HISTORY_PATH = "ddns_history.db"
+DEFAULT_HISTORY_RAW_DAYS = 7
+DEFAULT_HISTORY_RETENTION_DAYS = 400
+DEFAULT_HISTORY_COMPACT_INTERVAL = 24 * 3600
+DEFAULT_LEASE_PATH = "ddns_leases"
+DEFAULT_LEASE_TTL = 600
+DEFAULT_LEASE_SHARDS = 16
+DEFAULT_IP_PROVIDER_TIMEOUT = 5.0
+# IP提供方响应（含响应头）的大小上限
+IP_PROVIDER_MAX_RESPONSE = 64 * 1024
+DEFAULT_ESA_CALL_TIMEOUT = 10.0
+DEFAULT_CONFIG_POLL_INTERVAL = 2.0
+DEFAULT_PROPAGATION_TIMEOUT = 2.0
+DEFAULT_PROPAGATION_DEADLINE = 120.0
+DEFAULT_PROPAGATION_INTERVAL = 5.0
+DEFAULT_IP_HEDGE_DELAY = 0.3
+DEFAULT_WATCHER_DEBOUNCE = 3.0
+DEFAULT_WATCHER_POLL_INTERVAL = 10.0
+DEFAULT_METRICS_PORT = 9877
+DEFAULT_CONTROL_PORT = 9878
 running = True
-manual_scan_requested = False
-scan_lock = threading.Lock()
+last_results: List[Dict[str, Any]] = []
 
 
 # 信号处理器
 def signal_handler(signum, frame):
-    global running
     cprint(f"\n接收到信号 {signum}，正在优雅退出...", Colors.YELLOW, bold=True)
-    logger.info(f"接收到信号 {signum}，正在优雅退出...")
+    stop_service(f"接收到信号 {signum}，正在优雅退出...")
+
+
+def stop_service(reason: Optional[str] = None):
+    """停止服务主循环"""
+    global running
+    if reason:
+        logger.info(reason)
     running = False
+    scheduler.stop()
+    cancel_running_checks()
+
+
+# 指标
+class Metric:
+    """指标基类，按标签值组合分别计数"""
+
+    metric_type = "unknown"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def remove(self, **labels):
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    @staticmethod
+    def _escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def _labels(self, key: tuple, extra: Optional[Dict[str, str]] = None) -> str:
+        pairs = list(zip(self.label_names, key)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{self._escape(v)}"' for k, v in pairs) + "}"
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        family = self.name[:-len("_total")] if self.metric_type == "counter" else self.name
+        lines = [f"# TYPE {family} {self.metric_type}", f"# HELP {family} {self.documentation}"]
+        return lines + self.samples()
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._labels(k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._labels(k)} {v}" for k, v in self._values.items()]
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        # OpenMetrics 要求 le 为规范的浮点数表示（1.0 而不是 1）
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["counts"][i] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, entry in self._values.items():
+                for bound, count in zip(self.buckets, entry["counts"]):
+                    lines.append(f"{self.name}_bucket{self._labels(key, {'le': repr(bound)})} {count}")
+                lines.append(f"{self.name}_bucket{self._labels(key, {'le': '+Inf'})} {entry['count']}")
+                lines.append(f"{self.name}_sum{self._labels(key)} {entry['sum']}")
+                lines.append(f"{self.name}_count{self._labels(key)} {entry['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表，输出 OpenMetrics 文本格式"""
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+STAGE_DURATION = metrics.register(Histogram(
+    "ddns_stage_duration_seconds", "Duration of each update stage", ("stage",)))
+UPDATES_TOTAL = metrics.register(Counter(
+    "ddns_updates_total", "Successful record updates", ("record",)))
+NOOPS_TOTAL = metrics.register(Counter(
+    "ddns_noop_total", "Checks where the record already held the current IP", ("record",)))
+ERRORS_TOTAL = metrics.register(Counter(
+    "ddns_errors_total", "Failed checks or updates by error code", ("code",)))
+PROVIDER_FAILURES = metrics.register(Counter(
+    "ddns_ip_provider_failures_total", "Failed public IP lookups by provider", ("provider",)))
+LAST_SUCCESS = metrics.register(Gauge(
+    "ddns_last_success_timestamp_seconds", "Last time the record was confirmed up to date", ("record",)))
+COALESCED_TOTAL = metrics.register(Counter(
+    "ddns_writes_coalesced_total", "Record writes avoided by the write coalescer", ("reason",)))
+LEASES_HELD = metrics.register(Gauge(
+    "ddns_leases_held", "Whether this instance holds the lease (1) or is standby (0)", ("lease",)))
+CONFIG_RELOADS = metrics.register(Counter(
+    "ddns_config_reloads_total", "Config file changes applied or rejected", ("result",)))
+PROPAGATION_SECONDS = metrics.register(Histogram(
+    "ddns_propagation_seconds", "Time from a record update until all nameservers serve the new value",
+    buckets=(1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)))
+PROPAGATION_TOTAL = metrics.register(Counter(
+    "ddns_propagation_checks_total", "Post-update propagation checks by outcome", ("result",)))
+RECORD_IP = metrics.register(Gauge(
+    "ddns_record_current_ip", "Value currently known for the record", ("record", "ip")))
+
+_record_ip_labels: Dict[str, str] = {}
+_record_ip_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def metrics_stage(stage: str):
+    """计时上下文，将耗时记录到 ddns_stage_duration_seconds；开启追踪时同时记录为 span"""
+    start = time.perf_counter()
+    try:
+        if _tracer is None:
+            yield
+        else:
+            with _tracer.span(f"ddns.{stage}"):
+                yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+# 当前正在收集的各阶段耗时（供运行历史使用）；按上下文区分，同一事件循环中的协程互不影响
+_stage_collector: contextvars.ContextVar = contextvars.ContextVar("ddns_stage_collector", default=None)
+
+
+def observe_stage(stage: str, seconds: float):
+    """记录阶段耗时：写入直方图，并累加到当前上下文的收集器中"""
+    STAGE_DURATION.observe(seconds, stage=stage)
+    stages = _stage_collector.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def collect_stages():
+    """收集当前线程（或协程）内各阶段的耗时，yield 出 {阶段: 秒数}"""
+    stages: Dict[str, float] = {}
+    token = _stage_collector.set(stages)
+    try:
+        yield stages
+    finally:
+        _stage_collector.reset(token)
+
+
+# 追踪、性能分析与内存追踪（均默认关闭；关闭时各埋点只多一次全局变量判断）
+SERVICE_NAME = "aliyun-esa-ddns"
+DEFAULT_PROFILE_DIR = "ddns_profile"
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+_NO_SPAN = contextlib.nullcontext()
+_current_span: contextvars.ContextVar = contextvars.ContextVar("ddns_current_span", default=None)
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+class Span:
+    """一段计时区间，对应 OpenTelemetry 的 span"""
+
+    __slots__ = ("name", "kind", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, kind: int, parent: Optional["Span"], attributes: Optional[Dict[str, Any]]):
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start_ns = self.end_ns = 0
+        self.attributes = dict(attributes) if attributes else {}
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_otlp_attribute(k, v) for k, v in self.attributes.items() if v is not None],
+            "status": {"code": 2, "message": self.error} if self.error is not None else {},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class SpanTracer:
+    """
+    span 追踪器
+
+    span 按上下文（线程/协程）形成父子关系，asyncio.to_thread 中的工作自动归入调用方。
+    根 span（一次更新周期）结束时，将该次追踪的全部 span 作为一行 OTLP/JSON
+    （ExportTraceServiceRequest）追加到文件，可由 OpenTelemetry Collector 的 otlpjsonfile 接收器读取。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending: Dict[str, List[Span]] = {}
+        self._resource = {"attributes": [_otlp_attribute("service.name", SERVICE_NAME),
+                                         _otlp_attribute("service.instance.id", DEFAULT_INSTANCE_ID)]}
+
+    @contextlib.contextmanager
+    def span(self, name: str, attributes: Optional[Dict[str, Any]] = None, kind: int = SPAN_KIND_INTERNAL):
+        parent = _current_span.get()
+        current = Span(name, kind, parent, attributes)
+        token = _current_span.set(current)
+        current.start_ns = time.time_ns()
+        try:
+            yield current
+        except BaseException as e:
+            current.error = str(e) or type(e).__name__
+            raise
+        finally:
+            current.end_ns = time.time_ns()
+            _current_span.reset(token)
+            self._finish(current, root=parent is None)
+
+    def _finish(self, span: Span, root: bool):
+        with self._lock:
+            self._pending.setdefault(span.trace_id, []).append(span)
+            if not root:
+                return
+            spans = self._pending.pop(span.trace_id)
+        line = json.dumps({"resourceSpans": [{
+            "resource": self._resource,
+            "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": [s.to_otlp() for s in spans]}],
+        }]}, ensure_ascii=False)
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logger.warning(f"写入追踪文件 {self.path} 失败: {e}")
+
+
+_tracer: Optional[SpanTracer] = None
+
+
+def span(name: str, attributes: Optional[Dict[str, Any]] = None, kind: int = SPAN_KIND_INTERNAL):
+    """追踪区间；未开启追踪时返回空上下文（as 得到 None）"""
+    tracer = _tracer
+    if tracer is None:
+        return _NO_SPAN
+    return tracer.span(name, attributes, kind)
+
+
+def collapse_stats(stats: Dict[tuple, tuple], min_fraction: float = 1e-4) -> Dict[str, int]:
+    """
+    将 cProfile 的统计转换为折叠调用栈 {"根;...;函数": 微秒}，可用 flamegraph.pl 或 speedscope 绘制火焰图
+
+    cProfile 只记录调用边而不记录完整的调用栈，这里从根函数出发沿调用边展开，
+    按各调用边的累计耗时占比分摊子函数的耗时（与 flameprof 等工具的近似方法相同）。
+    """
+    callees: Dict[tuple, List[tuple]] = collections.defaultdict(list)
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller].append((func, edge[3]))
+    roots = [func for func, entry in stats.items() if not entry[4]]
+    total = sum(stats[func][3] for func in roots) or 1.0
+    folded: Dict[str, int] = collections.defaultdict(int)
+
+    def label(func: tuple) -> str:
+        filename, line, name = func
+        return f"{name} ({os.path.basename(filename)}:{line})" if line else name
+
+    def walk(func: tuple, frames: tuple, on_stack: frozenset, scale: float):
+        frames = frames + (label(func),)
+        micros = int(stats[func][2] * scale * 1e6)
+        if micros:
+            folded[";".join(frames)] += micros
+        for callee, edge_time in callees.get(func, ()):
+            callee_total = stats[callee][3]
+            if callee in on_stack or callee_total <= 0 or edge_time * scale < total * min_fraction:
+                continue
+            walk(callee, frames, on_stack | {callee}, scale * min(1.0, edge_time / callee_total))
+
+    for root in roots:
+        walk(root, (), frozenset((root,)), 1.0)
+    return dict(folded)
+
+
+class CycleProfiler:
+    """
+    周期性能分析：用 cProfile 记录接下来 N 个更新周期
+
+    完成后在 directory 下写出 .pstats（可用 pstats / snakeviz 查看）与 .folded
+    （折叠调用栈，可生成火焰图），并在日志中输出累计耗时最高的函数。cProfile 只统计执行
+    更新周期的线程（异步引擎的事件循环），asyncio.to_thread 与多账号模式工作线程中的调用不计入。
+    """
+
+    def __init__(self, cycles: int, directory: str = DEFAULT_PROFILE_DIR):
+        import cProfile
+        self.remaining = cycles
+        self.directory = directory
+        self.recorded = 0
+        self._profile = cProfile.Profile()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def cycle(self):
+        # 同一时间只分析一个周期（手动触发与定时任务可能并发）
+        if self.remaining <= 0 or not self._lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            self._profile.enable()
+            try:
+                yield
+            finally:
+                self._profile.disable()
+            self.recorded += 1
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.dump()
+        finally:
+            self._lock.release()
+
+    def dump(self) -> Optional[str]:
+        """写出已记录的统计，返回文件名前缀"""
+        if not self.recorded:
+            return None
+        import io
+        import pstats
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"ddns-profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+        self._profile.dump_stats(base + ".pstats")
+        stats = pstats.Stats(self._profile)
+        folded = collapse_stats(stats.stats)
+        with open(base + ".folded", "w", encoding="utf-8") as f:
+            for stack, micros in sorted(folded.items()):
+                f.write(f"{stack} {micros}\n")
+        stream = io.StringIO()
+        pstats.Stats(self._profile, stream=stream).sort_stats("cumulative").print_stats(20)
+        logger.info(f"性能分析（{self.recorded} 个周期）累计耗时最高的函数:\n{stream.getvalue().strip()}")
+        cprint(f"性能分析完成（{self.recorded} 个周期）: {base}.pstats / {base}.folded", Colors.GREEN)
+        self.recorded = 0
+        return base
+
+
+class MemoryTracker:
+    """
+    内存追踪：每个更新周期结束后拍摄 tracemalloc 快照并与上一周期比较
+
+    在日志中列出内存增长最多的代码位置，用于排查长时间运行时的内存泄漏。
+    只保留上一份快照；开启后内存分配会明显变慢，仅用于排查问题。
+    """
+
+    def __init__(self, top: int = 10, frames: int = 1):
+        import tracemalloc
+        self.top = top
+        self._previous = None
+        self._cycles = 0
+        self._lock = threading.Lock()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def before_cycle(self):
+        import tracemalloc
+        tracemalloc.reset_peak()
+
+    def after_cycle(self):
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "*/cProfile.py"),
+            tracemalloc.Filter(False, "*/pstats.py"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+        with self._lock:
+            previous, self._previous = self._previous, snapshot
+            self._cycles += 1
+            cycle = self._cycles
+        summary = f"内存追踪[周期 {cycle}]: 当前 {current / 1024:.0f} KiB，本周期峰值 {peak / 1024:.0f} KiB"
+        if previous is None:
+            logger.info(f"{summary}（首个快照，作为比较基准）")
+            return
+        diffs = [stat for stat in snapshot.compare_to(previous, "lineno") if stat.size_diff][:self.top]
+        growth = sum(stat.size_diff for stat in snapshot.compare_to(previous, "filename"))
+        lines = "\n".join(f"  {stat}" for stat in diffs)
+        logger.info(f"{summary}，较上一周期 {growth / 1024:+.0f} KiB" + (f"，变化最大的位置:\n{lines}" if lines else ""))
+
+
+_profiler: Optional[CycleProfiler] = None
+_memory_tracker: Optional[MemoryTracker] = None
+
+
+def setup_instrumentation(config: Dict[str, Any], args: Optional[argparse.Namespace] = None):
+    """按配置中的 profiling 部分与命令行参数开启性能分析、内存追踪与 span 追踪"""
+    global _tracer, _profiler, _memory_tracker
+    prof_cfg = config.get("profiling") or {}
+    cycles = (args.profile if args is not None and args.profile else None) or prof_cfg.get("cycles", 0)
+    trace_file = (args.trace if args is not None and args.trace else None) or prof_cfg.get("trace_file")
+    memory = (args is not None and args.trace_memory) or prof_cfg.get("memory", False)
+
+    if cycles:
+        _profiler = CycleProfiler(int(cycles), prof_cfg.get("dir", DEFAULT_PROFILE_DIR))
+        logger.info(f"性能分析已开启：记录接下来 {int(cycles)} 个更新周期")
+    if trace_file:
+        _tracer = SpanTracer(trace_file)
+        logger.info(f"span 追踪已开启，写入 {trace_file}")
+    if memory:
+        _memory_tracker = MemoryTracker(int(prof_cfg.get("memory_top", 10)))
+        logger.info("内存追踪已开启：每个更新周期结束后比较内存快照")
+
+
+def shutdown_instrumentation():
+    """退出前写出尚未完成的性能分析"""
+    if _profiler is not None and _profiler.remaining > 0:
+        _profiler.dump()
+
+
+@contextlib.contextmanager
+def instrumented_cycle(auto_update: bool):
+    """在一次更新周期外层依次套上 cProfile、内存快照与根 span"""
+    memory = _memory_tracker
+    if memory is not None:
+        memory.before_cycle()
+    with (_profiler.cycle() if _profiler is not None else _NO_SPAN), \
+            span("ddns.cycle", {"ddns.auto_update": auto_update}) as cycle_span:
+        yield cycle_span
+    if memory is not None:
+        memory.after_cycle()
+
+
+def observe_result(result: Dict[str, Any]):
+    """根据单条记录的结果更新计数器与仪表"""
+    record = str(result.get("record_id"))
+    update_result = result.get("update_result") or {}
+
+    if result.get("error"):
+        ERRORS_TOTAL.inc(code=result.get("error_code", "Unknown"))
+        return
+    if result.get("update_performed") and not update_result.get("success"):
+        ERRORS_TOTAL.inc(code=update_result.get("error_code", "Unknown"))
+        return
+
+    if result.get("update_performed"):
+        # 合并到其它写入中的结果没有实际调用 UpdateRecord
+        if not result.get("coalesced"):
+            UPDATES_TOTAL.inc(record=record)
+        value = result.get("local_ip")
+    else:
+        # 未执行更新时记录值仍是查询到的值（auto_update=False 时可能已过期）
+        value = result.get("record_ip")
+        if not result.get("ip_changed"):
+            NOOPS_TOTAL.inc(record=record)
+    if result.get("update_performed") or not result.get("ip_changed"):
+        LAST_SUCCESS.set(time.time(), record=record)
+
+    if value:
+        with _record_ip_lock:
+            previous = _record_ip_labels.get(record)
+            if previous != value:
+                if previous is not None:
+                    RECORD_IP.remove(record=record, ip=previous)
+                RECORD_IP.set(1, record=record, ip=value)
+                _record_ip_labels[record] = value
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """/metrics 请求处理"""
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"metrics: {format % args}")
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        """监听 Unix 套接字的HTTP服务"""
+        daemon_threads = True
+else:
+    UnixHTTPServer = None
+
+
+def serve_http(handler_cls, name: str, host: str = "127.0.0.1", port: int = 0,
+               unix_socket: Optional[str] = None):
+    """在后台线程中启动本地HTTP服务（TCP或Unix套接字），失败时返回None"""
+    try:
+        if unix_socket:
+            if UnixHTTPServer is None:
+                raise OSError("当前平台不支持Unix套接字")
+            if os.path.exists(unix_socket):
+                os.unlink(unix_socket)
+            server = UnixHTTPServer(unix_socket, handler_cls)
+            os.chmod(unix_socket, 0o600)
+            address = f"unix:{unix_socket}"
+        else:
+            server = ThreadingHTTPServer((host, port), handler_cls)
+            server.daemon_threads = True
+            address = f"http://{host}:{server.server_address[1]}"
+    except OSError as e:
+        logger.error(f"启动{name}失败 {unix_socket or f'{host}:{port}'} - {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name=name, daemon=True).start()
+    logger.info(f"{name}已启动: {address}")
+    return server
+
+
+def start_metrics_server(config: Dict[str, Any]):
+    """按配置在本地启动指标HTTP服务"""
+    metrics_cfg = config.get("metrics") or {}
+    if not metrics_cfg.get("enabled"):
+        return None
+    return serve_http(_MetricsRequestHandler, "指标服务",
+                      host=metrics_cfg.get("host", "127.0.0.1"),
+                      port=int(metrics_cfg.get("port", DEFAULT_METRICS_PORT)))
+
+
+# 控制接口
+class _ControlRequestHandler(BaseHTTPRequestHandler):
+    """
+    本地控制接口
+
+      GET  /status                         服务状态与下次执行时间
+      GET  /results                        最近一次更新的结果
+      GET  /history[?record=..&since=7d&until=..&status=..&limit=100]
+                                           查询运行历史
+      POST /trigger[?record_id=..&dry_run=1&wait=1]
+                                           触发更新；指定记录、试运行或 wait=1 时同步执行并返回结果
+      POST /exit                           停止服务
+    """
+
+    def _send_json(self, code: int, payload: Any):
+        body = json.dumps(payload, ensure_ascii=False, default=_json_default).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        token = (self.server.control_cfg or {}).get("token")
+        if not token:
+            return True
+        return hmac.compare_digest(self.headers.get("Authorization", ""), f"Bearer {token}")
+
+    def _params(self) -> Dict[str, List[str]]:
+        parsed = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(parsed.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            raw = self.rfile.read(length).decode("utf-8")
+            try:
+                body = json.loads(raw)
+                for key, value in (body or {}).items():
+                    params[key] = [str(v) for v in value] if isinstance(value, list) else [str(value)]
+            except ValueError:
+                params.update(urllib.parse.parse_qs(raw))
+        return params
+
+    def _dispatch(self, method: str):
+        if not self._authorized():
+            self._send_json(401, {"error": "unauthorized"})
+            return
+        route = urllib.parse.urlsplit(self.path).path.rstrip("/") or "/"
+        try:
+            if method == "GET" and route == "/status":
+                self._send_json(200, get_service_status())
+            elif method == "GET" and route == "/results":
+                self._send_json(200, {"results": last_results})
+            elif method == "GET" and route == "/history":
+                params = {k: v[0] for k, v in self._params().items()}
+                history = query_history(load_config(), record=params.get("record"),
+                                        since=params.get("since"), until=params.get("until"),
+                                        status=params.get("status"), limit=int(params.get("limit", 100)))
+                self._send_json(404 if "error" in history else 200, history)
+            elif method == "POST" and route == "/trigger":
+                params = self._params()
+                record_ids = params.get("record_id") or None
+                dry_run = _truthy(params.get("dry_run", ["0"])[0])
+                wait_result = _truthy(params.get("wait", ["0"])[0])
+                if record_ids or dry_run or wait_result:
+                    results = run_ddns_update(record_ids=record_ids, auto_update=not dry_run)
+                    self._send_json(200, {"dry_run": dry_run, "results": results})
+                else:
+                    request_manual_scan("控制接口请求手动扫描")
+                    self._send_json(202, {"queued": True})
+            elif method == "POST" and route == "/exit":
+                self._send_json(200, {"stopping": True})
+                stop_service("控制接口请求退出")
+            else:
+                self._send_json(404, {"error": f"unknown endpoint {method} {route}"})
+        except Exception as e:
+            logger.error(f"控制接口处理错误: {e}")
+            self._send_json(500, {"error": str(e)})
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def log_message(self, format, *args):
+        logger.debug(f"control: {format % args}")
+
+
+def _json_default(value: Any) -> Any:
+    """结果中的记录模型等对象转换为JSON"""
+    to_dict = getattr(value, "to_dict", None)
+    return to_dict() if to_dict is not None else str(value)
+
+
+def _truthy(value: Any) -> bool:
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def start_control_server(config: Dict[str, Any]):
+    """按配置启动本地控制接口（Unix套接字或仅本机可访问的HTTP）"""
+    control_cfg = config.get("control") or {}
+    if not control_cfg.get("enabled"):
+        return None
+    server = serve_http(_ControlRequestHandler, "控制接口",
+                        host=control_cfg.get("host", "127.0.0.1"),
+                        port=int(control_cfg.get("port", DEFAULT_CONTROL_PORT)),
+                        unix_socket=control_cfg.get("unix_socket"))
+    if server is not None:
+        server.control_cfg = control_cfg
+    return server
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """通过Unix套接字发送HTTP请求"""
+
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def control_request(method: str, path: str, control_cfg: Dict[str, Any],
+                    timeout: float = 300.0) -> tuple:
+    """向运行中的服务发送控制请求，返回 (HTTP状态码, JSON内容)"""
+    if control_cfg.get("unix_socket"):
+        conn = _UnixHTTPConnection(control_cfg["unix_socket"], timeout)
+    else:
+        conn = http.client.HTTPConnection(control_cfg.get("host", "127.0.0.1"),
+                                          int(control_cfg.get("port", DEFAULT_CONTROL_PORT)), timeout=timeout)
+    headers = {}
+    if control_cfg.get("token"):
+        headers["Authorization"] = f"Bearer {control_cfg['token']}"
+    try:
+        conn.request(method, path, headers=headers)
+        resp = conn.getresponse()
+        return resp.status, json.loads(resp.read().decode("utf-8") or "{}")
+    finally:
+        conn.close()
+
+
+def run_control_client(args) -> int:
+    """ctl 子命令：通过控制接口操作运行中的服务"""
+    control_cfg: Dict[str, Any] = {}
+    try:
+        control_cfg = dict(load_config().get("control") or {})
+    except Exception:
+        pass
+    if args.socket:
+        control_cfg["unix_socket"] = args.socket
+    if args.host:
+        control_cfg["host"] = args.host
+        control_cfg.pop("unix_socket", None)
+    if args.port:
+        control_cfg["port"] = args.port
+    if args.token:
+        control_cfg["token"] = args.token
+
+    if args.action == "status":
+        method, path = "GET", "/status"
+    elif args.action == "results":
+        method, path = "GET", "/results"
+    elif args.action == "exit":
+        method, path = "POST", "/exit"
+    elif args.action == "history":
+        query = [(k, str(v)) for k, v in (("record", (args.record or [None])[0]), ("since", args.since),
+                                          ("until", args.until), ("limit", args.limit)) if v]
+        method, path = "GET", "/history" + (f"?{urllib.parse.urlencode(query)}" if query else "")
+    else:
+        query = [("record_id", str(r)) for r in (args.record or [])]
+        if args.dry_run:
+            query.append(("dry_run", "1"))
+        if args.wait:
+            query.append(("wait", "1"))
+        method, path = "POST", "/trigger" + (f"?{urllib.parse.urlencode(query)}" if query else "")
+
+    try:
+        status, payload = control_request(method, path, control_cfg)
+    except OSError as e:
+        print(f"无法连接到DDNS服务: {e}", file=sys.stderr)
+        return 2
+    print(json.dumps(payload, ensure_ascii=False, indent=2, default=str))
+    if status >= 400:
+        return 1
+    results = payload.get("results") if isinstance(payload, dict) else None
+    return 1 if results and any(r.get("error") for r in results) else 0
+
+
+# 调度器
+class CronExpression:
+    """
+    5段cron表达式：分 时 日 月 周
+
+    每段支持 *、*/n、a-b、a-b/n 以及逗号分隔的列表；周的取值 0-7，0 和 7 均表示周日。
+    """
+
+    FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"cron表达式需要5段: {expression}")
+        self.expression = expression
+        fields = [self._parse_field(part, lo, hi) for part, (lo, hi) in zip(parts, self.FIELD_RANGES)]
+        self.minutes, self.hours, self.days, self.months, weekdays = fields
+        self.weekdays = {d % 7 for d in weekdays}
+        self._day_any = parts[2] == "*"
+        self._weekday_any = parts[4] == "*"
+
+    @staticmethod
+    def _parse_field(field: str, lo: int, hi: int) -> set:
+        values = set()
+        for item in field.split(","):
+            step = 1
+            if "/" in item:
+                item, step_str = item.split("/", 1)
+                step = int(step_str)
+                if step <= 0:
+                    raise ValueError(f"cron步长无效: {field}")
+            if item == "*":
+                start, end = lo, hi
+            elif "-" in item:
+                start, end = (int(x) for x in item.split("-", 1))
+            else:
+                start = int(item)
+                end = hi if step > 1 else start
+            if start < lo or end > hi or start > end:
+                raise ValueError(f"cron字段超出范围: {field}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt: datetime) -> bool:
+        day_ok = dt.day in self.days
+        # isoweekday: 周一=1 ... 周日=7
+        weekday_ok = dt.isoweekday() % 7 in self.weekdays
+        if self._day_any:
+            return weekday_ok
+        if self._weekday_any:
+            return day_ok
+        # 日与周同时限定时，满足其一即可（与标准cron一致）
+        return day_ok or weekday_ok
+
+    def next_after(self, dt: datetime) -> datetime:
+        """返回严格晚于 dt 的下一个匹配时间"""
+        t = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"cron表达式没有可匹配的时间: {self.expression}")
+
+
+class ScheduledJob:
+    """调度任务：固定间隔或cron表达式触发，可附加随机抖动；两者都未设置时只能手动触发"""
+
+    def __init__(self, name: str, callback, interval: Optional[float] = None,
+                 cron: Optional[str] = None, jitter: float = 0.0):
+        if interval is not None and interval <= 0:
+            raise ValueError(f"任务 {name} 的间隔必须大于0")
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.cron = CronExpression(cron) if cron else None
+        self.jitter = max(0.0, jitter)
+        self.next_run: Optional[float] = None
+        self.last_run: Optional[float] = None
+
+    def schedule_next(self, now: float):
+        if self.cron is not None:
+            base = self.cron.next_after(datetime.fromtimestamp(now)).timestamp()
+        elif self.interval is not None:
+            base = now + self.interval
+        else:
+            self.next_run = None
+            return
+        self.next_run = base + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+
+class Scheduler:
+    """
+    基于条件变量的调度器
+
+    空闲时一直睡眠到最近一个任务的执行时间，手动触发与停止会立即唤醒；
+    任务回调在锁外执行，调度锁不会跨越任何网络请求。
+    """
+
+    # 单次最长睡眠时间，用于校正系统时钟跳变
+    MAX_SLEEP = 300.0
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._jobs: Dict[str, ScheduledJob] = {}
+        self._triggered: List[str] = []
+        self._deferred: Dict[str, float] = {}
+        self._stopped = False
+        self._running = False
+
+    def add_job(self, name: str, callback, interval: Optional[float] = None,
+                cron: Optional[str] = None, jitter: float = 0.0) -> ScheduledJob:
+        job = ScheduledJob(name, callback, interval=interval, cron=cron, jitter=jitter)
+        job.schedule_next(time.time())
+        with self._cond:
+            self._jobs[name] = job
+            self._cond.notify()
+        return job
+
+    def remove_job(self, name: str):
+        with self._cond:
+            self._jobs.pop(name, None)
+
+    def job_names(self) -> List[str]:
+        with self._cond:
+            return list(self._jobs)
+
+    def clear(self):
+        with self._cond:
+            self._jobs.clear()
+            self._triggered.clear()
+            self._deferred.clear()
+
+    def trigger(self, name: str) -> bool:
+        """立即执行指定任务；尚未执行的重复触发会被合并"""
+        with self._cond:
+            if name not in self._jobs:
+                return False
+            if name not in self._triggered:
+                self._triggered.append(name)
+            self._cond.notify()
+            return True
+
+    def trigger_later(self, name: str, delay: float) -> bool:
+        """delay 秒后执行指定任务；已有更早的延迟触发时合并为一次"""
+        with self._cond:
+            if name not in self._jobs:
+                return False
+            when = time.time() + max(0.0, delay)
+            if name not in self._deferred or when < self._deferred[name]:
+                self._deferred[name] = when
+            self._cond.notify()
+            return True
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped
+
+    @property
+    def running(self) -> bool:
+        """调度主循环是否在运行（单次模式下不运行）"""
+        return self._running and not self._stopped
+
+    def next_runs(self) -> Dict[str, Optional[datetime]]:
+        """各任务的下次执行时间"""
+        with self._cond:
+            return {name: (datetime.fromtimestamp(job.next_run) if job.next_run else None)
+                    for name, job in self._jobs.items()}
+
+    def _next_due(self) -> List[ScheduledJob]:
+        """在持有锁的情况下等待，直到有任务需要执行或调度器停止"""
+        while not self._stopped:
+            now = time.time()
+            for name, when in list(self._deferred.items()):
+                if when <= now:
+                    del self._deferred[name]
+                    if name not in self._triggered:
+                        self._triggered.append(name)
+            if self._triggered:
+                names, self._triggered = self._triggered, []
+                return [self._jobs[n] for n in names if n in self._jobs]
+
+            now = time.time()
+            due = [job for job in self._jobs.values() if job.next_run is not None and job.next_run <= now]
+            if due:
+                for job in due:
+                    job.schedule_next(now)
+                return due
+
+            upcoming = [job.next_run for job in self._jobs.values() if job.next_run is not None]
+            upcoming.extend(self._deferred.values())
+            timeout = min(min(upcoming) - now, self.MAX_SLEEP) if upcoming else None
+            self._cond.wait(timeout)
+        return []
+
+    def run(self):
+        """调度主循环，直到 stop() 被调用"""
+        self._running = True
+        while True:
+            with self._cond:
+                jobs = self._next_due()
+                if self._stopped:
+                    return
+            for job in jobs:
+                job.last_run = time.time()
+                try:
+                    job.callback()
+                except Exception as e:
+                    logger.error(f"调度任务 {job.name} 执行失败: {e}")
+                    cprint(f"错误: {e}", Colors.RED)
+                if self._stopped:
+                    return
+
+
+scheduler = Scheduler()
+
+
+def request_manual_scan(reason: str = "用户请求手动扫描"):
+    """请求调度器立即执行一次扫描（重复请求会被合并）"""
+    logger.info(reason)
+    scheduler.trigger(MANUAL_JOB)
+
+
+# 网卡地址变化监听
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+
+# 仅用于选择出口地址的探测目标（UDP connect 不会发送任何数据包）
+ROUTE_PROBE_TARGETS = {
+    socket.AF_INET: "223.5.5.5",
+    socket.AF_INET6: "2400:3200::1",
+}
+
+
+def _route_source_address(family: int) -> Optional[str]:
+    """获取指定协议族默认路由的出口地址"""
+    try:
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.connect((ROUTE_PROBE_TARGETS[family], 53))
+            return sock.getsockname()[0]
+    except OSError:
+        return None
+
+
+def get_interface_addresses() -> frozenset:
+    """
+    获取本机网卡地址快照
+
+    包含 IPv4/IPv6 默认出口地址，以及 Linux 下 /proc/net/if_inet6 中的全局 IPv6 地址。
+    """
+    addresses = set()
+    for family in ROUTE_PROBE_TARGETS:
+        address = _route_source_address(family)
+        if address:
+            addresses.add(address)
+    try:
+        with open("/proc/net/if_inet6", "r") as f:
+            for line in f:
+                fields = line.split()
+                # 第4列为scope，00表示全局地址
+                if len(fields) >= 6 and fields[3] == "00":
+                    raw = fields[0]
+                    addresses.add(str(ipaddress.IPv6Address(int(raw, 16))))
+    except (OSError, ValueError):
+        pass
+    return frozenset(addresses)
+
+
+class InterfaceWatcher:
+    """
+    网卡地址变化监听器
+
+    Linux 下订阅 rtnetlink 的 RTM_NEWADDR/RTM_DELADDR 事件，其它平台
+    （或 mode=poll）定期对比本机地址快照。事件经过 debounce 秒去抖，
+    且只有地址快照确实变化时才调用 on_change。
+    """
+
+    def __init__(self, on_change, mode: str = "auto", debounce: float = DEFAULT_WATCHER_DEBOUNCE,
+                 poll_interval: float = DEFAULT_WATCHER_POLL_INTERVAL):
+        self.on_change = on_change
+        self.mode = mode
+        self.debounce = max(0.0, debounce)
+        self.poll_interval = max(1.0, poll_interval)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._snapshot = get_interface_addresses()
+        self._last_event: Optional[float] = None
+
+    def start(self):
+        sock = None
+        if self.mode in ("auto", "netlink"):
+            sock = self._open_netlink()
+            if sock is None and self.mode == "netlink":
+                logger.warning("当前平台不支持rtnetlink，改为轮询网卡地址")
+        target = functools.partial(self._run_netlink, sock) if sock else self._run_poll
+        self._thread = threading.Thread(target=target, name="iface-watcher", daemon=True)
+        self._thread.start()
+        logger.info(f"网卡地址监听已启动 ({'rtnetlink' if sock else '轮询'}，去抖 {self.debounce} 秒)")
+
+    def stop(self):
+        self._stop.set()
+
+    @staticmethod
+    def _open_netlink():
+        if not hasattr(socket, "AF_NETLINK"):
+            return None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+            return sock
+        except OSError as e:
+            logger.warning(f"打开rtnetlink失败: {e}")
+            return None
+
+    def _mark_event(self):
+        if self._last_event is None:
+            logger.info("检测到网卡地址事件，等待去抖...")
+        self._last_event = time.monotonic()
+
+    def _settle(self) -> Optional[float]:
+        """去抖期结束时对比快照；返回距离去抖结束的剩余秒数（无待处理事件时返回None）"""
+        if self._last_event is None:
+            return None
+        remaining = self._last_event + self.debounce - time.monotonic()
+        if remaining > 0:
+            return remaining
+        self._last_event = None
+        self._check_snapshot()
+        return None
+
+    def _check_snapshot(self):
+        snapshot = get_interface_addresses()
+        if snapshot == self._snapshot:
+            return
+        added = sorted(snapshot - self._snapshot)
+        removed = sorted(self._snapshot - snapshot)
+        self._snapshot = snapshot
+        logger.info(f"网卡地址发生变化: 新增 {added or '无'}，移除 {removed or '无'}")
+        try:
+            self.on_change()
+        except Exception as e:
+            logger.error(f"处理网卡地址变化时发生错误: {e}")
+
+    def _run_netlink(self, sock):
+        with sock:
+            while not self._stop.is_set():
+                remaining = self._settle()
+                timeout = 1.0 if remaining is None else min(1.0, remaining)
+                readable, _, _ = select.select([sock], [], [], timeout)
+                if not readable:
+                    continue
+                data = sock.recv(65535)
+                offset = 0
+                # 逐条解析 nlmsghdr: 长度(4) 类型(2) 标志(2) 序号(4) 进程号(4)
+                while offset + 16 <= len(data):
+                    length, msg_type = struct.unpack_from("=IH", data, offset)
+                    if msg_type in (RTM_NEWADDR, RTM_DELADDR):
+                        self._mark_event()
+                    if length < 16:
+                        break
+                    offset += (length + 3) & ~3
+
+    def _run_poll(self):
+        while not self._stop.is_set():
+            remaining = self._settle()
+            if remaining is None and get_interface_addresses() != self._snapshot:
+                self._mark_event()
+                remaining = self.debounce
+            self._stop.wait(self.poll_interval if remaining is None else remaining)
 
 
 # 命令行输入处理器
 def command_input_handler():
     """命令行输入处理器线程"""
-    global running, manual_scan_requested
 
     cprint("\n" + "=" * 60, Colors.CYAN)
     cprint("DDNS更新服务已启动！", Colors.GREEN, bold=True)
@@ -142,6 +1462,7 @@ def command_input_handler():
     cprint("\n可用命令：", Colors.MAGENTA, bold=True)
     cprint("  start  - 立即执行一次新的扫描", Colors.WHITE)
     cprint("  status - 显示当前状态", Colors.WHITE)
+    cprint("  history [记录] [7d] - 查看运行历史", Colors.WHITE)
     cprint("  help   - 显示帮助信息", Colors.WHITE)
     cprint("  exit   - 退出程序", Colors.WHITE)
     cprint("  clear  - 清空屏幕", Colors.WHITE)
@@ -154,11 +1475,12 @@ def command_input_handler():
             prompt = f"{Colors.GREEN}DDNS>{Colors.RESET} "
             command = input(prompt).strip().lower()
 
-            if command == 'start':
+            if command == 'history' or command.startswith('history '):
+                show_history(command.split()[1:])
+
+            elif command == 'start':
                 cprint("正在启动新的扫描...", Colors.BLUE, bold=True)
-                logger.info("用户请求手动扫描")
-                with scan_lock:
-                    manual_scan_requested = True
+                request_manual_scan()
 
             elif command == 'status':
                 show_status()
@@ -168,7 +1490,7 @@ def command_input_handler():
 
             elif command == 'exit' or command == 'quit':
                 cprint("正在退出程序...", Colors.YELLOW, bold=True)
-                running = False
+                stop_service()
 
             elif command == 'clear':
                 os.system('cls' if os.name == 'nt' else 'clear')
@@ -178,15 +1500,35 @@ def command_input_handler():
                 cprint(f"未知命令: {command}", Colors.RED)
                 cprint("输入 'help' 查看可用命令", Colors.YELLOW)
 
-        except (KeyboardInterrupt, EOFError):
+        except EOFError:
+            # 没有终端（systemd/Docker）时标准输入立即关闭，只停止交互命令，服务继续运行
+            logger.info("标准输入已关闭，交互命令不可用，服务继续在后台运行")
+            break
+        except KeyboardInterrupt:
             cprint("\n接收到中断信号，正在退出...", Colors.YELLOW, bold=True)
-            running = False
+            stop_service()
             break
         except Exception as e:
             cprint(f"命令处理错误: {e}", Colors.RED)
             logger.error(f"命令处理错误: {e}")
 
 
+def get_service_status() -> Dict[str, Any]:
+    """服务状态（供控制接口使用）"""
+    return {
+        "running": running,
+        "pid": os.getpid(),
+        "time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "next_runs": {name: (t.strftime('%Y-%m-%d %H:%M:%S') if t else None)
+                      for name, t in scheduler.next_runs().items()},
+        "last_results": [{"record_id": r.get("record_id"), "record_name": r.get("record_name"),
+                          "record_ip": r.get("record_ip"), "status": _result_status(r),
+                          "error": r.get("error")} for r in last_results],
+        "rate_limit": rate_limiters.stats(),
+        "coordination": _coordinator.status() if _coordinator is not None else None,
+    }
+
+
 def show_status():
     """显示当前状态"""
     global running
@@ -197,13 +1539,15 @@ def show_status():
     cprint(f"当前时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", Colors.WHITE)
     cprint(f"进程ID: {os.getpid()}", Colors.WHITE)
 
-    # 计算下一个整点执行时间
+    # 各调度任务的下次执行时间
     now = datetime.now()
-    next_hour = (now + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
-    wait_seconds = (next_hour - now).total_seconds()
-    cprint(f"下次执行: {next_hour.strftime('%Y-%m-%d %H:%M:%S')}", Colors.YELLOW)
-    cprint(f"剩余时间: {int(wait_seconds // 3600)}小时{int((wait_seconds % 3600) // 60)}分钟{int(wait_seconds % 60)}秒",
-           Colors.YELLOW)
+    for name, next_run in scheduler.next_runs().items():
+        if next_run is None:
+            continue
+        wait_seconds = max(0.0, (next_run - now).total_seconds())
+        cprint(f"下次执行[{name}]: {next_run.strftime('%Y-%m-%d %H:%M:%S')} "
+               f"(剩余 {int(wait_seconds // 3600)}小时{int((wait_seconds % 3600) // 60)}分钟"
+               f"{int(wait_seconds % 60)}秒)", Colors.YELLOW)
     cprint("=" * 40, Colors.MAGENTA)
 
 
@@ -215,11 +1559,13 @@ def show_help():
     cprint("命令说明：", Colors.MAGENTA, bold=True)
     cprint(f"  {Colors.GREEN}start{Colors.RESET}  - 立即执行一次DDNS扫描和更新", Colors.WHITE)
     cprint(f"  {Colors.GREEN}status{Colors.RESET} - 显示服务状态和下次执行时间", Colors.WHITE)
+    cprint(f"  {Colors.GREEN}history{Colors.RESET} [记录ID或名称] [时间范围] - 查看运行历史，如 history 123 30d",
+           Colors.WHITE)
     cprint(f"  {Colors.GREEN}help{Colors.RESET}  - 显示此帮助信息", Colors.WHITE)
     cprint(f"  {Colors.GREEN}exit{Colors.RESET}  - 退出程序 (或使用 Ctrl+C)", Colors.WHITE)
     cprint(f"  {Colors.GREEN}clear{Colors.RESET} - 清空屏幕", Colors.WHITE)
     cprint("\n定时执行：", Colors.MAGENTA, bold=True)
-    cprint("  程序会在每小时整点自动执行DDNS更新", Colors.WHITE)
+    cprint("  程序默认在每小时整点自动执行DDNS更新（可通过 schedule 配置调整）", Colors.WHITE)
     cprint("  启动时会立即执行第一次更新", Colors.WHITE)
     cprint("  使用 'start' 命令可随时手动触发更新", Colors.WHITE)
     cprint("\n日志文件：", Colors.MAGENTA, bold=True)
@@ -227,82 +1573,325 @@ def show_help():
     cprint("=" * 50, Colors.CYAN)
 
 
+def start_interface_watcher() -> Optional[InterfaceWatcher]:
+    """按配置启动网卡地址监听，地址变化时立即触发一次扫描"""
+    try:
+        watcher_cfg = load_config().get("watcher") or {}
+    except Exception:
+        return None
+    if not watcher_cfg.get("enabled"):
+        return None
+    watcher = InterfaceWatcher(
+        on_change=lambda: request_manual_scan("网卡地址变化，触发DDNS更新"),
+        mode=watcher_cfg.get("mode", "auto"),
+        debounce=float(watcher_cfg.get("debounce", DEFAULT_WATCHER_DEBOUNCE)),
+        poll_interval=float(watcher_cfg.get("poll_interval", DEFAULT_WATCHER_POLL_INTERVAL)),
+    )
+    watcher.start()
+    return watcher
+
+
+def run_manual_scan():
+    """手动触发的扫描任务"""
+    cprint("\n" + "=" * 60, Colors.YELLOW)
+    cprint("执行手动扫描...", Colors.BLUE, bold=True)
+    logger.info("开始执行手动扫描")
+    run_ddns_update()
+    cprint("手动扫描完成!", Colors.GREEN, bold=True)
+    cprint("=" * 60, Colors.YELLOW)
+    log_next_runs()
+
+
+def run_scheduled_scan(job_name: str, record_ids: Optional[List[Any]] = None):
+    """定时触发的扫描任务"""
+    logger.info(f"定时执行DDNS更新[{job_name}]: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    cprint(f"\n[{datetime.now().strftime('%H:%M:%S')}] 执行定时DDNS更新[{job_name}]...",
+           Colors.CYAN, bold=True)
+    run_ddns_update(record_ids=record_ids)
+    log_next_runs()
+
+
+def setup_schedule(target: Scheduler, config: Dict[str, Any], reset: bool = True):
+    """
+    根据配置注册调度任务
+
+    全局 schedule 配置（默认每小时整点）负责未单独配置计划的记录；
+    记录上配置了 cron 或 interval 的，使用各自独立的任务。
+    reset=False 时（配置重新加载）保留尚未执行的触发，只替换任务并删除不再需要的任务。
+    """
+    previous = set(target.job_names())
+    if reset:
+        target.clear()
+    schedule_cfg = config.get("schedule") or {}
+    default_jitter = float(schedule_cfg.get("jitter", 0))
+
+    own_schedule = []
+    for record in get_configured_records(config):
+        if record.get("cron") or record.get("interval"):
+            key = record_key(record)
+            own_schedule.append(key)
+            target.add_job(
+                f"record-{key}",
+                functools.partial(run_scheduled_scan, f"record-{key}", [key]),
+                interval=float(record["interval"]) if record.get("interval") else None,
+                cron=record.get("cron"),
+                jitter=float(record.get("jitter", default_jitter)),
+            )
+
+    default_ids = None
+    if own_schedule:
+        default_ids = [record_key(r) for r in get_configured_records(config)
+                       if record_key(r) not in own_schedule]
+    if default_ids is None or default_ids:
+        interval = schedule_cfg.get("interval")
+        target.add_job(
+            DEFAULT_JOB,
+            functools.partial(run_scheduled_scan, DEFAULT_JOB, default_ids),
+            interval=float(interval) if interval else None,
+            cron=None if interval else schedule_cfg.get("cron", DEFAULT_SCHEDULE_CRON),
+            jitter=default_jitter,
+        )
+
+    target.add_job(MANUAL_JOB, run_manual_scan)
+    if not reset:
+        current = {DEFAULT_JOB, MANUAL_JOB} | {f"record-{key}" for key in own_schedule}
+        for name in previous - current:
+            target.remove_job(name)
+
+
+def _reload_schedule(change: ConfigChange):
+    """记录列表或执行计划变化：重建调度任务"""
+    old_keys = {record_key(r) for r in get_configured_records(change.old)}
+    new_keys = {record_key(r) for r in get_configured_records(change.new)}
+    if old_keys != new_keys:
+        logger.info(f"记录列表已变化: 新增 {sorted(new_keys - old_keys) or '无'}，"
+                    f"删除 {sorted(old_keys - new_keys) or '无'}")
+    setup_schedule(scheduler, change.new, reset=False)
+    log_next_runs()
+
+
+def _reload_clients(change: ConfigChange):
+    """凭证或账号变化：释放已删除账号的客户端（凭证变化的客户端在下次使用时按指纹重建）"""
+    client_registry.retain(set(get_accounts(change.new)) or {"default"})
+
+
+def _reload_limits(change: ConfigChange):
+    """重试/熔断与限流参数变化：立即生效"""
+    get_resilience(change.new)
+    rate_limiters.configure(fleet_rate_limit(change.new) if change.new.get("accounts")
+                            else change.new.get("rate_limit"))
+
+
+def _reload_logging(change: ConfigChange):
+    setup_logging(change.new.get("logging"))
+
+
+def _reload_requires_restart(change: ConfigChange):
+    sections = sorted(change.sections & {"watcher", "metrics", "control", "config_reload", "profiling"})
+    logger.warning(f"配置段 {', '.join(sections)} 的修改需要重启服务后生效")
+
+
+def watch_config(config: Dict[str, Any]) -> ConfigManager:
+    """注册各依赖方并启动配置文件监视（config_reload.enabled 默认开启）"""
+    manager = get_config_manager()
+    manager.subscribe(_reload_schedule, ("schedule", "records", "record_id", "accounts"))
+    manager.subscribe(_reload_clients, ("aliyun", "accounts"))
+    manager.subscribe(_reload_limits, ("resilience", "rate_limit", "accounts"))
+    manager.subscribe(_reload_logging, ("logging",))
+    manager.subscribe(_reload_requires_restart, ("watcher", "metrics", "control", "config_reload", "profiling"))
+    reload_cfg = config.get("config_reload") or {}
+    if reload_cfg.get("enabled", True):
+        manager.poll_interval = float(reload_cfg.get("poll_interval", DEFAULT_CONFIG_POLL_INTERVAL))
+        manager.start()
+    return manager
+
+
+def log_next_runs():
+    """输出下次定时执行时间"""
+    upcoming = [(name, t) for name, t in scheduler.next_runs().items() if t is not None]
+    if not upcoming:
+        return
+    name, next_run = min(upcoming, key=lambda item: item[1])
+    wait_seconds = max(0.0, (next_run - datetime.now()).total_seconds())
+    logger.info(f"下次执行时间[{name}]: {next_run.strftime('%Y-%m-%d %H:%M:%S')}")
+    logger.info(f"等待 {wait_seconds:.1f} 秒 ({wait_seconds / 3600:.2f} 小时)")
+    cprint(f"\n下次定时执行[{name}]: {next_run.strftime('%Y-%m-%d %H:%M:%S')}",
+           Colors.MAGENTA, bold=True)
+    cprint(f"等待时间: {wait_seconds / 3600:.2f} 小时", Colors.CYAN)
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="阿里云 ESA DDNS 自动更新服务")
+    parser.add_argument("--daemon", action="store_true",
+                        help="后台模式：不启动交互命令行，通过控制接口管理")
+    parser.add_argument("--once", action="store_true",
+                        help="单次模式：检查并更新一次后退出，退出码表示结果")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="配合 --once 使用，只检查不更新")
+    parser.add_argument("--profile", type=int, metavar="N",
+                        help="用 cProfile 分析接下来 N 个更新周期，输出 pstats 与折叠调用栈")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="将各阶段与 ESA 调用的 span 以 OTLP/JSON 格式追加写入 FILE")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="每个更新周期结束后比较 tracemalloc 快照，记录内存增长")
+    subparsers = parser.add_subparsers(dest="command")
+
+    ctl = subparsers.add_parser("ctl", help="通过控制接口操作运行中的服务")
+    ctl.add_argument("action", choices=["status", "results", "history", "trigger", "exit"])
+    ctl.add_argument("--record", action="append", help="只处理指定记录ID（可重复）；history 时为要查询的记录")
+    ctl.add_argument("--since", help="history: 起始时间，如 7d、2024-05-01")
+    ctl.add_argument("--until", help="history: 结束时间")
+    ctl.add_argument("--limit", type=int, help="history: 最多返回的条数")
+    ctl.add_argument("--dry-run", action="store_true", help="只检查不更新")
+    ctl.add_argument("--wait", action="store_true", help="等待更新完成并输出结果")
+    ctl.add_argument("--socket", help="控制接口的Unix套接字路径")
+    ctl.add_argument("--host", help="控制接口地址")
+    ctl.add_argument("--port", type=int, help="控制接口端口")
+    ctl.add_argument("--token", help="控制接口访问令牌")
+    return parser.parse_args(argv)
+
+
+# --once 模式的退出码
+EXIT_OK = 0
+EXIT_ERROR = 1           # 配置错误等，未能执行检查
+EXIT_IP_LOOKUP = 2       # 无法获取本机公网IP
+EXIT_RECORD_FAILED = 3   # 部分记录查询或更新失败
+
+
+def once_exit_code(results: List[Dict[str, Any]]) -> int:
+    """根据单次运行的结果计算退出码"""
+    if not results:
+        return EXIT_ERROR
+    failed = [r for r in results if "error" in r]
+    if not failed:
+        return EXIT_OK
+    if all(r.get("error_code") == "IPLookupFailed" for r in results):
+        return EXIT_IP_LOOKUP
+    return EXIT_RECORD_FAILED
+
+
+def run_once(auto_update: bool = True) -> int:
+    """
+    单次模式：执行一次检查后返回退出码
+
+    不启动命令行、调度器、网卡监听与本地服务；状态缓存命中时整个过程不会加载ESA SDK。
+    """
+    started = time.perf_counter()
+    # 没有调度器可以延迟重扫，稳定窗口在本次运行中等待
+    _write_coalescer.mode = "once"
+    results = run_ddns_update(auto_update=auto_update)
+    shutdown_fleet_pool()
+    release_leases()
+    shutdown_instrumentation()
+    finished = time.perf_counter()
+    code = once_exit_code(results)
+
+    sdk_loaded = "alibabacloud_esa20240910.client" in sys.modules
+    timing = (f"启动 {(started - _module_load_started) * 1000:.0f} ms，"
+              f"检查 {(finished - started) * 1000:.0f} ms，"
+              f"总计 {(finished - _module_load_started) * 1000:.0f} ms"
+              f"（ESA SDK {'已加载' if sdk_loaded else '未加载'}）")
+    cprint(f"耗时: {timing}，退出码 {code}", Colors.CYAN)
+    logger.info(f"单次运行完成，耗时: {timing}，退出码 {code}")
+    return code
+
+
 # 修改主函数
-def main():
-    global running, manual_scan_requested
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    if args.command == "ctl":
+        sys.exit(run_control_client(args))
+
+    # 日志按配置初始化（轮转、JSON格式等）
+    try:
+        config = load_config()
+    except Exception as e:
+        setup_logging()
+        cprint(f"加载配置文件失败: {e}", Colors.RED, bold=True)
+        sys.exit(EXIT_ERROR)
+    setup_logging(config.get("logging"))
+    setup_instrumentation(config, args)
+
+    if args.once:
+        sys.exit(run_once(auto_update=not args.dry_run))
 
     # 设置信号处理器
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    # 启动命令行输入线程
-    input_thread = threading.Thread(target=command_input_handler, daemon=True)
-    input_thread.start()
+    # 启动命令行输入线程（后台模式下不启动）
+    if not args.daemon:
+        input_thread = threading.Thread(target=command_input_handler, daemon=True)
+        input_thread.start()
+
+    # 启动网卡地址监听（整点定时执行仍作为兜底）
+    watcher = start_interface_watcher()
+
+    # 启动本地指标服务与控制接口
+    metrics_server = start_metrics_server(config)
+    control_server = start_control_server(config)
+
+    # 配置调度任务，并监视配置文件的修改
+    setup_schedule(scheduler, config)
+    config_manager = watch_config(config)
 
     # 第一次启动时立即执行一次
     logger.info("第一次启动，立即执行DDNS更新...")
     cprint("\n正在执行首次DDNS更新...", Colors.BLUE, bold=True)
     run_ddns_update()
+    log_next_runs()
 
-    # 计算到下一个整点的等待时间
-    wait_seconds = wait_until_next_hour()
-
-    # 主循环
-    while running:
-        try:
-            # 检查是否需要手动扫描
-            with scan_lock:
-                if manual_scan_requested:
-                    cprint("\n" + "=" * 60, Colors.YELLOW)
-                    cprint("执行手动扫描...", Colors.BLUE, bold=True)
-                    logger.info("开始执行手动扫描")
-                    run_ddns_update()
-                    cprint("手动扫描完成!", Colors.GREEN, bold=True)
-                    cprint("=" * 60, Colors.YELLOW)
-                    manual_scan_requested = False
-
-            # 分段等待，以便能够响应退出信号和命令
-            for _ in range(int(wait_seconds)):
-                if not running:
-                    break
-                time.sleep(1)
-
-                # 每秒检查一次手动扫描请求
-                with scan_lock:
-                    if manual_scan_requested:
-                        break
-
-            if not running:
-                break
-
-            # 执行定时DDNS更新
-            logger.info(f"整点执行DDNS更新: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            cprint(f"\n[{datetime.now().strftime('%H:%M:%S')}] 执行定时DDNS更新...",
-                   Colors.CYAN, bold=True)
-            run_ddns_update()
-
-            # 计算下一个整点的等待时间
-            wait_seconds = wait_until_next_hour()
-
-        except KeyboardInterrupt:
-            cprint("\n接收到中断信号，正在退出...", Colors.YELLOW, bold=True)
-            break
-        except Exception as e:
-            logger.error(f"主循环中发生错误: {e}")
-            cprint(f"错误: {e}", Colors.RED)
-            # 出错后等待5分钟再重试
-            time.sleep(300)
-
+    # 主循环：调度器在没有任务到期时一直睡眠，手动触发会立即唤醒
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        cprint("\n接收到中断信号，正在退出...", Colors.YELLOW, bold=True)
+
+    if watcher is not None:
+        watcher.stop()
+    config_manager.stop()
+    shutdown_fleet_pool()
+    release_leases()
+    shutdown_instrumentation()
+    for server in (metrics_server, control_server):
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            if isinstance(server.server_address, str) and os.path.exists(server.server_address):
+                os.unlink(server.server_address)
     cprint("\nDDNS更新服务已停止", Colors.YELLOW, bold=True)
     logger.info("DDNS更新服务已停止")
 
 
 # 修改check_and_update_ip函数，添加颜色输出
 def check_and_update_ip(record_id: int, new_ip: Optional[str] = None,
-                        auto_update: bool = True) -> Dict[str, Any]:
+                        auto_update: bool = True,
+                        config: Optional[Dict[str, Any]] = None,
+                        verbose: bool = True,
+                        record_info: Optional[RecordInfo] = None) -> Dict[str, Any]:
     """
     检查并更新IP地址，如果IP不同则更新最新的IP
+
+    check_and_update_ip_async 的同步封装，在新的事件循环中执行（不能在事件循环内调用）。
+    """
+    return asyncio.run(check_and_update_ip_async(record_id, new_ip=new_ip, auto_update=auto_update,
+                                                 config=config, verbose=verbose, record_info=record_info))
+
+
+async def check_and_update_ip_async(record_id: int, new_ip: Optional[str] = None,
+                                    auto_update: bool = True,
+                                    config: Optional[Dict[str, Any]] = None,
+                                    verbose: bool = True,
+                                    record_info: Union[RecordInfo, Dict[str, Any], None] = None) -> Dict[str, Any]:
     """
+    检查并更新IP地址，如果IP不同则更新最新的IP（协程）
+
+    config 为本周期已解析的配置，查询与更新共用同一个ESA客户端，每次ESA请求的超时为 batch.call_timeout。
+    verbose=False 时只写日志不输出彩色终端信息（批量并发执行时使用）。
+    record_info 为已通过批量列表接口取得的记录信息，提供时不再调用 GetRecord。
+    """
+    say = cprint if verbose else _silent_print
     result = {
         "record_id": record_id,
         "local_ip": "",
@@ -312,55 +1901,69 @@ def check_and_update_ip(record_id: int, new_ip: Optional[str] = None,
         "update_result": None
     }
 
-    cprint("\n" + "=" * 60, Colors.BLUE)
-    cprint(f"开始检查并更新IP地址 - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-           Colors.GREEN, bold=True)
+    say("\n" + "=" * 60, Colors.BLUE)
+    say(f"开始检查并更新IP地址 - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+        Colors.GREEN, bold=True)
     logger.info("=" * 60)
     logger.info(f"开始检查并更新IP地址 - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
     # 1. 获取当前IP
     if new_ip:
         local_ip = new_ip
-        cprint(f"使用指定的IP: {local_ip}", Colors.CYAN)
+        say(f"使用指定的IP: {local_ip}", Colors.CYAN)
         logger.info(f"使用指定的IP: {local_ip}")
     else:
-        cprint("1. 正在获取本机公网IP...", Colors.WHITE)
+        say("1. 正在获取本机公网IP...", Colors.WHITE)
         logger.info("1. 正在获取本机公网IP...")
-        local_ip = get_local_ip()
+        # 已知记录为AAAA时获取IPv6地址
+        family = ip_family(record_info.value) if isinstance(record_info, RecordInfo) else None
+        with metrics_stage("ip_lookup"):
+            local_ip = await get_local_ip_async(config, family)
         if not local_ip:
-            cprint("错误: 无法获取本机IP地址", Colors.RED, bold=True)
+            say("错误: 无法获取本机IP地址", Colors.RED, bold=True)
             logger.error("错误: 无法获取本机IP地址")
-            return {**result, "error": "无法获取本机IP地址"}
-        cprint(f"   本机公网IP: {Colors.GREEN}{local_ip}{Colors.RESET}", Colors.WHITE, bold=True)
+            return {**result, "error": "无法获取本机IP地址", "error_code": "IPLookupFailed"}
+        say(f"   本机公网IP: {Colors.GREEN}{local_ip}{Colors.RESET}", Colors.WHITE, bold=True)
         logger.info(f"   本机公网IP: {local_ip}")
 
     result["local_ip"] = local_ip
 
+    # 本地状态缓存命中（IP未变化且未超过重新校验时间）时不访问ESA
+    state_cache = get_state_cache(config)
+    if state_cache is not None:
+        cached = state_cache.lookup(record_id, local_ip)
+        if cached is not None:
+            say(f"2. 本地缓存命中，记录值仍为 {local_ip}，跳过ESA查询", Colors.GREEN)
+            logger.info(f"2. 本地缓存命中，记录值仍为 {local_ip}，跳过ESA查询 "
+                        f"(确认于 {datetime.fromtimestamp(cached['confirmed_at']).strftime('%Y-%m-%d %H:%M:%S')})")
+            return {**result, "record_ip": local_ip, "record_name": cached.get("record_name", "未知"),
+                    "cache_hit": True}
+
     # 2. 获取阿里云ESA中的记录值
-    cprint("2. 正在查询阿里云ESA记录...", Colors.WHITE)
+    say("2. 正在查询阿里云ESA记录...", Colors.WHITE)
     logger.info("2. 正在查询阿里云ESA记录...")
 
     try:
-        record_info = get_domain_record(record_id)
+        client = create_client(config)
+        call_timeout = esa_call_timeout(config)
+        if record_info is None:
+            with metrics_stage("get_record"):
+                record_info = await get_domain_record_async(record_id, client=client, timeout=call_timeout)
+        else:
+            logger.info("   使用批量列表中的记录信息，跳过 GetRecord")
 
-        if "error" in record_info:
-            cprint(f"错误: 获取记录信息失败 - {record_info['error']}", Colors.RED, bold=True)
+        if not isinstance(record_info, RecordInfo):
+            say(f"错误: 获取记录信息失败 - {record_info['error']}", Colors.RED, bold=True)
             logger.error(f"错误: 获取记录信息失败 - {record_info['error']}")
-            return {**result, "error": f"获取记录信息失败: {record_info['error']}"}
+            return {**result, "error": f"获取记录信息失败: {record_info['error']}",
+                    "error_code": record_info.get("error_code", "Unknown")}
 
-        # 从记录信息中提取IP地址
-        record_data = record_info.get("Data", {})
-        if isinstance(record_data, dict):
-            record_ip = record_data.get("Value", "")
-        else:
-            record_ip = str(record_info.get("Data", ""))
-
-        record_name = record_info.get("RecordName", "未知")
-        record_priority = record_data.get("priority", 10) if isinstance(record_data, dict) else 10
+        record_ip = record_info.value
+        record_name = record_info.name or "未知"
 
-        cprint(f"   记录名称: {Colors.CYAN}{record_name}{Colors.RESET}", Colors.WHITE)
-        cprint(f"   记录ID: {Colors.CYAN}{record_id}{Colors.RESET}", Colors.WHITE)
-        cprint(f"   记录值(IP): {Colors.CYAN}{record_ip if record_ip else '空'}{Colors.RESET}", Colors.WHITE)
+        say(f"   记录名称: {Colors.CYAN}{record_name}{Colors.RESET}", Colors.WHITE)
+        say(f"   记录ID: {Colors.CYAN}{record_id}{Colors.RESET}", Colors.WHITE)
+        say(f"   记录值(IP): {Colors.CYAN}{record_ip if record_ip else '空'}{Colors.RESET}", Colors.WHITE)
 
         logger.info(f"   记录名称: {record_name}")
         logger.info(f"   记录ID: {record_id}")
@@ -368,332 +1971,3487 @@ def check_and_update_ip(record_id: int, new_ip: Optional[str] = None,
 
         result["record_ip"] = record_ip
         result["record_name"] = record_name
-        result["record_priority"] = record_priority
+        result["record"] = record_info
 
         # 3. 比较IP地址
-        cprint("3. 比较IP地址...", Colors.WHITE)
+        say("3. 比较IP地址...", Colors.WHITE)
         logger.info("3. 比较IP地址...")
+        compare_started = time.perf_counter()
 
         if not record_ip:
-            cprint("   警告: 记录中的IP地址为空", Colors.YELLOW)
+            say("   警告: 记录中的IP地址为空", Colors.YELLOW)
             logger.warning("警告: 记录中的IP地址为空")
             ip_changed = True
         elif local_ip == record_ip:
-            cprint(f"   结果: {Colors.GREEN}IP地址相同{Colors.RESET}", Colors.WHITE)
-            cprint(f"   本机IP: {Colors.GREEN}{local_ip}{Colors.RESET}", Colors.WHITE)
-            cprint(f"   记录IP: {Colors.GREEN}{record_ip}{Colors.RESET}", Colors.WHITE)
+            say(f"   结果: {Colors.GREEN}IP地址相同{Colors.RESET}", Colors.WHITE)
+            say(f"   本机IP: {Colors.GREEN}{local_ip}{Colors.RESET}", Colors.WHITE)
+            say(f"   记录IP: {Colors.GREEN}{record_ip}{Colors.RESET}", Colors.WHITE)
             logger.info(f"   结果: IP地址相同")
             logger.info(f"   本机IP: {local_ip}")
             logger.info(f"   记录IP: {record_ip}")
             ip_changed = False
         else:
-            cprint(f"   结果: {Colors.YELLOW}IP地址不同!{Colors.RESET}", Colors.WHITE, bold=True)
-            cprint(f"   本机IP: {Colors.GREEN}{local_ip}{Colors.RESET}", Colors.WHITE)
-            cprint(f"   记录IP: {Colors.RED}{record_ip}{Colors.RESET}", Colors.WHITE)
+            say(f"   结果: {Colors.YELLOW}IP地址不同!{Colors.RESET}", Colors.WHITE, bold=True)
+            say(f"   本机IP: {Colors.GREEN}{local_ip}{Colors.RESET}", Colors.WHITE)
+            say(f"   记录IP: {Colors.RED}{record_ip}{Colors.RESET}", Colors.WHITE)
             logger.info(f"   结果: IP地址不同!")
             logger.info(f"   本机IP: {local_ip}")
             logger.info(f"   记录IP: {record_ip}")
             ip_changed = True
 
         result["ip_changed"] = ip_changed
+        observe_stage("compare", time.perf_counter() - compare_started)
+        if state_cache is not None and not ip_changed:
+            state_cache.confirm(record_id, record_ip, record_info.request_id, record_name)
 
         # 4. 如果IP不同且允许自动更新，则更新记录
+        coalescer = get_write_coalescer(config)
+        if not ip_changed:
+            coalescer.clear(record_id)
+        elif auto_update and not await coalescer.wait_stable(record_id, local_ip, config):
+            # 新IP尚未稳定（或已经变回去），本次不写入
+            say("4. 新IP尚未稳定，暂不更新", Colors.YELLOW)
+            logger.info("4. 新IP尚未稳定，暂不更新")
+            if coalescer.mode == "worker":
+                return {**result, "deferred": True, "candidate": coalescer.candidate(record_id)}
+            return {**result, "deferred": True}
+
         if ip_changed and auto_update:
-            cprint("4. 正在更新记录到最新IP...", Colors.WHITE)
+            say("4. 正在更新记录到最新IP...", Colors.WHITE)
             logger.info("4. 正在更新记录到最新IP...")
 
-            # 获取原记录的其他设置
-            proxied = record_info.get("Proxied", False)
-            ttl = record_info.get("Ttl", 1)
-            record_type = record_info.get("Type", "A/AAAA")
-
-            update_result = update_domain_record(
-                record_id=record_id,
-                new_ip=local_ip,
-                priority=record_priority,
-                proxied=proxied,
-                ttl=ttl,
-                record_type=record_type
-            )
+            async def _write() -> Dict[str, Any]:
+                # 多实例部署时只有仍持有租约的实例可以写入
+                coordinator = get_coordinator(config)
+                if coordinator is not None and not await asyncio.to_thread(coordinator.fenced, record_id):
+                    return {"success": False, "error": "本实例未持有该记录的租约，跳过写入",
+                            "error_code": "LeaseLost"}
+                with metrics_stage("update_record"):
+                    return await update_domain_record_async(
+                        record_id=record_id,
+                        new_ip=local_ip,
+                        # 保留原记录的其他设置
+                        priority=record_info.priority if record_info.priority is not None else 10,
+                        proxied=record_info.proxied,
+                        ttl=record_info.ttl,
+                        record_type=record_info.type,
+                        client=client,
+                        timeout=call_timeout
+                    )
+
+            update_result, coalesced = await coalescer.write(record_id, local_ip, _write)
 
             result["update_performed"] = True
             result["update_result"] = update_result
+            if coalesced:
+                result["coalesced"] = True
+                say("   已有相同目标的写入正在进行，复用其结果", Colors.CYAN)
+                logger.info("   已有相同目标的写入正在进行，复用其结果")
 
             if update_result.get("success"):
-                cprint(f"   记录已成功更新到: {Colors.GREEN}{local_ip}{Colors.RESET}",
-                       Colors.WHITE, bold=True)
+                say(f"   记录已成功更新到: {Colors.GREEN}{local_ip}{Colors.RESET}",
+                    Colors.WHITE, bold=True)
                 logger.info(f"   记录已成功更新到: {local_ip}")
+                if state_cache is not None:
+                    state_cache.confirm(record_id, local_ip, update_result.get("request_id"), record_name)
             else:
-                cprint(f"   记录更新失败: {update_result.get('error', '未知错误')}",
-                       Colors.RED, bold=True)
+                if state_cache is not None:
+                    state_cache.invalidate(record_id)
+                say(f"   记录更新失败: {update_result.get('error', '未知错误')}",
+                    Colors.RED, bold=True)
                 logger.error(f"   记录更新失败: {update_result.get('error', '未知错误')}")
         elif ip_changed and not auto_update:
-            cprint("4. IP地址不同，但auto_update=False，跳过更新", Colors.YELLOW)
+            say("4. IP地址不同，但auto_update=False，跳过更新", Colors.YELLOW)
             logger.info("4. IP地址不同，但auto_update=False，跳过更新")
         else:
-            cprint("4. IP地址相同，无需更新", Colors.GREEN)
+            say("4. IP地址相同，无需更新", Colors.GREEN)
             logger.info("4. IP地址相同，无需更新")
 
     except Exception as e:
-        cprint(f"错误: 比较IP地址时发生错误 - {e}", Colors.RED, bold=True)
+        say(f"错误: 比较IP地址时发生错误 - {e}", Colors.RED, bold=True)
         logger.error(f"错误: 比较IP地址时发生错误 - {e}")
         import traceback
         traceback.print_exc()
-        return {**result, "error": str(e)}
+        return {**result, "error": str(e), "error_code": get_error_code(e)}
 
     logger.info("=" * 60)
     logger.info("检查完成")
-    cprint("\n" + "=" * 60, Colors.BLUE)
-    cprint("检查完成", Colors.GREEN, bold=True)
+    say("\n" + "=" * 60, Colors.BLUE)
+    say("检查完成", Colors.GREEN, bold=True)
 
     return result
 
 
-# 修改run_ddns_update函数，添加颜色输出
-def run_ddns_update():
-    """执行DDNS更新任务"""
-    try:
-        config = load_config()
-        # 从配置中获取record_id
-        record_id = config.get("record_id", 3942378189367488)
-
-        # 如果需要从aliyun部分获取
-        if "aliyun" in config and "record_id" in config["aliyun"]:
-            record_id = config["aliyun"]["record_id"]
-
-        # 执行DDNS更新
-        result = check_and_update_ip(record_id)
-
-        # 记录结果
-        cprint("\n" + "=" * 60, Colors.MAGENTA)
-        cprint("结果摘要:", Colors.CYAN, bold=True)
-        cprint("=" * 60, Colors.MAGENTA)
+def _silent_print(*args, **kwargs):
+    """静默输出（替代cprint）"""
 
-        status_color = Colors.GREEN if not result.get('error') else Colors.RED
-        cprint(f"记录ID: {result.get('record_id')}", Colors.WHITE)
-        cprint(f"本机IP: {result.get('local_ip')}", Colors.WHITE)
-        cprint(f"记录IP: {result.get('record_ip')}", Colors.WHITE)
 
-        if result.get('ip_changed'):
-            ip_status = f"{Colors.YELLOW}是{Colors.RESET}"
-        else:
-            ip_status = f"{Colors.GREEN}否{Colors.RESET}"
-        cprint(f"IP是否变化: {ip_status}", Colors.WHITE)
+def get_configured_records(config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    从配置中读取需要更新的记录列表
 
-        if result.get('update_performed'):
-            update_status = f"{Colors.YELLOW}是{Colors.RESET}"
-        else:
-            update_status = f"{Colors.CYAN}否{Colors.RESET}"
-        cprint(f"是否执行更新: {update_status}", Colors.WHITE)
+    优先使用 records 列表，每一项可以是记录ID，或包含 record_id 的字典，
+    或按站点与主机名配置的字典（site_id/site + name，可选 type），名称在更新前解析为记录ID；
+    未配置 records 时兼容旧的单个 record_id 配置。
+    """
+    if config.get("accounts"):
+        # 多账号模式：各账号的记录带上所属账号名
+        result = []
+        for name, account in get_accounts(config).items():
+            for item in account.get("records") or []:
+                record = dict(item) if isinstance(item, dict) else {"record_id": item}
+                record["account"] = name
+                result.append(record)
+        return result
 
-        if result.get('update_result'):
-            if result['update_result'].get('success'):
-                update_result = f"{Colors.GREEN}成功{Colors.RESET}"
+    records = config.get("records")
+    if records:
+        result = []
+        for item in records:
+            if isinstance(item, dict):
+                result.append(dict(item))
             else:
-                update_result = f"{Colors.RED}失败{Colors.RESET}"
-            cprint(f"更新结果: {update_result}", Colors.WHITE)
-
-        if result.get('error'):
-            cprint(f"错误信息: {result['error']}", Colors.RED)
-        cprint("=" * 60, Colors.MAGENTA)
+                result.append({"record_id": item})
+        return result
 
-        # 同时记录到日志
-        logger.info("=" * 60)
-        logger.info("结果摘要:")
-        logger.info(f"记录ID: {result.get('record_id')}")
-        logger.info(f"本机IP: {result.get('local_ip')}")
-        logger.info(f"记录IP: {result.get('record_ip')}")
-        logger.info(f"IP是否变化: {'是' if result.get('ip_changed') else '否'}")
-        logger.info(f"是否执行更新: {'是' if result.get('update_performed') else '否'}")
+    # 兼容旧配置：顶层或 aliyun 部分的 record_id
+    record_id = (config.get("aliyun") or {}).get("record_id") or config.get("record_id")
+    if record_id is None:
+        logger.error("配置文件中没有需要更新的记录，请配置 records")
+        return []
+    return [{"record_id": record_id}]
 
-        if result.get('update_result'):
-            logger.info(f"更新结果: {'成功' if result['update_result'].get('success') else '失败'}")
 
-        if result.get('error'):
-            logger.error(f"错误信息: {result['error']}")
-        logger.info("=" * 60)
+def record_key(record: Dict[str, Any]) -> str:
+    """记录在调度与筛选中使用的标识：记录ID，按名称配置且尚未解析时为主机名"""
+    return str(record.get("record_id") or record.get("name"))
 
-    except Exception as e:
-        cprint(f"执行DDNS更新时发生错误: {e}", Colors.RED, bold=True)
-        logger.error(f"执行DDNS更新时发生错误: {e}")
 
+def record_family(record: Dict[str, Any]) -> Optional[int]:
+    """根据记录配置的 type（A/AAAA）判断协议族，未配置时返回None"""
+    record_type = str(record.get("type", "")).upper()
+    for family, name in IP_FAMILY_RECORD_TYPES.items():
+        if record_type == name:
+            return family
+    return None
 
-# 保留原有函数（未修改部分保持不变）
-def load_config(config_path: str = "config.yml") -> Dict[str, Any]:
-    """加载配置文件"""
-    try:
-        with open(config_path, "r", encoding="utf-8") as f:
-            return yaml.safe_load(f)
-    except Exception as e:
-        logger.error(f"加载配置文件失败: {e}")
-        raise
 
+def lookup_local_ips(config: Dict[str, Any]) -> Dict[int, str]:
+    """获取本周期使用的公网IP：双栈模式下为 {4: ..., 6: ...}，否则为 {4: ...}"""
+    return asyncio.run(lookup_local_ips_async(config))
 
-def create_client() -> ESA20240910Client:
-    """创建阿里云ESA客户端"""
-    cfg = load_config()
 
-    cred_cfg = CredConfig(
-        type="access_key",
-        access_key_id=cfg["aliyun"]["access_key_id"],
-        access_key_secret=cfg["aliyun"]["access_key_secret"]
-    )
-    cred_client = CredClient(cred_cfg)
+async def lookup_local_ips_async(config: Dict[str, Any]) -> Dict[int, str]:
+    """lookup_local_ips 的协程版本"""
+    dual_stack = bool((config.get("dual_stack") or {}).get("enabled"))
+    logger.info("正在获取本机公网IP" + ("（IPv4/IPv6）..." if dual_stack else "..."))
+    with metrics_stage("ip_lookup"):
+        return await get_local_ips_async(config) if dual_stack else {4: await get_local_ip_async(config, 4)}
 
-    config = open_api_models.Config(
-        credential=cred_client,
-        region_id=cfg["aliyun"]["region"],
-        endpoint="esa.cn-hangzhou.aliyuncs.com"
-    )
 
-    return ESA20240910Client(config)
+def ip_lookup_failed_results(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """无法获取公网IP时，为每条记录生成失败结果"""
+    results = [{"record_id": r.get("record_id"), "record_name": r.get("name"),
+                "local_ip": "", "record_ip": "", "ip_changed": False,
+                "update_performed": False, "update_result": None,
+                "error": "无法获取本机IP地址", "error_code": "IPLookupFailed"} for r in records]
+    for result in results:
+        observe_result(result)
+    return results
 
 
-def get_local_ip() -> str:
+def run_batch_update(records: List[Dict[str, Any]], config: Dict[str, Any],
+                     max_workers: Optional[int] = None, new_ip: Optional[str] = None,
+                     auto_update: bool = True, ips: Optional[Dict[int, str]] = None,
+                     verbose: Optional[bool] = None) -> List[Dict[str, Any]]:
     """
-    获取本机公网IP
+    批量检查并更新多条记录
+
+    公网IP在整个批次中只获取一次并共享（ips 为调用方已获取的结果），各记录的
+    查询/比较/更新 流程由异步更新引擎并发执行（check_records_async），返回与 records 顺序一致的结果列表。
     """
-    try:
-        # 使用ipplus360获取本机IP
-        response = requests.get("https://www.ipplus360.com/getIP", timeout=10)
-        response.raise_for_status()
+    if not records:
+        return []
 
-        data = response.json()
+    # 按本周期配置更新重试/熔断与限流参数（参数不变时保留状态）
+    get_resilience(config)
+    rate_limiters.configure(config.get("rate_limit"))
 
-        if data.get("success") and data.get("code") == 200:
-            return data.get("data", "")
-        else:
-            logger.error(f"获取IP失败: {data.get('msg', '未知错误')}")
-            return ""
+    # 按主机名配置的记录先解析为记录ID
+    try:
+        records = resolve_record_names(records, config)
+    except Exception as e:
+        logger.error(f"解析记录名称失败: {e}")
+
+    # 多实例部署：只处理本实例持有租约的记录，其余记录使用持有者发布的值（不访问ESA）
+    ordered = records
+    standby_by_record: Dict[int, Dict[str, Any]] = {}
+    coordinator = get_coordinator(config)
+    if coordinator is not None:
+        records, standby = coordinator.partition(records)
+        if standby:
+            logger.info(f"{len(standby)} 条记录由其它实例负责写入，本实例为备用")
+            for (record, _), result in zip(standby, standby_results(standby, get_state_cache(config))):
+                standby_by_record[id(record)] = result
+
+    def _merged(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        by_record = dict(zip(map(id, records), results))
+        by_record.update(standby_by_record)
+        return [by_record[id(r)] for r in ordered]
+
+    if not records:
+        state_cache = get_state_cache(config)
+        if state_cache is not None:
+            state_cache.flush()
+        results = _merged([])
+        record_history(results, config)
+        return results
+
+    if max_workers is None:
+        max_workers = int((config.get("batch") or {}).get("max_workers", DEFAULT_BATCH_WORKERS))
+    max_workers = max(1, min(max_workers, len(records)))
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"网络请求失败: {e}")
-        return ""
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON解析失败: {e}")
-        return ""
+    try:
+        results = asyncio.run(check_records_async(records, config, max_workers, new_ip=new_ip,
+                                                  auto_update=auto_update, ips=ips, verbose=verbose))
+    finally:
+        state_cache = get_state_cache(config)
+        if state_cache is not None:
+            state_cache.flush()
+    if coordinator is not None:
+        coordinator.publish(results)
+    results = _merged(results)
+    record_history(results, config)
+    return results
+
+
+# 正在执行的批量检查：id -> (事件循环, 各记录的任务)，停止服务时取消
+_running_checks: Dict[int, tuple] = {}
+_running_checks_lock = threading.Lock()
+
+
+def cancel_running_checks():
+    """取消所有正在进行的记录检查（停止服务时调用），被取消的记录返回 Cancelled 错误"""
+    with _running_checks_lock:
+        running_checks = list(_running_checks.values())
+    for loop, tasks in running_checks:
+        for task in tasks:
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                # 事件循环已经结束
+                pass
+
+
+def esa_call_timeout(config: Optional[Dict[str, Any]]) -> float:
+    """单次ESA请求的超时（秒）"""
+    return float(((config or {}).get("batch") or {}).get("call_timeout", DEFAULT_ESA_CALL_TIMEOUT))
+
+
+async def check_records_async(records: List[Dict[str, Any]], config: Dict[str, Any], max_workers: int,
+                              new_ip: Optional[str] = None, auto_update: bool = True,
+                              ips: Optional[Dict[int, str]] = None,
+                              verbose: Optional[bool] = None) -> List[Dict[str, Any]]:
+    """
+    异步更新引擎：在一个事件循环中检查并更新多条记录
+
+    公网IP只获取一次并共享；每条记录的 查询/比较/更新 作为协程执行，同时进行的记录不超过
+    max_workers 条，不再为每个进行中的请求占用一个线程。返回与 records 顺序一致的结果列表。
+    """
+    # 双栈模式：IPv4与IPv6并发获取，每条记录按协议族使用对应的地址
+    dual_stack = bool((config.get("dual_stack") or {}).get("enabled")) and not new_ip
+    if new_ip:
+        ips = {ip_family(new_ip) or 4: new_ip}
+    else:
+        if ips is None:
+            ips = await lookup_local_ips_async(config)
+        if not any(ips.values()):
+            logger.error("错误: 无法获取本机IP地址")
+            return ip_lookup_failed_results(records)
+        logger.info(f"批量更新: 本机公网IP {' / '.join(ip for ip in ips.values() if ip)}，"
+                    f"共 {len(records)} 条记录，并发数 {max_workers}")
+
+    if verbose is None:
+        verbose = len(records) == 1
+    state_cache = get_state_cache(config)
+    call_timeout = esa_call_timeout(config)
+
+    def _family_of(record: Dict[str, Any], record_info: Optional[RecordInfo]) -> Optional[int]:
+        """依次根据配置的 type、缓存值、已知记录值判断记录的协议族"""
+        if not dual_stack:
+            return next(iter(ips))
+        family = record_family(record)
+        if family is None and state_cache is not None:
+            family = ip_family(state_cache.value(record["record_id"]))
+        if family is None and record_info is not None:
+            family = ip_family(record_info.value)
+        return family
+
+    # 批量比较模式：按站点分页拉取全部记录，已是当前IP的记录不再逐条请求
+    index = None
+    if (config.get("batch") or {}).get("bulk_compare"):
+        # 本地缓存仍有效的记录无需拉取
+        pending = [r for r in records if r.get("record_id")
+                   and (state_cache is None
+                        or state_cache.lookup(r["record_id"], ips.get(_family_of(r, None)) or "") is None)]
+        if pending:
+            index = await asyncio.to_thread(build_record_index, pending, config)
+
+    async def _check(record: Dict[str, Any]) -> Dict[str, Any]:
+        if not record.get("record_id"):
+            raise RecordResolveError(record.get("resolve_error") or f"记录 {record.get('name')} 未解析")
+        record_info = index.get(record["record_id"]) if index else None
+        family = _family_of(record, record_info)
+        if family is None:
+            # 协议族未知时先查询记录，按记录当前值判断
+            with metrics_stage("get_record"):
+                record_info = await get_domain_record_async(record["record_id"], client=create_client(config),
+                                                            timeout=call_timeout)
+            if isinstance(record_info, RecordInfo):
+                family = ip_family(record_info.value) or 4
+        record_ip = ips.get(family) if family else None
+        if family and not record_ip:
+            raise IPLookupError(f"没有可用的IPv{family}地址")
+        return await check_and_update_ip_async(record["record_id"], new_ip=record_ip, auto_update=auto_update,
+                                               config=config, verbose=verbose, record_info=record_info)
+
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def _run_one(record: Dict[str, Any]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            async with semaphore:
+                with span("ddns.record", {"ddns.record_id": record.get("record_id"),
+                                          "ddns.record_name": record.get("name"),
+                                          "ddns.account": record.get("account")}) as record_span, \
+                        collect_stages() as stages:
+                    result = await _check(record)
+                    # 按名称配置的记录不存在时重新解析，记录被删除重建后自动恢复
+                    if record.get("name") and is_not_found_error(result.get("error_code")) \
+                            and await asyncio.to_thread(heal_record, record, config):
+                        result = await _check(record)
+                    if record_span is not None:
+                        record_span.set("ddns.status", _history_status(result))
+                        if "error" in result:
+                            record_span.error = str(result["error"])
+            # 传播检查在释放并发名额后进行，等待生效期间不占用名额
+            checker = get_propagation_checker(config)
+            if checker is not None and (result.get("update_result") or {}).get("success"):
+                with collect_stages() as propagation_stages:
+                    await verify_propagation(checker, result, config, call_timeout)
+                stages.update(propagation_stages)
+            result["stages"] = stages
+        except (Exception, asyncio.CancelledError) as e:
+            cancelled = isinstance(e, asyncio.CancelledError)
+            if cancelled:
+                logger.warning(f"记录 {record.get('record_id') or record.get('name')} 的检查已取消")
+            else:
+                logger.error(f"记录 {record.get('record_id') or record.get('name')} 更新时发生错误: {e}")
+            result = {"record_id": record.get("record_id"), "record_name": record.get("name"),
+                      "local_ip": "", "record_ip": "",
+                      "ip_changed": False, "update_performed": False, "update_result": None,
+                      "error": "检查已取消" if cancelled else str(e),
+                      "error_code": "Cancelled" if cancelled
+                      else "IPLookupFailed" if isinstance(e, IPLookupError) else get_error_code(e)}
+        result["duration"] = time.perf_counter() - started
+        if record.get("account"):
+            result["account"] = record["account"]
+        observe_result(result)
+        return result
+
+    tasks = [asyncio.ensure_future(_run_one(record)) for record in records]
+    with _running_checks_lock:
+        _running_checks[id(tasks)] = (asyncio.get_running_loop(), tasks)
+    try:
+        return list(await asyncio.gather(*tasks))
+    finally:
+        with _running_checks_lock:
+            _running_checks.pop(id(tasks), None)
+
+
+def get_accounts(config: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """多账号模式下的 账号名 -> 账号配置（未配置 name 时按序号命名）"""
+    accounts = {}
+    for i, account in enumerate(config.get("accounts") or []):
+        name = str(account.get("name") or f"account-{i + 1}")
+        if name in accounts:
+            raise ValueError(f"账号名称重复: {name}")
+        accounts[name] = account
+    return accounts
+
+
+def _account_path(path: str, account: str) -> str:
+    """为账号生成独立的文件路径：ddns_state.json -> ddns_state.<账号>.json"""
+    root, ext = os.path.splitext(path)
+    safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in account)
+    return f"{root}.{safe}{ext}"
+
+
+def account_config(config: Dict[str, Any], name: str, account: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    为单个账号生成独立的运行配置
+
+    凭证、区域与接入点取自账号配置（未配置的项沿用顶层 aliyun），状态缓存与记录索引
+    使用各自的文件；账号上的 rate_limit 合并到全局限流配置的 accounts 部分。
+    """
+    derived = {k: v for k, v in config.items() if k not in ("accounts", "records")}
+    derived["account"] = name
+    aliyun_cfg = dict(config.get("aliyun") or {})
+    for key in ("access_key_id", "access_key_secret", "region", "endpoint", "protocol"):
+        if key in account:
+            aliyun_cfg[key] = account[key]
+    derived["aliyun"] = aliyun_cfg
+    derived["rate_limit"] = fleet_rate_limit(config)
+    if (config.get("coordination") or {}).get("enabled"):
+        # 工作进程与主进程使用同一个实例标识
+        derived["coordination"] = {"instance_id": DEFAULT_INSTANCE_ID, **config["coordination"]}
+    for section, default_path in (("state_cache", DEFAULT_STATE_CACHE_PATH),
+                                  ("record_index", DEFAULT_RECORD_INDEX_PATH)):
+        block = dict(config.get(section) or {})
+        block["path"] = _account_path(block.get("path", default_path), name)
+        derived[section] = block
+    return derived
+
+
+def fleet_rate_limit(config: Dict[str, Any]) -> Dict[str, Any]:
+    """合并后的限流配置，所有账号相同，避免线程间反复重建令牌桶"""
+    rate_cfg = dict(config.get("rate_limit") or {})
+    accounts = dict(rate_cfg.get("accounts") or {})
+    for name, account in get_accounts(config).items():
+        if account.get("rate_limit"):
+            accounts[name] = account["rate_limit"]
+    if accounts:
+        rate_cfg["accounts"] = accounts
+    return rate_cfg
+
+
+def _run_account(name: str, records: List[Dict[str, Any]], config: Dict[str, Any],
+                 ips: Dict[int, str], auto_update: bool) -> List[Dict[str, Any]]:
+    """执行单个账号的批量更新；账号级别的异常只影响该账号的记录"""
+    try:
+        results = run_batch_update(records, config, auto_update=auto_update, ips=ips, verbose=False)
     except Exception as e:
-        logger.error(f"获取本机IP时发生未知错误: {e}")
-        return ""
+        logger.error(f"账号 {name} 更新时发生错误: {e}")
+        results = [{"record_id": r.get("record_id"), "record_name": r.get("name"), "local_ip": "",
+                    "record_ip": "", "ip_changed": False, "update_performed": False,
+                    "update_result": None, "error": str(e), "error_code": get_error_code(e)}
+                   for r in records]
+    for result in results:
+        result["account"] = name
+    return results
+
+
+def _fleet_worker_init(log_queue, level: int):
+    """工作进程初始化：日志经队列交给主进程统一输出"""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _run_fleet_shard(jobs: List[tuple], ips: Dict[int, str], auto_update: bool, once: bool,
+                     candidates: Dict[str, tuple]) -> List[Dict[str, Any]]:
+    """
+    工作进程中执行一组账号，各账号在独立线程中并发
+
+    工作进程没有调度器：稳定窗口的候选值由主进程保存并随任务传入，单次模式以外
+    未稳定的记录直接返回，由主进程安排延迟扫描。
+    """
+    _write_coalescer.mode = "once" if once else "worker"
+    for _, records, _ in jobs:
+        for record in records:
+            _write_coalescer.adopt(record["record_id"], candidates.get(str(record["record_id"])))
+    with ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="fleet-account") as executor:
+        futures = [executor.submit(contextvars.copy_context().run, _run_account, name, records, cfg, ips,
+                                   auto_update)
+                   for name, records, cfg in jobs]
+        return [result for future in futures for result in future.result()]
+
+
+class _LogForwarder(logging.Handler):
+    """把工作进程的日志记录交给主进程的日志系统处理"""
+
+    def emit(self, record: logging.LogRecord):
+        logging.getLogger(record.name).handle(record)
+
+
+# 多账号进程池在周期之间复用，工作进程中的客户端与缓存保持预热
+_fleet_pool: Optional[tuple] = None
+_fleet_pool_lock = threading.Lock()
+
+
+def get_fleet_pool(workers: int) -> ProcessPoolExecutor:
+    """返回（必要时创建）多账号模式的进程池，进程数变化时重建"""
+    global _fleet_pool
+    with _fleet_pool_lock:
+        if _fleet_pool is not None and _fleet_pool[0] == workers \
+                and not getattr(_fleet_pool[1], "_broken", False):
+            return _fleet_pool[1]
+        _shutdown_fleet_pool_locked()
+        ctx = multiprocessing.get_context("spawn")
+        log_queue = ctx.Queue()
+        forwarder = logging.handlers.QueueListener(log_queue, _LogForwarder())
+        forwarder.start()
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_fleet_worker_init,
+                                       initargs=(log_queue, logging.getLogger().level))
+        _fleet_pool = (workers, executor, forwarder)
+        return executor
+
+
+def _shutdown_fleet_pool_locked():
+    global _fleet_pool
+    if _fleet_pool is not None:
+        _, executor, forwarder = _fleet_pool
+        executor.shutdown(wait=True, cancel_futures=True)
+        forwarder.stop()
+        _fleet_pool = None
+
+
+def shutdown_fleet_pool():
+    """停止多账号模式的工作进程"""
+    with _fleet_pool_lock:
+        _shutdown_fleet_pool_locked()
+
+
+def _adopt_worker_candidate(coalescer: "WriteCoalescer", result: Dict[str, Any]):
+    """保存工作进程交回的稳定窗口候选值，并在窗口到期时安排一次扫描"""
+    candidate = result.pop("candidate", None)
+    coalescer.adopt(result["record_id"], candidate)
+    if candidate is not None:
+        delay = candidate[1] + coalescer.stabilize_seconds - time.time()
+        logger.info(f"记录 {result['record_id']} 的新IP {candidate[0]} 需稳定 {max(0.0, delay):.0f} 秒后再写入")
+        scheduler.trigger_later(MANUAL_JOB, delay)
+
+
+def run_fleet_update(records: List[Dict[str, Any]], config: Dict[str, Any],
+                     auto_update: bool = True) -> List[Dict[str, Any]]:
+    """
+    多账号模式：按账号分组执行批量更新，返回汇总结果
+
+    公网IP只获取一次供所有账号使用。每个账号使用独立的客户端、限流器、熔断器与
+    状态文件；fleet.mode 为 thread（默认）时各账号在线程中并发，为 process 时
+    按 fleet.workers 将账号分片到多个工作进程。
+    """
+    accounts = get_accounts(config)
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for record in records:
+        groups.setdefault(record["account"], []).append(record)
+    if not groups:
+        return []
+
+    ips = lookup_local_ips(config)
+    if not any(ips.values()):
+        logger.error("错误: 无法获取本机IP地址")
+        results = ip_lookup_failed_results(records)
+        for record, result in zip(records, results):
+            result["account"] = record["account"]
+        return results
+
+    fleet_cfg = config.get("fleet") or {}
+    mode = fleet_cfg.get("mode", "thread")
+    workers = max(1, min(int(fleet_cfg.get("workers", DEFAULT_FLEET_WORKERS)), len(groups)))
+    jobs = [(name, group, account_config(config, name, accounts[name])) for name, group in groups.items()]
+    logger.info(f"多账号模式: {len(jobs)} 个账号，共 {len(records)} 条记录，"
+                f"{'进程' if mode == 'process' else '线程'}数 {workers}")
+
+    if mode != "process":
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fleet-account") as executor:
+            futures = [executor.submit(contextvars.copy_context().run, _run_account, name, group, cfg, ips,
+                                       auto_update)
+                       for name, group, cfg in jobs]
+            return [result for future in futures for result in future.result()]
+
+    # 按账号轮流分片，每个工作进程负责一组账号
+    shards = [jobs[i::workers] for i in range(workers)]
+    executor = get_fleet_pool(workers)
+    coalescer = get_write_coalescer(config)
+    once = coalescer.mode == "once"
+    candidates = {}
+    for record in records:
+        candidate = coalescer.candidate(record["record_id"])
+        if candidate is not None:
+            candidates[str(record["record_id"])] = candidate
+    futures = {executor.submit(_run_fleet_shard, shard, ips, auto_update, once, candidates): shard
+               for shard in shards}
+    results: List[Dict[str, Any]] = []
+    for future, shard in futures.items():
+        try:
+            shard_results = future.result()
+        except Exception as e:
+            # 工作进程异常退出时，该分片的账号全部记为失败（进程池会在下个周期重建）
+            logger.error(f"多账号模式: 工作进程失败 - {e}")
+            shard_results = [{"record_id": r.get("record_id"), "record_name": r.get("name"),
+                              "account": name, "local_ip": "", "record_ip": "",
+                              "ip_changed": False, "update_performed": False,
+                              "update_result": None, "error": str(e),
+                              "error_code": get_error_code(e)}
+                             for name, group, _ in shard for r in group]
+        # 工作进程中的指标不会回传，在主进程中重新统计
+        for result in shard_results:
+            observe_result(result)
+            if not once and result.get("record_id") is not None:
+                _adopt_worker_candidate(coalescer, result)
+        results.extend(shard_results)
+
+    # 按账号配置顺序输出
+    order = {name: i for i, name in enumerate(groups)}
+    results.sort(key=lambda r: order.get(r.get("account"), len(order)))
+    return results
+
+
+def print_fleet_summary(results: List[Dict[str, Any]]):
+    """按账号输出多账号模式的汇总结果"""
+    summary: Dict[str, Dict[str, int]] = {}
+    for result in results:
+        counts = summary.setdefault(str(result.get("account")), {})
+        status = _result_status(result)
+        counts[status] = counts.get(status, 0) + 1
+
+    cprint(f"\n{'账号':<24} {'记录数':>6}  结果", Colors.WHITE, bold=True)
+    for name, counts in summary.items():
+        detail = ", ".join(f"{k}: {v}" for k, v in counts.items())
+        failed = any(k in ("错误", "更新失败") for k in counts)
+        cprint(f"{name:<24} {sum(counts.values()):>6}  {detail}", Colors.RED if failed else Colors.GREEN)
+        logger.info(f"账号 {name}: {detail}")
+
+
+class RecordIndex:
+    """站点记录的内存索引，按记录ID和记录名称查找"""
+
+    def __init__(self):
+        self.by_id: Dict[int, RecordInfo] = {}
+        self.by_name: Dict[str, List[RecordInfo]] = {}
+
+    def add(self, record: RecordInfo):
+        self.by_id[record.record_id] = record
+        self.by_name.setdefault(record.name.lower(), []).append(record)
+
+    def get(self, record_id: Any) -> Optional[RecordInfo]:
+        try:
+            return self.by_id.get(int(record_id))
+        except (TypeError, ValueError):
+            return None
+
+    def find(self, name: str, record_type: Optional[str] = None) -> List[RecordInfo]:
+        matches = self.by_name.get(str(name).lower(), [])
+        if record_type:
+            matches = [r for r in matches if r.type == record_type]
+        return matches
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+def list_site_records(site_id: int, client: Optional[ESA20240910Client] = None,
+                      page_size: int = DEFAULT_LIST_PAGE_SIZE,
+                      record_name: Optional[str] = None) -> List[RecordInfo]:
+    """
+    分页拉取站点下的全部记录
+    """
+    if client is None:
+        client = create_client()
+
+    records: List[RecordInfo] = []
+    page_number = 1
+    while True:
+        list_request = esa20240910_models.ListRecordsRequest(
+            site_id=site_id,
+            record_name=record_name,
+            record_match_type="exact" if record_name else None,
+            page_number=page_number,
+            page_size=page_size
+        )
+        try:
+            resp = call_esa(client, "ListRecords", list_request)
+        except Exception as error:
+            error_msg = getattr(error, 'message', str(error))
+            logger.error(f"拉取站点 {site_id} 的记录列表失败: {error_msg}")
+            raise error
+
+        body = resp.body
+        page = body.records or []
+        records.extend(RecordInfo.from_model(item, body.request_id) for item in page if item.record_id is not None)
+
+        total = int(body.total_count or 0)
+        if not page or len(page) < page_size or len(records) >= total:
+            break
+        page_number += 1
+
+    logger.info(f"站点 {site_id} 共拉取 {len(records)} 条记录 ({page_number} 次请求)")
+    return records
+
+
+def build_record_index(records: List[Dict[str, Any]], config: Dict[str, Any]) -> RecordIndex:
+    """
+    为批量中涉及的站点建立记录索引
+
+    未配置 site_id 的记录以及拉取失败的站点会回退到逐条 GetRecord。
+    """
+    index = RecordIndex()
+    site_ids = sorted({int(r["site_id"]) for r in records if r.get("site_id")})
+    if not site_ids:
+        logger.warning("批量比较模式: 记录未配置 site_id，回退到逐条查询")
+        return index
+
+    page_size = int((config.get("batch") or {}).get("page_size", DEFAULT_LIST_PAGE_SIZE))
+    client = create_client(config)
+    for site_id in site_ids:
+        try:
+            for record in list_site_records(site_id, client=client, page_size=page_size):
+                index.add(record)
+        except Exception as e:
+            logger.error(f"批量比较模式: 站点 {site_id} 拉取失败，回退到逐条查询 - {e}")
+    return index
+
+
+class RecordResolveError(Exception):
+    """按名称配置的记录无法解析为记录ID"""
 
+    code = "RecordNotResolved"
 
-def parse_response_string(response_str: str) -> Dict[str, Any]:
+
+def is_not_found_error(code: Any) -> bool:
+    """ESA错误码是否表示记录（或站点）不存在"""
+    code = str(code or "")
+    return "NotExist" in code or "NotFound" in code
+
+
+def record_matches_type(record: RecordInfo, record_type: Optional[str]) -> bool:
+    """
+    记录是否为指定类型的地址记录
+
+    ESA 中 A 与 AAAA 记录的类型都是 A/AAAA，只能按记录值的协议族区分。
+    """
+    if record.type.upper() not in ("A/AAAA", "A", "AAAA"):
+        return False
+    if not record_type:
+        return True
+    family = ip_family(record.value)
+    return family is None or IP_FAMILY_RECORD_TYPES.get(family) == str(record_type).upper()
+
+
+class RecordNameIndex:
+    """
+    主机名 -> 记录ID 的持久化索引
+
+    按 (站点, 主机名, 类型) 保存解析出的记录ID与解析时间，以及站点名称 -> 站点ID，
+    持久化为JSON文件。条目超过 ttl 后在下次解析时重新确认。
+    """
+
+    def __init__(self, path: str = DEFAULT_RECORD_INDEX_PATH, ttl: float = DEFAULT_RECORD_INDEX_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._sites: Dict[str, int] = {}
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self._records = data.get("records", {})
+                self._sites = data.get("sites", {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"读取记录索引 {self.path} 失败，将重新建立: {e}")
+
+    @staticmethod
+    def key(site_id: Any, name: str, record_type: Optional[str]) -> str:
+        return f"{site_id}/{str(name).lower().rstrip('.')}/{str(record_type or '*').upper()}"
+
+    def lookup(self, site_id: Any, name: str, record_type: Optional[str]) -> Optional[int]:
+        """返回仍在有效期内的记录ID"""
+        with self._lock:
+            entry = self._records.get(self.key(site_id, name, record_type))
+            if not entry or time.time() - entry.get("resolved_at", 0) >= self.ttl:
+                return None
+            return int(entry["record_id"])
+
+    def store(self, site_id: Any, name: str, record_type: Optional[str], record_id: Any):
+        with self._lock:
+            self._records[self.key(site_id, name, record_type)] = {
+                "record_id": int(record_id),
+                "resolved_at": time.time(),
+            }
+            self._dirty = True
+
+    def invalidate(self, site_id: Any, name: str, record_type: Optional[str]):
+        """丢弃条目（例如记录在控制台被删除重建），下次解析时重新查询"""
+        with self._lock:
+            if self._records.pop(self.key(site_id, name, record_type), None) is not None:
+                self._dirty = True
+
+    def site_id(self, site_name: str) -> Optional[int]:
+        with self._lock:
+            return self._sites.get(str(site_name).lower())
+
+    def store_site(self, site_name: str, site_id: Any):
+        with self._lock:
+            self._sites[str(site_name).lower()] = int(site_id)
+            self._dirty = True
+
+    def flush(self):
+        """将索引原子地写入文件"""
+        with self._lock:
+            if not self._dirty:
+                return
+            payload = json.dumps({"version": 1, "sites": self._sites, "records": self._records},
+                                 ensure_ascii=False)
+            self._dirty = False
+        try:
+            atomic_write_text(self.path, payload)
+        except Exception as e:
+            logger.error(f"写入记录索引 {self.path} 失败: {e}")
+
+
+_record_name_indexes: Dict[str, RecordNameIndex] = {}
+_record_name_index_lock = threading.Lock()
+
+
+def get_record_name_index(config: Optional[Dict[str, Any]]) -> RecordNameIndex:
+    """根据配置返回记录名称索引（按文件路径复用）"""
+    index_cfg = (config or {}).get("record_index") or {}
+    path = index_cfg.get("path", DEFAULT_RECORD_INDEX_PATH)
+    ttl = float(index_cfg.get("ttl", DEFAULT_RECORD_INDEX_TTL))
+    with _record_name_index_lock:
+        index = _record_name_indexes.get(path)
+        if index is None:
+            index = _record_name_indexes[path] = RecordNameIndex(path, ttl)
+        index.ttl = ttl
+        return index
+
+
+def resolve_site_id(site_name: str, client: ESA20240910Client, index: RecordNameIndex) -> int:
+    """按站点名称查询站点ID（结果保存在索引中）"""
+    site_id = index.site_id(site_name)
+    if site_id is not None:
+        return site_id
+    request = esa20240910_models.ListSitesRequest(site_name=site_name, site_search_type="exact")
+    body = call_esa(client, "ListSites", request).body
+    for site in body.sites or []:
+        if str(site.site_name or "").lower() == str(site_name).lower():
+            index.store_site(site_name, site.site_id)
+            return int(site.site_id)
+    raise RecordResolveError(f"未找到站点 {site_name}")
+
+
+def resolve_record_names(records: List[Dict[str, Any]], config: Dict[str, Any],
+                         refresh: bool = False) -> List[Dict[str, Any]]:
+    """
+    为按主机名配置的记录填充 record_id
+
+    优先使用持久化索引；索引中没有（或已过期、refresh=True）的名称按站点分组查询：
+    同一站点待解析的名称达到 scan_threshold 个时整站分页拉取一次，否则按名称精确查询。
+    解析失败的记录写入 resolve_error，由批量更新输出为失败结果。
+    """
+    named = [r for r in records if r.get("name") and not r.get("record_id")]
+    if not named:
+        return records
+
+    index = get_record_name_index(config)
+    index_cfg = config.get("record_index") or {}
+    threshold = int(index_cfg.get("scan_threshold", DEFAULT_RECORD_INDEX_SCAN_THRESHOLD))
+    page_size = int((config.get("batch") or {}).get("page_size", DEFAULT_LIST_PAGE_SIZE))
+    client = create_client(config)
+
+    pending: Dict[int, List[Dict[str, Any]]] = {}
+    for record in named:
+        try:
+            site_id = record.get("site_id")
+            if site_id is None:
+                if not record.get("site"):
+                    raise RecordResolveError(f"记录 {record['name']} 未配置 site_id 或 site")
+                site_id = resolve_site_id(record["site"], client, index)
+            record["site_id"] = int(site_id)
+        except Exception as e:
+            record["resolve_error"] = str(e)
+            continue
+        cached = None if refresh else index.lookup(record["site_id"], record["name"], record.get("type"))
+        if cached is not None:
+            record["record_id"] = cached
+        else:
+            pending.setdefault(record["site_id"], []).append(record)
+
+    for site_id, site_records in pending.items():
+        try:
+            if len(site_records) >= threshold:
+                site_index = RecordIndex()
+                for item in list_site_records(site_id, client=client, page_size=page_size):
+                    site_index.add(item)
+                candidates = {id(r): site_index.find(r["name"]) for r in site_records}
+            else:
+                candidates = {id(r): list_site_records(site_id, client=client, page_size=page_size,
+                                                       record_name=r["name"])
+                              for r in site_records}
+        except Exception as e:
+            for record in site_records:
+                record["resolve_error"] = f"查询站点 {site_id} 的记录失败: {e}"
+            continue
+
+        for record in site_records:
+            matches = [m for m in candidates[id(record)] if record_matches_type(m, record.get("type"))]
+            if len(matches) == 1:
+                record["record_id"] = matches[0].record_id
+                index.store(site_id, record["name"], record.get("type"), record["record_id"])
+                logger.info(f"记录 {record['name']} 解析为记录ID {record['record_id']}")
+            elif not matches:
+                record["resolve_error"] = f"站点 {site_id} 中没有名为 {record['name']} 的地址记录"
+            else:
+                record["resolve_error"] = (f"{record['name']} 匹配到 {len(matches)} 条记录，"
+                                           f"请配置 type（A 或 AAAA）")
+
+    index.flush()
+    return records
+
+
+def heal_record(record: Dict[str, Any], config: Dict[str, Any]) -> bool:
+    """
+    记录不存在时重新解析（记录在控制台删除重建后ID会变化）
+
+    返回是否解析到了与原来不同的记录ID。
     """
-    解析响应字符串为字典
+    old_id = record.get("record_id")
+    index = get_record_name_index(config)
+    index.invalidate(record.get("site_id"), record["name"], record.get("type"))
+    record["record_id"] = None
+    resolve_record_names([record], config, refresh=True)
+    if record.get("record_id") and record["record_id"] != old_id:
+        logger.warning(f"记录 {record['name']} 的ID已由 {old_id} 变为 {record['record_id']}，已更新索引")
+        state_cache = get_state_cache(config)
+        if state_cache is not None:
+            state_cache.invalidate(old_id)
+        return True
+    return False
+
+
+def print_result_summary(result: Dict[str, Any]):
+    """输出单条记录的结果摘要"""
+    cprint("\n" + "=" * 60, Colors.MAGENTA)
+    cprint("结果摘要:", Colors.CYAN, bold=True)
+    cprint("=" * 60, Colors.MAGENTA)
+
+    cprint(f"记录ID: {result.get('record_id')}", Colors.WHITE)
+    cprint(f"本机IP: {result.get('local_ip')}", Colors.WHITE)
+    cprint(f"记录IP: {result.get('record_ip')}", Colors.WHITE)
+
+    if result.get('ip_changed'):
+        ip_status = f"{Colors.YELLOW}是{Colors.RESET}"
+    else:
+        ip_status = f"{Colors.GREEN}否{Colors.RESET}"
+    cprint(f"IP是否变化: {ip_status}", Colors.WHITE)
+
+    if result.get('update_performed'):
+        update_status = f"{Colors.YELLOW}是{Colors.RESET}"
+    else:
+        update_status = f"{Colors.CYAN}否{Colors.RESET}"
+    cprint(f"是否执行更新: {update_status}", Colors.WHITE)
+
+    if result.get('update_result'):
+        if result['update_result'].get('success'):
+            update_result = f"{Colors.GREEN}成功{Colors.RESET}"
+        else:
+            update_result = f"{Colors.RED}失败{Colors.RESET}"
+        cprint(f"更新结果: {update_result}", Colors.WHITE)
+
+    propagation = result.get('propagation')
+    if propagation:
+        color = Colors.GREEN if propagation.get('converged') else Colors.YELLOW
+        cprint(f"传播检查: {color}{propagation_text(propagation)}{Colors.RESET}", Colors.WHITE)
+
+    if result.get('error'):
+        cprint(f"错误信息: {result['error']}", Colors.RED)
+    cprint("=" * 60, Colors.MAGENTA)
+
+    # 同时记录到日志
+    logger.info("=" * 60)
+    logger.info("结果摘要:")
+    logger.info(f"记录ID: {result.get('record_id')}")
+    logger.info(f"本机IP: {result.get('local_ip')}")
+    logger.info(f"记录IP: {result.get('record_ip')}")
+    logger.info(f"IP是否变化: {'是' if result.get('ip_changed') else '否'}")
+    logger.info(f"是否执行更新: {'是' if result.get('update_performed') else '否'}")
+
+    if result.get('update_result'):
+        logger.info(f"更新结果: {'成功' if result['update_result'].get('success') else '失败'}")
+    if propagation:
+        logger.info(f"传播检查: {propagation_text(propagation)}")
+
+    if result.get('error'):
+        logger.error(f"错误信息: {result['error']}")
+    logger.info("=" * 60)
+
+
+def _result_status(result: Dict[str, Any]) -> str:
+    """结果状态文本"""
+    if result.get('error'):
+        return "错误"
+    if result.get('update_performed'):
+        update_result = result.get('update_result') or {}
+        return "已更新" if update_result.get('success') else "更新失败"
+    if result.get('deferred'):
+        return "等待稳定"
+    if result.get('standby'):
+        return "备用"
+    if result.get('ip_changed'):
+        return "待更新"
+    return "无变化"
+
+
+def print_result_table(results: List[Dict[str, Any]]):
+    """以表格形式输出批量更新结果"""
+    header = f"{'记录ID':<20} {'记录名称':<32} {'记录IP':<40} {'状态':<6}"
+    cprint("\n" + "=" * 100, Colors.MAGENTA)
+    cprint(f"批量更新结果 (共 {len(results)} 条):", Colors.CYAN, bold=True)
+    cprint("=" * 100, Colors.MAGENTA)
+    cprint(header, Colors.WHITE, bold=True)
+    logger.info("=" * 60)
+    logger.info(f"批量更新结果 (共 {len(results)} 条):")
+
+    status_colors = {"错误": Colors.RED, "更新失败": Colors.RED, "已更新": Colors.YELLOW,
+                     "待更新": Colors.YELLOW, "无变化": Colors.GREEN}
+    for result in results:
+        status = _result_status(result)
+        line = (f"{str(result.get('record_id') or '-'):<20} {str(result.get('record_name') or '-'):<32} "
+                f"{str(result.get('record_ip') or '-'):<40} {status:<6}")
+        cprint(line, status_colors.get(status, Colors.WHITE))
+        if result.get('error'):
+            cprint(f"    错误信息: {result['error']}", Colors.RED)
+            logger.error(f"记录 {result.get('record_id') or result.get('record_name')}: {status} - {result['error']}")
+        else:
+            logger.info(f"记录 {result.get('record_id')}: {status} (记录IP: {result.get('record_ip') or '空'})")
+
+    counts: Dict[str, int] = {}
+    for result in results:
+        status = _result_status(result)
+        counts[status] = counts.get(status, 0) + 1
+    summary = ", ".join(f"{k}: {v}" for k, v in counts.items())
+    cprint("-" * 100, Colors.MAGENTA)
+    cprint(f"统计: {summary}", Colors.CYAN)
+    cprint("=" * 100, Colors.MAGENTA)
+    logger.info(f"统计: {summary}")
+    logger.info("=" * 60)
+
+
+class RecordStateCache:
     """
+    本地记录状态缓存
+
+    按记录保存最近一次在ESA上确认过的值、确认时间和RequestId，持久化为JSON文件
+    （先写临时文件再原子替换）。本机IP与缓存值相同且未超过重新校验时间时，
+    无需再访问ESA。
+    """
+
+    def __init__(self, path: str = DEFAULT_STATE_CACHE_PATH,
+                 revalidate_ttl: float = DEFAULT_STATE_REVALIDATE_TTL):
+        self.path = path
+        self.revalidate_ttl = revalidate_ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self._entries = data.get("records", {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"读取状态缓存 {self.path} 失败，将重新建立: {e}")
+
+    def lookup(self, record_id: Any, value: str) -> Optional[Dict[str, Any]]:
+        """缓存值与 value 相同且仍在有效期内时返回缓存条目"""
+        with self._lock:
+            entry = self._entries.get(str(record_id))
+            if not entry or entry.get("value") != value:
+                return None
+            if time.time() - entry.get("confirmed_at", 0) >= self.revalidate_ttl:
+                return None
+            return dict(entry)
+
+    def value(self, record_id: Any) -> Optional[str]:
+        """最近一次确认的值（不检查有效期）"""
+        with self._lock:
+            return (self._entries.get(str(record_id)) or {}).get("value")
+
+    def confirm(self, record_id: Any, value: str, request_id: Optional[str] = None,
+                record_name: Optional[str] = None, confirmed_at: Optional[float] = None):
+        """记录ESA上已确认的值（confirmed_at 为确认时间，默认为当前）；值发生变化时立即落盘"""
+        with self._lock:
+            key = str(record_id)
+            changed = (self._entries.get(key) or {}).get("value") != value
+            self._entries[key] = {
+                "value": value,
+                "confirmed_at": confirmed_at or time.time(),
+                "request_id": request_id,
+                "record_name": record_name,
+            }
+            self._dirty = True
+        if changed:
+            self.flush()
+
+    def invalidate(self, record_id: Any):
+        """丢弃记录的缓存，下次必定访问ESA"""
+        with self._lock:
+            if self._entries.pop(str(record_id), None) is None:
+                return
+            self._dirty = True
+        self.flush()
+
+    def flush(self):
+        """将缓存原子地写入文件"""
+        with self._lock:
+            if not self._dirty:
+                return
+            payload = json.dumps({"version": 1, "records": self._entries}, ensure_ascii=False)
+            self._dirty = False
+        try:
+            atomic_write_text(self.path, payload)
+        except Exception as e:
+            logger.error(f"写入状态缓存 {self.path} 失败: {e}")
+
+
+def atomic_write_text(path: str, text: str):
+    """先写同目录下的临时文件再原子替换，避免进程中途退出留下半个文件"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+_state_caches: Dict[str, RecordStateCache] = {}
+_state_cache_lock = threading.Lock()
+
+
+def get_state_cache(config: Optional[Dict[str, Any]]) -> Optional[RecordStateCache]:
+    """根据配置返回状态缓存（按文件路径复用），未启用时返回None"""
+    cache_cfg = (config or {}).get("state_cache") or {}
+    if not cache_cfg.get("enabled"):
+        return None
+    path = cache_cfg.get("path", DEFAULT_STATE_CACHE_PATH)
+    ttl = float(cache_cfg.get("revalidate_ttl", DEFAULT_STATE_REVALIDATE_TTL))
+    with _state_cache_lock:
+        cache = _state_caches.get(path)
+        if cache is None:
+            cache = _state_caches[path] = RecordStateCache(path, ttl)
+        cache.revalidate_ttl = ttl
+        return cache
+
+
+class WriteCoalescer:
+    """
+    记录写入合并（位于 update_domain_record 之前）
+
+    - 稳定窗口：新IP需要持续 stabilize_seconds 秒才会写入，链路抖动期间来回变化的IP不会写到ESA；
+    - 同一记录同时只有一个写入，目标相同的重复触发（手动/定时/网卡监听）等待并复用其结果，
+      目标不同的写入排在其后执行。
+
+    mode 决定新IP未稳定时的处理：daemon（服务模式，延迟触发一次扫描）、
+    once（--once 单次模式，在周期内等待）、worker（多账号工作进程，交回主进程安排）。
+    """
+
+    def __init__(self, stabilize_seconds: float = 0.0):
+        self.stabilize_seconds = stabilize_seconds
+        self.mode = "daemon"
+        self._lock = threading.Lock()
+        # 记录ID -> (候选IP, 首次发现时间)
+        self._candidates: Dict[str, tuple] = {}
+        # 记录ID -> (正在写入的IP, Future)
+        self._inflight: Dict[str, tuple] = {}
+        # 候选IP -> 稳定性复查（单次模式下同一IP的所有记录共用一次复查）
+        self._stability_checks: Dict[str, Future] = {}
+
+    def clear(self, record_id: Any):
+        """记录值已经是本机IP，丢弃候选值"""
+        with self._lock:
+            if self._candidates.pop(str(record_id), None) is not None:
+                COALESCED_TOTAL.inc(reason="flap")
+
+    def remaining(self, record_id: Any, target: str) -> float:
+        """登记候选IP，返回距离稳定还需等待的秒数"""
+        if self.stabilize_seconds <= 0:
+            return 0.0
+        key = str(record_id)
+        now = time.time()
+        with self._lock:
+            candidate = self._candidates.get(key)
+            if candidate is None or candidate[0] != target:
+                candidate = self._candidates[key] = (target, now)
+            return max(0.0, candidate[1] + self.stabilize_seconds - now)
+
+    def candidate(self, record_id: Any) -> Optional[tuple]:
+        """记录当前的 (候选IP, 首次发现时间)，没有候选值时返回None"""
+        with self._lock:
+            return self._candidates.get(str(record_id))
+
+    def adopt(self, record_id: Any, candidate: Optional[tuple]):
+        """用其它进程登记的候选值替换本地状态（None 表示已没有候选值）"""
+        key = str(record_id)
+        with self._lock:
+            if candidate is None:
+                self._candidates.pop(key, None)
+            else:
+                self._candidates[key] = tuple(candidate)
+
+    async def wait_stable(self, record_id: Any, target: str, config: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        新IP是否已经稳定，可以写入
+
+        服务模式下不等待：延迟触发一次手动扫描并返回False，到期后的扫描再写入；
+        工作进程中直接返回False，候选值随结果交回主进程重新安排；
+        单次模式下等待窗口结束并重新获取一次公网IP，仍是该IP时返回True。
+        """
+        delay = self.remaining(record_id, target)
+        if delay <= 0:
+            return True
+        COALESCED_TOTAL.inc(reason="deferred")
+        if self.mode == "worker":
+            return False
+        if self.mode != "once":
+            logger.info(f"记录 {record_id} 的新IP {target} 需稳定 {delay:.0f} 秒后再写入")
+            scheduler.trigger_later(MANUAL_JOB, delay)
+            return False
+
+        with self._lock:
+            check = self._stability_checks.get(target)
+            owner = check is None
+            if owner:
+                check = self._stability_checks[target] = Future()
+        if owner:
+            logger.info(f"新IP {target} 需稳定 {delay:.0f} 秒，等待后重新确认")
+            try:
+                await asyncio.sleep(delay)
+                check.set_result(await get_local_ip_async(config, ip_family(target)) == target)
+            except BaseException as e:
+                check.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    self._stability_checks.pop(target, None)
+        # 复查可能由其它线程的事件循环执行
+        stable = await asyncio.wrap_future(check)
+        if not stable:
+            self.clear(record_id)
+        return stable
+
+    async def write(self, record_id: Any, target: str, write_fn) -> tuple:
+        """
+        执行写入（write_fn 为协程函数），返回 (结果, 是否复用了其它写入的结果)
+
+        同一记录已有相同目标的写入在进行时直接等待其结果，不再调用 UpdateRecord。
+        """
+        key = str(record_id)
+        while True:
+            with self._lock:
+                inflight = self._inflight.get(key)
+                if inflight is None:
+                    future = Future()
+                    self._inflight[key] = (target, future)
+                    break
+            value, other = inflight
+            if value == target:
+                COALESCED_TOTAL.inc(reason="inflight")
+                return dict(await asyncio.wrap_future(other)), True
+            # 目标不同：等前一个写入结束后再写
+            await asyncio.wait([asyncio.wrap_future(other)])
+
+        try:
+            result = await write_fn()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                self._candidates.pop(key, None)
+
+
+_write_coalescer = WriteCoalescer()
+
+
+def get_write_coalescer(config: Optional[Dict[str, Any]]) -> WriteCoalescer:
+    """返回全局写入合并器，按配置更新稳定窗口"""
+    coalesce_cfg = (config or {}).get("write_coalescing") or {}
+    _write_coalescer.stabilize_seconds = float(coalesce_cfg.get("stabilize_seconds", 0))
+    return _write_coalescer
+
+
+def _history_status(result: Dict[str, Any]) -> str:
+    """运行历史中的状态"""
+    if result.get("error"):
+        return "error"
+    if result.get("update_performed"):
+        return "updated" if (result.get("update_result") or {}).get("success") else "update_failed"
+    if result.get("deferred"):
+        return "deferred"
+    if result.get("standby"):
+        return "standby"
+    if result.get("ip_changed"):
+        return "pending"
+    return "noop"
+
+
+class HistoryStore:
+    """
+    运行历史（SQLite，WAL 模式，只追加）
+
+    每条记录每次检查一行：时间、状态、原值/新值、错误码、总耗时与各阶段耗时。
+    按 (record_id, ts) 与 ts 建索引，按记录和时间范围查询不需要全表扫描。
+    压缩时将超过 raw_days 天的无变化记录按 (记录, 天) 合并为一行（count 为合并的次数），
+    超过 retention_days 天的记录删除，并增量回收文件空间。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            ts REAL NOT NULL,
+            record_id TEXT NOT NULL,
+            record_name TEXT,
+            account TEXT,
+            status TEXT NOT NULL,
+            old_value TEXT,
+            new_value TEXT,
+            error_code TEXT,
+            duration_ms REAL,
+            stages TEXT,
+            count INTEGER NOT NULL DEFAULT 1
+        );
+        CREATE INDEX IF NOT EXISTS idx_runs_record_ts ON runs (record_id, ts);
+        CREATE INDEX IF NOT EXISTS idx_runs_ts ON runs (ts);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, path: str = DEFAULT_HISTORY_PATH, raw_days: float = DEFAULT_HISTORY_RAW_DAYS,
+                 retention_days: float = DEFAULT_HISTORY_RETENTION_DAYS,
+                 compact_interval: float = DEFAULT_HISTORY_COMPACT_INTERVAL):
+        self.path = path
+        self.raw_days = raw_days
+        self.retention_days = retention_days
+        self.compact_interval = compact_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        # auto_vacuum 只能在建表前设置，已有数据库保持原样
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+
+    def append(self, results: List[Dict[str, Any]], ts: Optional[float] = None):
+        """追加一批结果（一个事务）"""
+        ts = ts or time.time()
+        rows = []
+        for r in results:
+            status = _history_status(r)
+            new_value = r.get("local_ip") if status in ("updated", "pending", "deferred") else None
+            stages = {k: round(v * 1000, 2) for k, v in (r.get("stages") or {}).items()}
+            rows.append((ts, str(r.get("record_id") or r.get("record_name")), r.get("record_name"),
+                         r.get("account"), status, r.get("record_ip") or None, new_value,
+                         r.get("error_code") if status in ("error", "update_failed") else None,
+                         round(r["duration"] * 1000, 2) if r.get("duration") is not None else None,
+                         json.dumps(stages) if stages else None))
+        if not rows:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "INSERT INTO runs (ts, record_id, record_name, account, status, old_value, new_value,"
+                    " error_code, duration_ms, stages) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def query(self, record: Optional[str] = None, since: Optional[float] = None,
+              until: Optional[float] = None, status: Optional[str] = None,
+              limit: int = 100) -> List[Dict[str, Any]]:
+        """按记录ID（或名称）、时间范围与状态查询，按时间倒序"""
+        where, args = self._where(record, since, until, status)
+        sql = f"SELECT * FROM runs{where} ORDER BY ts DESC LIMIT ?"
+        with self._lock:
+            cursor = self._conn.execute(sql, (*args, int(limit)))
+            columns = [c[0] for c in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for row in rows:
+            row["stages"] = json.loads(row["stages"]) if row["stages"] else {}
+            row["time"] = datetime.fromtimestamp(row["ts"]).strftime('%Y-%m-%d %H:%M:%S')
+        return rows
+
+    def summary(self, record: Optional[str] = None, since: Optional[float] = None,
+                until: Optional[float] = None) -> Dict[str, int]:
+        """各状态的次数（已合并的行按 count 计）"""
+        where, args = self._where(record, since, until, None)
+        with self._lock:
+            cursor = self._conn.execute(f"SELECT status, SUM(count) FROM runs{where} GROUP BY status", args)
+            return {status: int(total) for status, total in cursor.fetchall()}
+
+    @staticmethod
+    def _where(record, since, until, status) -> tuple:
+        clauses, args = [], []
+        if record:
+            clauses.append("(record_id = ? OR record_name = ?)")
+            args.extend([str(record), str(record)])
+        if since is not None:
+            clauses.append("ts >= ?")
+            args.append(float(since))
+        if until is not None:
+            clauses.append("ts < ?")
+            args.append(float(until))
+        if status:
+            clauses.append("status = ?")
+            args.append(status)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), args
+
+    def compact(self, now: Optional[float] = None) -> Dict[str, int]:
+        """合并旧的无变化记录并删除过期记录，返回处理的行数"""
+        now = now or time.time()
+        raw_before = now - self.raw_days * 86400
+        retain_before = now - self.retention_days * 86400
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN IMMEDIATE")
+                expired = self._conn.execute("DELETE FROM runs WHERE ts < ?", (retain_before,)).rowcount
+                # 每条记录每天只保留一行无变化记录
+                groups = self._conn.execute(
+                    "SELECT record_id, CAST(ts / 86400 AS INTEGER) AS day, COUNT(*) FROM runs"
+                    " WHERE status = 'noop' AND ts < ? GROUP BY record_id, day HAVING COUNT(*) > 1",
+                    (raw_before,)).fetchall()
+                merged = 0
+                for record_id, day, _ in groups:
+                    # 窗口内的原始记录不参与合并，当天的上界取原始记录保留期的起点
+                    bounds = (record_id, day * 86400, min((day + 1) * 86400, raw_before))
+                    self._conn.execute(
+                        "INSERT INTO runs (ts, record_id, record_name, account, status, old_value,"
+                        " duration_ms, count)"
+                        " SELECT MAX(ts), record_id, MAX(record_name), MAX(account), 'noop', MAX(old_value),"
+                        " AVG(duration_ms), SUM(count) FROM runs"
+                        " WHERE status = 'noop' AND record_id = ? AND ts >= ? AND ts < ?", bounds)
+                    last_id = self._conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                    merged += self._conn.execute(
+                        "DELETE FROM runs WHERE status = 'noop' AND record_id = ? AND ts >= ? AND ts < ?"
+                        " AND id != ?", (*bounds, last_id)).rowcount
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_compact', ?)",
+                                   (str(now),))
+            self._conn.execute("PRAGMA incremental_vacuum")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if expired or merged:
+            logger.info(f"运行历史压缩完成: 合并 {merged} 行无变化记录，删除 {expired} 行过期记录")
+        return {"merged": merged, "expired": expired}
+
+    def maybe_compact(self):
+        """距离上次压缩超过 compact_interval 时执行压缩"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'last_compact'").fetchone()
+        if row is None or time.time() - float(row[0]) >= self.compact_interval:
+            self.compact()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_history_store: Optional[HistoryStore] = None
+_history_store_lock = threading.Lock()
+
+
+def get_history_store(config: Optional[Dict[str, Any]]) -> Optional[HistoryStore]:
+    """根据配置返回运行历史存储，未启用时返回None"""
+    global _history_store
+    history_cfg = (config or {}).get("history") or {}
+    if not history_cfg.get("enabled"):
+        return None
+    path = history_cfg.get("path", DEFAULT_HISTORY_PATH)
+    with _history_store_lock:
+        if _history_store is None or _history_store.path != path:
+            if _history_store is not None:
+                _history_store.close()
+            _history_store = HistoryStore(path)
+        _history_store.raw_days = float(history_cfg.get("raw_days", DEFAULT_HISTORY_RAW_DAYS))
+        _history_store.retention_days = float(history_cfg.get("retention_days", DEFAULT_HISTORY_RETENTION_DAYS))
+        _history_store.compact_interval = float(history_cfg.get("compact_interval",
+                                                                DEFAULT_HISTORY_COMPACT_INTERVAL))
+        return _history_store
+
+
+def record_history(results: List[Dict[str, Any]], config: Optional[Dict[str, Any]]):
+    """将一批结果写入运行历史（未启用时什么也不做，失败不影响更新流程）"""
+    try:
+        store = get_history_store(config)
+        if store is not None:
+            store.append(results)
+            store.maybe_compact()
+    except Exception as e:
+        logger.error(f"写入运行历史失败: {e}")
+
+
+def parse_time_arg(value: Any) -> Optional[float]:
+    """
+    解析时间参数，返回时间戳
+
+    支持相对时长（30m、12h、7d，表示距今）、日期或日期时间（2024-05-01、2024-05-01T08:00）以及时间戳。
+    """
+    if value in (None, ""):
+        return None
+    text = str(value).strip()
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+    if text[-1:].lower() in units and text[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(text[:-1]) * units[text[-1].lower()]
     try:
-        # 如果响应是字符串格式的字典，先转换为真正的字典
-        if isinstance(response_str, str):
-            # 使用ast安全地解析字符串格式的字典
-            response_dict = ast.literal_eval(response_str)
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+def query_history(config: Dict[str, Any], record: Optional[str] = None, since: Any = None,
+                  until: Any = None, status: Optional[str] = None, limit: int = 100) -> Dict[str, Any]:
+    """查询运行历史（供命令行、控制接口使用）"""
+    store = get_history_store(config)
+    if store is None:
+        return {"error": "运行历史未启用（history.enabled）"}
+    since_ts, until_ts = parse_time_arg(since), parse_time_arg(until)
+    return {
+        "summary": store.summary(record, since_ts, until_ts),
+        "runs": store.query(record, since_ts, until_ts, status, limit),
+    }
+
+
+def show_history(args: List[str]):
+    """history [记录ID或名称] [时间范围，如 7d/30d]：显示运行历史"""
+    record = args[0] if args else None
+    since = args[1] if len(args) > 1 else "7d"
+    history = query_history(load_config(), record=record, since=since, limit=20)
+    if "error" in history:
+        cprint(history["error"], Colors.YELLOW)
+        return
+
+    cprint("\n" + "=" * 90, Colors.CYAN)
+    cprint(f"运行历史 ({record or '全部记录'}，{since} 内)", Colors.GREEN, bold=True)
+    cprint("=" * 90, Colors.CYAN)
+    status_colors = {"error": Colors.RED, "update_failed": Colors.RED, "updated": Colors.YELLOW}
+    for run in history["runs"]:
+        change = f"{run['old_value'] or '-'} -> {run['new_value']}" if run["new_value"] else (run["old_value"] or "-")
+        extra = f" x{run['count']}" if run["count"] > 1 else ""
+        cprint(f"{run['time']}  {run['record_id']:<20} {run['status'] + extra:<16} {change}"
+               f"{'  ' + run['error_code'] if run['error_code'] else ''}",
+               status_colors.get(run["status"], Colors.WHITE))
+    summary = ", ".join(f"{k}: {v}" for k, v in history["summary"].items()) or "无记录"
+    cprint("-" * 90, Colors.CYAN)
+    cprint(f"统计: {summary}", Colors.CYAN)
+
+
+class LeaseBackend:
+    """
+    租约后端
+
+    租约保存 持有者、过期时间、防护令牌（fencing token）以及持有者发布的记录值。
+    每次换人持有时令牌加一；写入前与发布前都会校验令牌，暂停后恢复的旧持有者
+    （例如进程被挂起超过租约时间）无法再写入。子类只需实现原子的读-改-写 _update。
+    """
+
+    def _update(self, name: str, fn) -> Dict[str, Any]:
+        """原子地读取租约、调用 fn(lease) 得到新租约并保存，返回新租约"""
+        raise NotImplementedError
+
+    def acquire(self, name: str, holder: str, ttl: float) -> Dict[str, Any]:
+        """尝试获取或续期租约，返回当前租约（holder 不是自己时表示处于备用状态）"""
+        def _acquire(lease: Dict[str, Any]) -> Dict[str, Any]:
+            now = time.time()
+            if lease.get("holder") == holder or lease.get("expires", 0) <= now:
+                if lease.get("holder") != holder:
+                    lease = {**lease, "holder": holder, "token": int(lease.get("token", 0)) + 1}
+                lease = {**lease, "expires": now + ttl}
+            return lease
+        return self._update(name, _acquire)
+
+    def validate(self, name: str, holder: str, token: int) -> bool:
+        """holder 仍以 token 持有未过期的租约"""
+        lease = self._update(name, lambda lease: lease)
+        return (lease.get("holder") == holder and lease.get("token") == token
+                and lease.get("expires", 0) > time.time())
+
+    def publish(self, name: str, holder: str, token: int, values: Dict[str, Dict[str, Any]]) -> bool:
+        """持有者发布已确认的记录值，供备用实例预热缓存；令牌不符时不发布"""
+        published = []
+
+        def _publish(lease: Dict[str, Any]) -> Dict[str, Any]:
+            if lease.get("holder") != holder or lease.get("token") != token:
+                return lease
+            published.append(True)
+            return {**lease, "values": {**(lease.get("values") or {}), **values}}
+        self._update(name, _publish)
+        return bool(published)
+
+    def release(self, name: str, holder: str):
+        """释放租约（保留令牌与已发布的记录值）"""
+        def _release(lease: Dict[str, Any]) -> Dict[str, Any]:
+            return {**lease, "expires": 0} if lease.get("holder") == holder else lease
+        self._update(name, _release)
+
+
+class MemoryLeaseBackend(LeaseBackend):
+    """进程内租约后端（同一进程内的多个实例，用于本地测试）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases: Dict[str, Dict[str, Any]] = {}
+
+    def _update(self, name: str, fn) -> Dict[str, Any]:
+        with self._lock:
+            lease = self._leases[name] = fn(dict(self._leases.get(name) or {}))
+            return dict(lease)
+
+
+class FileLeaseBackend(LeaseBackend):
+    """
+    文件租约后端（多台主机共享同一目录，如 NFS / 共享卷）
+
+    每个租约一个 JSON 文件，读-改-写期间对同名 .lock 文件加排他锁，保存时原子替换。
+    """
+
+    def __init__(self, path: str = DEFAULT_LEASE_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _update(self, name: str, fn) -> Dict[str, Any]:
+        lease_path = os.path.join(self.path, f"{name}.json")
+        with open(os.path.join(self.path, f"{name}.lock"), "a+b") as lock_file:
+            self._lock(lock_file)
+            try:
+                try:
+                    with open(lease_path, "r", encoding="utf-8") as f:
+                        lease = json.load(f)
+                except FileNotFoundError:
+                    lease = {}
+                except ValueError as e:
+                    logger.warning(f"租约文件 {lease_path} 损坏，将重新建立: {e}")
+                    lease = {}
+                updated = fn(dict(lease))
+                if updated != lease:
+                    atomic_write_text(lease_path, json.dumps(updated, ensure_ascii=False))
+                return updated
+            finally:
+                self._unlock(lock_file)
+
+    @staticmethod
+    def _lock(lock_file):
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+
+    @staticmethod
+    def _unlock(lock_file):
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
         else:
-            # 如果已经是字典，直接使用
-            response_dict = response_str
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
 
-        return response_dict
-    except (ValueError, SyntaxError, TypeError) as e:
-        logger.error(f"解析响应字符串失败: {e}")
-        # 尝试使用json解析
+
+LEASE_BACKENDS = {
+    "file": lambda cfg: FileLeaseBackend(cfg.get("path", DEFAULT_LEASE_PATH)),
+    "memory": lambda cfg: MemoryLeaseBackend(),
+}
+
+
+class Coordinator:
+    """
+    多实例协调：按租约决定由哪个实例写入记录
+
+    scope 为 global（所有记录一个租约）、shard（按记录ID哈希分为 shards 个租约）或
+    record（每条记录一个租约）。持有租约的实例正常检查并更新；备用实例不访问ESA，
+    只从租约中读取持有者发布的记录值预热本地状态缓存，持有者失效后可以直接接手。
+    """
+
+    def __init__(self, backend: LeaseBackend, instance_id: str, ttl: float = DEFAULT_LEASE_TTL,
+                 scope: str = "shard", shards: int = DEFAULT_LEASE_SHARDS):
+        if scope not in ("global", "shard", "record"):
+            raise ValueError(f"未知的协调范围: {scope}")
+        self.backend = backend
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self.scope = scope
+        self.shards = max(1, int(shards))
+        self._lock = threading.Lock()
+        # 租约名 -> 本实例持有的令牌
+        self._held: Dict[str, int] = {}
+
+    def lease_name(self, record_id: Any) -> str:
+        if self.scope == "global":
+            return "global"
+        if self.scope == "record":
+            return f"record-{record_id}"
+        return f"shard-{zlib.crc32(str(record_id).encode()) % self.shards}"
+
+    def partition(self, records: List[Dict[str, Any]]) -> tuple:
+        """
+        获取/续期本批记录涉及的租约
+
+        返回 (本实例负责的记录, [(备用记录, 租约)])；尚未解析出记录ID的记录由本实例处理（只会报错，不会写入）。
+        """
+        leases: Dict[str, Dict[str, Any]] = {}
+        leading, standby = [], []
+        for record in records:
+            if not record.get("record_id"):
+                leading.append(record)
+                continue
+            name = self.lease_name(record["record_id"])
+            if name not in leases:
+                leases[name] = self._acquire(name)
+            lease = leases[name]
+            if lease.get("holder") == self.instance_id:
+                leading.append(record)
+            else:
+                standby.append((record, lease))
+        return leading, standby
+
+    def _acquire(self, name: str) -> Dict[str, Any]:
+        try:
+            lease = self.backend.acquire(name, self.instance_id, self.ttl)
+        except Exception as e:
+            # 后端不可用时不写入，避免与其它实例重复写
+            logger.error(f"获取租约 {name} 失败: {e}")
+            lease = {"holder": None}
+        with self._lock:
+            was_held = name in self._held
+            if lease.get("holder") == self.instance_id:
+                self._held[name] = lease["token"]
+                if not was_held:
+                    logger.info(f"已获得租约 {name}（令牌 {lease['token']}），由本实例负责写入")
+            elif was_held:
+                del self._held[name]
+                logger.warning(f"租约 {name} 已由 {lease.get('holder')} 持有，本实例转为备用")
+        LEASES_HELD.set(1 if lease.get("holder") == self.instance_id else 0, lease=name)
+        return lease
+
+    def fenced(self, record_id: Any) -> bool:
+        """写入前校验：本实例仍以获取时的令牌持有该记录的租约"""
+        name = self.lease_name(record_id)
+        with self._lock:
+            token = self._held.get(name)
+        if token is None:
+            return False
         try:
-            # 将单引号替换为双引号以适应JSON格式
-            json_str = response_str.replace("'", '"').replace("False", "false").replace("True", "true")
-            return json.loads(json_str)
-        except Exception as json_e:
-            logger.error(f"JSON解析也失败: {json_e}")
-            return {}
+            return self.backend.validate(name, self.instance_id, token)
+        except Exception as e:
+            logger.error(f"校验租约 {name} 失败: {e}")
+            return False
+
+    def publish(self, results: List[Dict[str, Any]]):
+        """将本批已确认的记录值发布到各自的租约"""
+        grouped: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        now = time.time()
+        for result in results:
+            if result.get("error") or result.get("standby") or not result.get("record_id"):
+                continue
+            update_result = result.get("update_result") or {}
+            if result.get("update_performed"):
+                if not update_result.get("success"):
+                    continue
+                value = result.get("local_ip")
+            elif result.get("ip_changed"):
+                continue
+            else:
+                value = result.get("record_ip")
+            if value:
+                grouped.setdefault(self.lease_name(result["record_id"]), {})[str(result["record_id"])] = {
+                    "value": value, "confirmed_at": now, "record_name": result.get("record_name")}
+        for name, values in grouped.items():
+            with self._lock:
+                token = self._held.get(name)
+            if token is None:
+                continue
+            try:
+                if not self.backend.publish(name, self.instance_id, token, values):
+                    logger.warning(f"租约 {name} 已失效，未发布记录值")
+            except Exception as e:
+                logger.error(f"发布记录值到租约 {name} 失败: {e}")
+
+    def release_all(self):
+        """释放本实例持有的全部租约（服务退出时调用，其它实例无需等待租约过期）"""
+        with self._lock:
+            names, self._held = list(self._held), {}
+        for name in names:
+            try:
+                self.backend.release(name, self.instance_id)
+                LEASES_HELD.set(0, lease=name)
+            except Exception as e:
+                logger.error(f"释放租约 {name} 失败: {e}")
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"instance_id": self.instance_id, "scope": self.scope, "held": sorted(self._held)}
+
+
+def standby_results(standby: List[tuple], state_cache: Optional[RecordStateCache]) -> List[Dict[str, Any]]:
+    """备用记录的结果：使用持有者发布的记录值，并写入本地状态缓存"""
+    results = []
+    for record, lease in standby:
+        published = (lease.get("values") or {}).get(str(record["record_id"])) or {}
+        if state_cache is not None and published.get("value"):
+            state_cache.confirm(record["record_id"], published["value"], None,
+                                published.get("record_name"), confirmed_at=published.get("confirmed_at"))
+        results.append({"record_id": record["record_id"],
+                        "record_name": published.get("record_name") or record.get("name"),
+                        "local_ip": "", "record_ip": published.get("value", ""), "ip_changed": False,
+                        "update_performed": False, "update_result": None,
+                        "standby": True, "leader": lease.get("holder")})
+    return results
+
+
+DEFAULT_INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+_coordinator: Optional[Coordinator] = None
+_coordinator_key: Optional[tuple] = None
+_coordinator_lock = threading.Lock()
+
+
+def get_coordinator(config: Optional[Dict[str, Any]]) -> Optional[Coordinator]:
+    """根据配置返回多实例协调器，未启用时返回None（后端配置不变时复用，保留已持有的令牌）"""
+    global _coordinator, _coordinator_key
+    coord_cfg = (config or {}).get("coordination") or {}
+    if not coord_cfg.get("enabled"):
+        return None
+    backend = coord_cfg.get("backend", "file")
+    if backend not in LEASE_BACKENDS:
+        raise ValueError(f"未知的租约后端: {backend}")
+    key = (backend, coord_cfg.get("path", DEFAULT_LEASE_PATH), coord_cfg.get("instance_id", DEFAULT_INSTANCE_ID))
+    with _coordinator_lock:
+        if _coordinator is None or _coordinator_key != key:
+            if _coordinator is not None:
+                _coordinator.release_all()
+            _coordinator = Coordinator(LEASE_BACKENDS[backend](coord_cfg), key[2])
+            _coordinator_key = key
+        _coordinator.ttl = float(coord_cfg.get("ttl", DEFAULT_LEASE_TTL))
+        _coordinator.scope = coord_cfg.get("scope", "shard")
+        _coordinator.shards = max(1, int(coord_cfg.get("shards", DEFAULT_LEASE_SHARDS)))
+        return _coordinator
+
+
+def release_leases():
+    """释放本实例持有的租约"""
+    if _coordinator is not None:
+        _coordinator.release_all()
 
 
-def get_record_info(record_id: int) -> Dict[str, Any]:
+# 修改run_ddns_update函数，添加颜色输出
+def run_ddns_update(record_ids: Optional[List[Any]] = None, auto_update: bool = True) -> List[Dict[str, Any]]:
     """
-    获取域名记录详细信息
+    执行DDNS更新任务，返回每条记录的结果
+
+    record_ids 为空时更新全部记录；auto_update=False 时只检查不更新（试运行）。
     """
-    client = create_client()
-    get_record_request = esa20240910_models.GetRecordRequest(record_id=record_id)
-    runtime = util_models.RuntimeOptions()
+    if _tracer is None and _profiler is None and _memory_tracker is None:
+        return _run_ddns_update(record_ids, auto_update)
+    with instrumented_cycle(auto_update) as cycle_span:
+        results = _run_ddns_update(record_ids, auto_update)
+        if cycle_span is not None:
+            cycle_span.set("ddns.records", len(results))
+            cycle_span.set("ddns.errors", sum(1 for r in results if "error" in r))
+        return results
+
+
+def _run_ddns_update(record_ids: Optional[List[Any]], auto_update: bool) -> List[Dict[str, Any]]:
+    global last_results
+    try:
+        config = load_config()
+        records = get_configured_records(config)
+        if record_ids is not None:
+            wanted = {str(r) for r in record_ids}
+            records = [r for r in records
+                       if str(r.get("record_id")) in wanted or str(r.get("name")) in wanted]
+
+        # 执行DDNS更新
+        fleet = bool(config.get("accounts"))
+        if fleet:
+            results = run_fleet_update(records, config, auto_update=auto_update)
+        else:
+            results = run_batch_update(records, config, auto_update=auto_update)
+        if auto_update and record_ids is None:
+            last_results = results
+
+        # 记录结果
+        if len(results) == 1 and not fleet:
+            print_result_summary(results[0])
+        else:
+            print_result_table(results)
+            if fleet:
+                print_fleet_summary(results)
+        return results
 
+    except Exception as e:
+        cprint(f"执行DDNS更新时发生错误: {e}", Colors.RED, bold=True)
+        logger.error(f"执行DDNS更新时发生错误: {e}")
+        return []
+
+
+# 保留原有函数（未修改部分保持不变）
+DEFAULT_ESA_ENDPOINT = "esa.cn-hangzhou.aliyuncs.com"
+
+
+def esa_endpoint(aliyun_cfg: Dict[str, Any]) -> str:
+    """账号使用的ESA接入点：显式配置的 endpoint，否则按区域推导"""
+    if aliyun_cfg.get("endpoint"):
+        return aliyun_cfg["endpoint"]
+    region = aliyun_cfg.get("region")
+    return f"esa.{region}.aliyuncs.com" if region else DEFAULT_ESA_ENDPOINT
+
+# 配置结构：每一项为 {type, required, choices, min, check, fields, items, values}
+# fields 为固定键的子结构，items 为列表元素的结构，values 为任意键映射的值结构
+_NUMBER = (int, float)
+_TOGGLE = {"enabled": {"type": bool}}
+_RATE = {"type": dict, "fields": {"rate": {"type": _NUMBER, "required": True, "min": 0},
+                                  "burst": {"type": _NUMBER, "min": 1}}}
+_RATE_LIMIT_FIELDS = {"default": _RATE, "actions": {"type": dict, "values": _RATE}}
+_PROVIDER_LIST = {"type": list, "items": {"type": dict, "fields": {
+    "name": {"type": str},
+    "url": {"type": str, "required": True},
+    "parser": {"type": str, "choices": ("text", "json", "header")},
+    "path": {"type": str},
+    "header": {"type": str},
+    "timeout": {"type": _NUMBER, "min": 0},
+}}}
+_PROVIDER_FIELDS = {
+    "providers": _PROVIDER_LIST,
+    "timeout": {"type": _NUMBER, "min": 0},
+    "hedge_delay": {"type": _NUMBER, "min": 0},
+    "quorum": {"type": int, "min": 1},
+}
+_ALIYUN_FIELDS = {
+    "access_key_id": {"type": str},
+    "access_key_secret": {"type": str},
+    "region": {"type": str},
+    "endpoint": {"type": str},
+    "protocol": {"type": str, "choices": ("http", "https", "HTTP", "HTTPS")},
+}
+
+
+def _check_record_item(item: Any):
+    if isinstance(item, dict) and not item.get("record_id") \
+            and not (item.get("name") and (item.get("site_id") or item.get("site"))):
+        raise ValueError("需要 record_id，或 name 与 site_id/site")
+
+
+_RECORD_ITEM = {"type": (int, str, dict), "check": _check_record_item, "fields": {
+    "record_id": {"type": (int, str)},
+    "site_id": {"type": (int, str)},
+    "site": {"type": str},
+    "name": {"type": str},
+    "type": {"type": str, "choices": ("A", "AAAA", "a", "aaaa")},
+    "cron": {"type": str, "check": CronExpression},
+    "interval": {"type": _NUMBER, "min": 0.001},
+    "jitter": {"type": _NUMBER, "min": 0},
+}}
+
+CONFIG_SCHEMA: Dict[str, Dict[str, Any]] = {
+    "aliyun": {"type": dict, "fields": {**_ALIYUN_FIELDS, "record_id": {"type": (int, str)}}},
+    "record_id": {"type": (int, str)},
+    "records": {"type": list, "items": _RECORD_ITEM},
+    "accounts": {"type": list, "items": {"type": dict, "fields": {
+        **_ALIYUN_FIELDS,
+        "name": {"type": (str, int)},
+        "records": {"type": list, "items": _RECORD_ITEM},
+        "rate_limit": {"type": dict, "fields": _RATE_LIMIT_FIELDS},
+    }}},
+    "batch": {"type": dict, "fields": {
+        "max_workers": {"type": int, "min": 1},
+        "bulk_compare": {"type": bool},
+        "page_size": {"type": int, "min": 1},
+        "call_timeout": {"type": _NUMBER, "min": 0.001},
+    }},
+    "fleet": {"type": dict, "fields": {
+        "mode": {"type": str, "choices": ("thread", "process")},
+        "workers": {"type": int, "min": 1},
+    }},
+    "schedule": {"type": dict, "fields": {
+        "cron": {"type": str, "check": CronExpression},
+        "interval": {"type": _NUMBER, "min": 0.001},
+        "jitter": {"type": _NUMBER, "min": 0},
+    }},
+    "state_cache": {"type": dict, "fields": {
+        **_TOGGLE, "path": {"type": str}, "revalidate_ttl": {"type": _NUMBER, "min": 0}}},
+    "record_index": {"type": dict, "fields": {
+        "path": {"type": str}, "ttl": {"type": _NUMBER, "min": 0}, "scan_threshold": {"type": int, "min": 1}}},
+    "history": {"type": dict, "fields": {
+        **_TOGGLE, "path": {"type": str}, "raw_days": {"type": _NUMBER, "min": 0},
+        "retention_days": {"type": _NUMBER, "min": 0}, "compact_interval": {"type": _NUMBER, "min": 0}}},
+    "coordination": {"type": dict, "fields": {
+        **_TOGGLE,
+        "backend": {"type": str, "choices": ("file", "memory")},
+        "path": {"type": str},
+        "scope": {"type": str, "choices": ("global", "shard", "record")},
+        "shards": {"type": int, "min": 1},
+        "ttl": {"type": _NUMBER, "min": 1},
+        "instance_id": {"type": str},
+    }},
+    "write_coalescing": {"type": dict, "fields": {"stabilize_seconds": {"type": _NUMBER, "min": 0}}},
+    "ip_providers": {"type": dict, "fields": _PROVIDER_FIELDS},
+    "ipv6": {"type": dict, "fields": {
+        **_PROVIDER_FIELDS,
+        "source": {"type": str, "choices": ("providers", "interface")},
+        "interface": {"type": str},
+        "suffix": {"type": str},
+        "prefix_length": {"type": int, "min": 0},
+    }},
+    "dual_stack": {"type": dict, "fields": _TOGGLE},
+    "watcher": {"type": dict, "fields": {
+        **_TOGGLE,
+        "mode": {"type": str, "choices": ("auto", "netlink", "poll")},
+        "debounce": {"type": _NUMBER, "min": 0},
+        "poll_interval": {"type": _NUMBER, "min": 0.1},
+    }},
+    "resilience": {"type": dict, "fields": {
+        "max_attempts": {"type": int, "min": 1},
+        "base_delay": {"type": _NUMBER, "min": 0},
+        "max_delay": {"type": _NUMBER, "min": 0},
+        "failure_threshold": {"type": int, "min": 1},
+        "reset_timeout": {"type": _NUMBER, "min": 0},
+        "auth_reset_timeout": {"type": _NUMBER, "min": 0},
+        "retry_budget_ratio": {"type": _NUMBER, "min": 0},
+        "retry_budget_capacity": {"type": _NUMBER, "min": 0},
+    }},
+    "rate_limit": {"type": dict, "fields": {
+        **_RATE_LIMIT_FIELDS,
+        "accounts": {"type": dict, "values": {"type": dict, "fields": _RATE_LIMIT_FIELDS}},
+    }},
+    "logging": {"type": dict, "fields": {
+        "level": {"type": str},
+        "file": {"type": str},
+        "format": {"type": str, "choices": ("text", "json")},
+        "rotate": {"type": str, "choices": ("size", "time", "none")},
+        "max_bytes": {"type": int, "min": 0},
+        "backup_count": {"type": int, "min": 0},
+        "when": {"type": str},
+        "compress": {"type": bool},
+        "async_console": {"type": bool},
+    }},
+    "metrics": {"type": dict, "fields": {**_TOGGLE, "host": {"type": str}, "port": {"type": int, "min": 0}}},
+    "control": {"type": dict, "fields": {
+        **_TOGGLE, "host": {"type": str}, "port": {"type": int, "min": 0},
+        "unix_socket": {"type": str}, "token": {"type": str}}},
+    "config_reload": {"type": dict, "fields": {**_TOGGLE, "poll_interval": {"type": _NUMBER, "min": 0.1}}},
+    "propagation": {"type": dict, "fields": {
+        **_TOGGLE,
+        "nameservers": {"type": list, "items": {"type": str}},
+        "timeout": {"type": _NUMBER, "min": 0.01},
+        "deadline": {"type": _NUMBER, "min": 0},
+        "interval": {"type": _NUMBER, "min": 0.01},
+        "retries": {"type": int, "min": 0},
+    }},
+    "profiling": {"type": dict, "fields": {
+        "cycles": {"type": int, "min": 0},
+        "dir": {"type": str},
+        "trace_file": {"type": str},
+        "memory": {"type": bool},
+        "memory_top": {"type": int, "min": 1},
+    }},
+}
+
+_TYPE_NAMES = {dict: "映射", list: "列表", str: "字符串", bool: "布尔值", int: "整数", float: "数字"}
+
+
+class ConfigError(ValueError):
+    """配置文件无法解析或未通过校验"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def _validate_value(value: Any, spec: Dict[str, Any], path: str, errors: List[str], warnings: List[str]):
+    expected = spec.get("type")
+    if expected is not None:
+        types = expected if isinstance(expected, tuple) else (expected,)
+        # YAML 中的 true/false 不能当作数字
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            names = "或".join(dict.fromkeys(_TYPE_NAMES.get(t, t.__name__) for t in types))
+            errors.append(f"{path}: 应为{names}，实际为 {type(value).__name__}")
+            return
+    if "choices" in spec and value not in spec["choices"]:
+        errors.append(f"{path}: 取值应为 {'/'.join(map(str, spec['choices']))} 之一，实际为 {value!r}")
+    if "min" in spec and isinstance(value, _NUMBER) and value < spec["min"]:
+        errors.append(f"{path}: 不能小于 {spec['min']}")
+    if "check" in spec:
+        try:
+            spec["check"](value)
+        except ValueError as e:
+            errors.append(f"{path}: {e}")
+    if isinstance(value, dict):
+        fields = spec.get("fields")
+        if fields is not None:
+            for key, field_spec in fields.items():
+                child = f"{path}.{key}" if path else key
+                if value.get(key) is None:
+                    if field_spec.get("required"):
+                        errors.append(f"{child}: 缺少必填项")
+                    continue
+                _validate_value(value[key], field_spec, child, errors, warnings)
+            for key in value:
+                if key not in fields:
+                    warnings.append(f"{path + '.' if path else ''}{key}: 未知的配置项，已忽略")
+        if "values" in spec:
+            for key, item in value.items():
+                _validate_value(item, spec["values"], f"{path}.{key}", errors, warnings)
+    if isinstance(value, list) and "items" in spec:
+        for i, item in enumerate(value):
+            _validate_value(item, spec["items"], f"{path}[{i}]", errors, warnings)
+
+
+def validate_config(config: Any) -> tuple:
+    """按 CONFIG_SCHEMA 校验配置，返回 (错误列表, 警告列表)"""
+    errors: List[str] = []
+    warnings: List[str] = []
+    if not isinstance(config, dict):
+        return [f"配置文件的顶层应为映射，实际为 {type(config).__name__}"], warnings
+    _validate_value(config, {"type": dict, "fields": CONFIG_SCHEMA}, "", errors, warnings)
+    if errors:
+        return errors, warnings
+
+    # 凭证与区域：多账号模式下按账号合并顶层 aliyun 后检查
+    aliyun_cfg = config.get("aliyun") or {}
+    accounts = config.get("accounts") or []
+    targets = [(f"accounts[{i}]", {**aliyun_cfg, **account}) for i, account in enumerate(accounts)] \
+        if accounts else [("aliyun", aliyun_cfg)]
+    for path, cfg in targets:
+        for key in ("access_key_id", "access_key_secret", "region"):
+            if not cfg.get(key):
+                errors.append(f"{path}.{key}: 缺少必填项")
+    if not accounts and not (config.get("records") or config.get("record_id") or aliyun_cfg.get("record_id")):
+        errors.append("records: 没有需要更新的记录")
+    propagation_cfg = config.get("propagation") or {}
+    if propagation_cfg.get("enabled") and not propagation_cfg.get("nameservers"):
+        errors.append("propagation.nameservers: 开启传播检查时需要配置要查询的域名服务器")
+    names = [str(account.get("name") or f"account-{i + 1}") for i, account in enumerate(accounts)]
+    for name in {n for n in names if names.count(n) > 1}:
+        errors.append(f"accounts: 账号名称重复: {name}")
+    return errors, warnings
+
+
+class FrozenDict(dict):
+    """只读字典（配置快照），任何修改都会抛出 TypeError"""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("配置快照是只读的，请先复制再修改")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        # 多进程模式下需要序列化传给工作进程
+        return FrozenDict, (dict(self),)
+
+
+def freeze_config(value: Any) -> Any:
+    """将解析出的配置递归转换为只读结构（映射 -> FrozenDict，列表 -> tuple）"""
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze_config(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(freeze_config(item) for item in value)
+    return value
+
+
+class ConfigChange:
+    """一次配置变化：新旧快照与发生变化的顶层配置段"""
+
+    def __init__(self, old: Dict[str, Any], new: Dict[str, Any]):
+        self.old = old
+        self.new = new
+        self.sections = frozenset(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+    def touches(self, *sections: str) -> bool:
+        return not self.sections.isdisjoint(sections)
+
+
+class ConfigManager:
+    """
+    配置管理
+
+    按 mtime/size 监视配置文件，变化时只解析并校验一次，然后原子地替换为只读快照；
+    监视线程运行时 snapshot() 不访问文件。文件无法解析或未通过校验（例如编辑到一半）时
+    保留上一份快照并记录错误。快照替换后按订阅的配置段通知各依赖方。
+    """
+
+    def __init__(self, path: str = "config.yml", poll_interval: float = DEFAULT_CONFIG_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._snapshot: Optional[FrozenDict] = None
+        self._stamp: Optional[tuple] = None
+        self._errors: List[str] = []
+        self._subscribers: List[tuple] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def snapshot(self) -> FrozenDict:
+        """当前配置快照；未启动监视时先检查文件是否变化"""
+        if self._snapshot is None or self._thread is None:
+            self.refresh(raise_errors=self._snapshot is None)
+        if self._snapshot is None:
+            # 文件未修改，仍是上次未通过校验的内容
+            raise ConfigError(self._errors)
+        return self._snapshot
+
+    def refresh(self, raise_errors: bool = False) -> bool:
+        """文件变化时重新加载，返回是否替换了快照"""
+        with self._lock:
+            try:
+                st = os.stat(self.path)
+                stamp = (st.st_mtime_ns, st.st_size)
+                if stamp == self._stamp:
+                    return False
+                with open(self.path, "r", encoding="utf-8") as f:
+                    raw = yaml.safe_load(f)
+                st = os.stat(self.path)
+                if (st.st_mtime_ns, st.st_size) != stamp:
+                    # 读取期间文件仍在写入，下次检查时再加载
+                    if not raise_errors:
+                        return False
+                errors, warnings = validate_config(raw)
+                if errors:
+                    raise ConfigError(errors)
+            except Exception as e:
+                self._errors = e.errors if isinstance(e, ConfigError) else [str(e)]
+                if isinstance(e, (ConfigError, yaml.YAMLError)):
+                    # 同一份无效内容只报告一次
+                    self._stamp = stamp
+                    CONFIG_RELOADS.inc(result="invalid")
+                if raise_errors:
+                    raise
+                logger.error(f"配置文件 {self.path} 无效，继续使用上一份配置: {e}")
+                return False
+            for warning in warnings:
+                logger.warning(f"配置文件 {self.path}: {warning}")
+            old, self._snapshot, self._stamp = self._snapshot, freeze_config(raw), stamp
+            new = self._snapshot
+        if old is not None:
+            CONFIG_RELOADS.inc(result="applied")
+            self._notify(ConfigChange(old, new))
+        return True
+
+    def subscribe(self, callback, sections: Optional[tuple] = None):
+        """配置变化时调用 callback(change)；指定 sections 时只在这些配置段变化时调用"""
+        self._subscribers.append((callback, sections))
+
+    def _notify(self, change: ConfigChange):
+        if not change.sections:
+            return
+        logger.info(f"配置文件已重新加载，变化的配置段: {', '.join(sorted(change.sections))}")
+        for callback, sections in list(self._subscribers):
+            if sections is not None and not change.touches(*sections):
+                continue
+            try:
+                callback(change)
+            except Exception as e:
+                logger.error(f"应用配置变化失败（{getattr(callback, '__name__', callback)}）: {e}")
+
+    def start(self):
+        """启动监视线程"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="config-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout=5)
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            self.refresh()
+
+
+_config_managers: Dict[str, ConfigManager] = {}
+_config_managers_lock = threading.Lock()
+
+
+def get_config_manager(config_path: str = "config.yml") -> ConfigManager:
+    """返回指定配置文件的配置管理器"""
+    with _config_managers_lock:
+        manager = _config_managers.get(config_path)
+        if manager is None:
+            manager = _config_managers[config_path] = ConfigManager(config_path)
+        return manager
+
+
+def load_config(config_path: str = "config.yml") -> Dict[str, Any]:
+    """返回当前配置快照（只读）；首次加载失败时抛出异常"""
     try:
-        resp = client.get_record_with_options(get_record_request, runtime)
+        return get_config_manager(config_path).snapshot()
+    except Exception as e:
+        logger.error(f"加载配置文件失败: {e}")
+        raise
+
+
+class ESAClientRegistry:
+    """
+    ESA客户端注册表
+
+    按 (凭证, 区域, 接入点) 构建并长期复用 ESA20240910Client，
+    同一个客户端在多个周期之间共享其HTTP连接池，只有当配置中的凭证、
+    区域或接入点真正发生变化时才会重建。
+    """
 
-        # 将响应转换为字典格式
-        # 先检查是否有to_map()方法
-        if hasattr(resp, 'to_map'):
-            resp_dict = resp.to_map()
-        elif hasattr(resp, '__dict__'):
-            resp_dict = resp.__dict__
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (fingerprint, client)
+        self._clients: Dict[str, Any] = {}
+        # id(client) -> name
+        self._accounts: Dict[int, str] = {}
+
+    @staticmethod
+    def fingerprint(aliyun_cfg: Dict[str, Any]) -> tuple:
+        """计算客户端指纹，密钥只保留摘要，避免明文常驻内存中的字典键"""
+        secret = str(aliyun_cfg.get("access_key_secret", ""))
+        return (
+            str(aliyun_cfg.get("access_key_id", "")),
+            hashlib.sha256(secret.encode("utf-8")).hexdigest(),
+            aliyun_cfg.get("region"),
+            esa_endpoint(aliyun_cfg),
+            aliyun_cfg.get("protocol"),
+        )
+
+    @staticmethod
+    def _build(aliyun_cfg: Dict[str, Any]) -> ESA20240910Client:
+        from alibabacloud_esa20240910.client import Client as ESA20240910Client
+        from alibabacloud_credentials.client import Client as CredClient
+        from alibabacloud_credentials.models import Config as CredConfig
+
+        cred_cfg = CredConfig(
+            type="access_key",
+            access_key_id=aliyun_cfg["access_key_id"],
+            access_key_secret=aliyun_cfg["access_key_secret"]
+        )
+        cred_client = CredClient(cred_cfg)
+
+        config = open_api_models.Config(
+            credential=cred_client,
+            region_id=aliyun_cfg["region"],
+            endpoint=esa_endpoint(aliyun_cfg)
+        )
+        if aliyun_cfg.get("protocol"):
+            config.protocol = aliyun_cfg["protocol"]
+
+        return ESA20240910Client(config)
+
+    def get(self, aliyun_cfg: Dict[str, Any], name: str = "default") -> ESA20240910Client:
+        """获取（必要时构建）指定账号的客户端"""
+        key = self.fingerprint(aliyun_cfg)
+        with self._lock:
+            cached = self._clients.get(name)
+            if cached and cached[0] == key:
+                return cached[1]
+            with span("esa.create_client", {"ddns.account": name}):
+                client = self._build(aliyun_cfg)
+            if cached:
+                self._accounts.pop(id(cached[1]), None)
+                logger.info(f"检测到账号 {name} 的凭证或接入点发生变化，重建ESA客户端")
+                # 旧凭证触发的熔断不应影响新凭证
+                get_resilience().reset(esa_breaker_key(name, client))
+            self._clients[name] = (key, client)
+            self._accounts[id(client)] = name
+            return client
+
+    def account_of(self, client: Any) -> str:
+        """返回客户端所属的账号名"""
+        with self._lock:
+            return self._accounts.get(id(client), "default")
+
+    def clear(self):
+        """丢弃所有缓存的客户端"""
+        with self._lock:
+            self._clients.clear()
+            self._accounts.clear()
+
+    def retain(self, names: set):
+        """只保留指定账号的客户端（账号从配置中删除后释放其客户端）"""
+        with self._lock:
+            for name in [n for n in self._clients if n not in names]:
+                _, client = self._clients.pop(name)
+                self._accounts.pop(id(client), None)
+                logger.info(f"账号 {name} 已从配置中删除，释放其ESA客户端")
+
+
+client_registry = ESAClientRegistry()
+
+
+def create_client(cfg: Optional[Dict[str, Any]] = None) -> ESA20240910Client:
+    """获取阿里云ESA客户端（复用注册表中已构建的客户端）"""
+    if cfg is None:
+        cfg = load_config()
+    return client_registry.get(cfg["aliyun"], cfg.get("account", "default"))
+
+
+class IPProvider:
+    """
+    公网IP提供方
+
+    由 URL 和响应解析方式组成，parser 取值：
+      - text:   响应体即为IP
+      - json:   按 path（以点分隔，如 data.ip）从JSON中取值
+      - header: 从响应头 header 中取值
+    """
+
+    def __init__(self, name: str, url: str, parser: str = "text", path: Optional[str] = None,
+                 header: Optional[str] = None, timeout: float = DEFAULT_IP_PROVIDER_TIMEOUT,
+                 family: Optional[int] = None):
+        if parser not in ("text", "json", "header"):
+            raise ValueError(f"IP提供方 {name} 的解析方式无效: {parser}")
+        self.name = name
+        self.url = url
+        self.parser = parser
+        self.path = path
+        self.header = header
+        self.timeout = timeout
+        # 4 或 6 时只接受对应协议族的答案
+        self.family = family
+
+    @classmethod
+    def from_config(cls, item: Dict[str, Any], timeout: float, family: Optional[int] = None) -> "IPProvider":
+        return cls(
+            name=item.get("name") or item["url"],
+            url=item["url"],
+            parser=item.get("parser", "text"),
+            path=item.get("path"),
+            header=item.get("header"),
+            timeout=float(item.get("timeout", timeout)),
+            family=family,
+        )
+
+    def parse(self, text: str, headers: Dict[str, str]) -> str:
+        """按配置的解析方式从响应（正文与小写的响应头）中提取IP，并校验其格式"""
+        if self.parser == "header":
+            value = headers.get((self.header or "").lower(), "")
+        elif self.parser == "json":
+            value = json.loads(text)
+            for key in (self.path or "").split("."):
+                if not key:
+                    continue
+                if isinstance(value, list):
+                    value = value[int(key)]
+                else:
+                    value = value.get(key) if isinstance(value, dict) else None
         else:
-            # 尝试转换为字符串然后解析
-            resp_str = str(resp)
-            resp_dict = parse_response_string(resp_str)
+            value = text
+
+        value = str(value or "").strip()
+        # 校验IP格式，无效答案不能参与竞速
+        address = ipaddress.ip_address(value)
+        if self.family and address.version != self.family:
+            raise ValueError(f"返回的 {address} 不是IPv{self.family}地址")
+        return str(address)
+
+    async def fetch(self) -> str:
+        with span("ip_provider.fetch", {"ddns.provider": self.name, "http.url": self.url}, SPAN_KIND_CLIENT):
+            status, headers, text = await asyncio.wait_for(http_get_async(self.url), self.timeout)
+        if status >= 400:
+            raise ConnectionError(f"HTTP {status}")
+        return self.parse(text, headers)
+
+
+def _http_proxy(parts: urllib.parse.SplitResult) -> Optional[urllib.parse.SplitResult]:
+    """按 HTTP(S)_PROXY / NO_PROXY 环境变量返回访问该URL应使用的代理，不使用代理时返回None"""
+    # 只在实际发起请求时导入，单次模式的缓存命中路径不需要
+    import urllib.request
+    proxy = urllib.request.getproxies().get(parts.scheme)
+    if not proxy or urllib.request.proxy_bypass(parts.hostname or ""):
+        return None
+    return urllib.parse.urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+
+
+def _proxy_auth_header(proxy: urllib.parse.SplitResult) -> str:
+    if not proxy.username:
+        return ""
+    credentials = f"{urllib.parse.unquote(proxy.username)}:{urllib.parse.unquote(proxy.password or '')}"
+    return f"Proxy-Authorization: Basic {base64.b64encode(credentials.encode()).decode()}\r\n"
 
-        return resp_dict
-    except Exception as error:
-        # 可以记录日志或抛出更具体的异常
-        error_msg = getattr(error, 'message', str(error))
-        logger.error(f"获取记录信息失败: {error_msg}")
 
-        if hasattr(error, 'data') and error.data:
-            logger.error(f"诊断地址: {error.data.get('Recommend', '无')}")
-        raise error
+async def _proxy_tunnel(proxy: urllib.parse.SplitResult, authority: str) -> socket.socket:
+    """通过HTTP代理的 CONNECT 建立到 authority 的隧道，返回已连接的套接字"""
+    loop = asyncio.get_running_loop()
+    family, type_, proto, _, address = (await loop.getaddrinfo(proxy.hostname, proxy.port or 80,
+                                                               type=socket.SOCK_STREAM))[0]
+    sock = socket.socket(family, type_, proto)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, address)
+        await loop.sock_sendall(sock, (f"CONNECT {authority} HTTP/1.1\r\nHost: {authority}\r\n"
+                                       f"{_proxy_auth_header(proxy)}\r\n").encode())
+        head = b""
+        while b"\r\n\r\n" not in head:
+            chunk = await loop.sock_recv(sock, 4096)
+            if not chunk or len(head) > IP_PROVIDER_MAX_RESPONSE:
+                raise ConnectionError(f"代理 {proxy.hostname} 未完成 CONNECT 握手")
+            head += chunk
+        status_line = head.split(b"\r\n", 1)[0].decode("iso-8859-1")
+        if status_line.split()[1:2] != ["200"]:
+            raise ConnectionError(f"代理 {proxy.hostname} 拒绝 CONNECT: {status_line}")
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def _read_limited(reader: asyncio.StreamReader, limit: int) -> bytes:
+    """读到连接关闭为止，超过 limit 字节时放弃"""
+    data = bytearray()
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            return bytes(data)
+        data += chunk
+        if len(data) > limit:
+            raise ConnectionError(f"响应超过 {limit} 字节")
 
 
-def extract_record_data(response: Dict[str, Any]) -> Dict[str, Any]:
+async def http_get_async(url: str, max_redirects: int = 3) -> tuple:
     """
-    从响应中提取关键信息
+    最简单的异步 HTTP GET，返回 (状态码, 小写的响应头, 正文)
+
+    只用于查询公网IP：HTTP/1.0 短连接，读到连接关闭为止（响应不超过 IP_PROVIDER_MAX_RESPONSE），
+    跟随有限次重定向。与 requests 一样遵循 HTTP(S)_PROXY / NO_PROXY 环境变量，
+    HTTPS 经代理的 CONNECT 隧道访问（只支持 http:// 代理）。
+    """
+    for _ in range(max_redirects + 1):
+        parts = urllib.parse.urlsplit(url)
+        https = parts.scheme == "https"
+        port = parts.port or (443 if https else 80)
+        context = ssl.create_default_context() if https else None
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        proxy = _http_proxy(parts)
+        extra_headers = ""
+        if proxy is None:
+            reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=context)
+        elif https:
+            host = f"[{parts.hostname}]" if ":" in parts.hostname else parts.hostname
+            sock = await _proxy_tunnel(proxy, f"{host}:{port}")
+            reader, writer = await asyncio.open_connection(sock=sock, ssl=context, server_hostname=parts.hostname)
+        else:
+            # 明文HTTP经代理时请求行使用完整URL
+            reader, writer = await asyncio.open_connection(proxy.hostname, proxy.port or 80)
+            path = urllib.parse.urlunsplit(parts._replace(fragment=""))
+            extra_headers = _proxy_auth_header(proxy)
+        try:
+            writer.write(f"GET {path} HTTP/1.0\r\nHost: {parts.netloc}\r\n{extra_headers}"
+                         f"User-Agent: Aliyun-ESA-DDNS\r\nAccept: */*\r\nConnection: close\r\n\r\n".encode())
+            await writer.drain()
+            raw = await _read_limited(reader, IP_PROVIDER_MAX_RESPONSE)
+        finally:
+            writer.close()
+            # 等待传输层（特别是TLS）关闭，避免遗留未关闭的连接
+            with contextlib.suppress(Exception):
+                await writer.wait_closed()
+        head, _, body = raw.partition(b"\r\n\r\n")
+        lines = head.decode("iso-8859-1").split("\r\n")
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if status in (301, 302, 303, 307, 308) and headers.get("location"):
+            url = urllib.parse.urljoin(url, headers["location"])
+            continue
+        return status, headers, body.decode("utf-8", errors="replace")
+    raise ConnectionError(f"重定向次数过多: {url}")
+
+
+class IPProviderPool:
     """
-    if not response:
-        return {}
+    并发竞速的公网IP查询
 
-    result = {}
+    按上一周期统计的延迟与失败情况排序，依次（间隔 hedge_delay 秒）发起请求，
+    最先获得 quorum 个一致答案的IP胜出，尚未开始的请求会被取消。
+    """
 
-    # 添加headers和statusCode
-    if "headers" in response:
-        result["headers"] = response.get("headers", {})
-    if "statusCode" in response:
-        result["statusCode"] = response.get("statusCode", 0)
+    def __init__(self, providers: List[IPProvider], hedge_delay: float = 0.0, quorum: int = 1):
+        if not providers:
+            raise ValueError("至少需要配置一个IP提供方")
+        self.providers = providers
+        self.hedge_delay = max(0.0, hedge_delay)
+        self.quorum = max(1, min(quorum, len(providers)))
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {
+            p.name: {"latency": 0.0, "successes": 0, "failures": 0, "consecutive_failures": 0}
+            for p in providers
+        }
 
-    # 添加body中的信息
-    body = response.get("body", {})
+    def _record(self, provider: IPProvider, latency: float, ok: bool):
+        with self._lock:
+            stats = self._stats[provider.name]
+            if ok:
+                # 指数加权平均延迟
+                stats["latency"] = latency if not stats["successes"] else 0.7 * stats["latency"] + 0.3 * latency
+                stats["successes"] += 1
+                stats["consecutive_failures"] = 0
+            else:
+                stats["failures"] += 1
+                stats["consecutive_failures"] += 1
+
+    def ranked(self) -> List[IPProvider]:
+        """按 (连续失败次数, 平均延迟) 排序的提供方列表"""
+        with self._lock:
+            stats = {name: dict(v) for name, v in self._stats.items()}
+        return sorted(self.providers,
+                      key=lambda p: (stats[p.name]["consecutive_failures"], stats[p.name]["latency"]))
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {name: dict(v) for name, v in self._stats.items()}
+
+    async def _query(self, provider: IPProvider) -> str:
+        breaker = get_resilience().breaker(f"ip:{provider.name}")
+        breaker.allow()
+        start = time.perf_counter()
+        try:
+            ip = await provider.fetch()
+        except Exception as e:
+            self._record(provider, time.perf_counter() - start, False)
+            # 响应内容无效不代表提供方不可用，只有网络/服务端错误计入熔断
+            breaker.record_failure("fatal" if isinstance(e, ValueError) else "retryable")
+            PROVIDER_FAILURES.inc(provider=provider.name)
+            logger.warning(f"IP提供方 {provider.name} 查询失败: {e}")
+            raise
+        breaker.record_success()
+        self._record(provider, time.perf_counter() - start, True)
+        return ip
+
+    async def lookup(self) -> str:
+        """返回胜出的公网IP，全部失败或未达到法定一致数时返回空字符串"""
+        queue = self.ranked()
+        owners: Dict[Any, IPProvider] = {}
+        pending = set()
+        votes: Dict[str, int] = {}
+        try:
+            while queue or pending:
+                if queue:
+                    provider = queue.pop(0)
+                    task = asyncio.ensure_future(self._query(provider))
+                    owners[task] = provider
+                    pending.add(task)
+                    # 尚有未发起的提供方时，最多等待 hedge_delay 秒再发起下一个
+                    timeout = self.hedge_delay if queue else None
+                else:
+                    timeout = None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        continue
+                    ip = task.result()
+                    votes[ip] = votes.get(ip, 0) + 1
+                    if votes[ip] >= self.quorum:
+                        logger.info(f"IP提供方 {owners[task].name} 返回 {ip}"
+                                    + (f" (一致数 {votes[ip]}/{self.quorum})" if self.quorum > 1 else ""))
+                        return ip
+            if votes:
+                logger.error(f"IP提供方答案不一致，未达到一致数 {self.quorum}: {votes}")
+            else:
+                logger.error("所有IP提供方均查询失败")
+            return ""
+        finally:
+            # 已有结果时取消其余仍在进行中的请求，并等待其结束
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
 
-    if not body:
-        return result
 
-    # 如果body中有RecordModel，则提取
-    if "RecordModel" in body:
-        record_model = body.get("RecordModel", {})
+DEFAULT_IP_PROVIDERS = [
+    {"name": "ipplus360", "url": "https://www.ipplus360.com/getIP", "parser": "json", "path": "data"},
+    {"name": "ipw", "url": "https://4.ipw.cn", "parser": "text"},
+    {"name": "ipify", "url": "https://api.ipify.org", "parser": "text"},
+]
+DEFAULT_IPV6_PROVIDERS = [
+    {"name": "ipw6", "url": "https://6.ipw.cn", "parser": "text"},
+    {"name": "ipify6", "url": "https://api6.ipify.org", "parser": "text"},
+]
 
-        # 复制所有RecordModel的字段到结果
-        for key, value in record_model.items():
-            if key not in ["__class__", "__dict__", "__weakref__"]:  # 排除Python内部属性
-                result[key] = value
+# 协议族 -> 记录类型
+IP_FAMILY_RECORD_TYPES = {4: "A", 6: "AAAA"}
 
-    # 添加RequestId
-    if "RequestId" in body:
-        result["RequestId"] = body.get("RequestId")
+_ip_provider_pools: Dict[Any, tuple] = {}
+_ip_provider_pool_lock = threading.Lock()
 
-    return result
+
+def get_ip_provider_pool(config: Optional[Dict[str, Any]] = None,
+                         family: Optional[int] = None) -> IPProviderPool:
+    """
+    根据配置返回IP提供方池，配置不变时复用（保留统计信息）
+
+    family=6 时使用 ipv6.providers 配置，其它情况使用 ip_providers 配置并只接受IPv4答案
+    （未指定协议族的调用与 family=4 共用同一个池及其统计）。
+    """
+    family = 6 if family == 6 else 4
+    if family == 6:
+        provider_cfg = ((config or {}).get("ipv6") or {})
+        defaults = DEFAULT_IPV6_PROVIDERS
+    else:
+        provider_cfg = (config or {}).get("ip_providers") or {}
+        defaults = DEFAULT_IP_PROVIDERS
+    key = json.dumps(provider_cfg, sort_keys=True, default=str)
+    with _ip_provider_pool_lock:
+        cached = _ip_provider_pools.get(family)
+        if cached is None or cached[0] != key:
+            timeout = float(provider_cfg.get("timeout", DEFAULT_IP_PROVIDER_TIMEOUT))
+            items = provider_cfg.get("providers") or defaults
+            pool = IPProviderPool(
+                [IPProvider.from_config(item, timeout, family) for item in items],
+                hedge_delay=float(provider_cfg.get("hedge_delay", DEFAULT_IP_HEDGE_DELAY)),
+                quorum=int(provider_cfg.get("quorum", 1)),
+            )
+            cached = _ip_provider_pools[family] = (key, pool)
+        return cached[1]
+
+
+def ip_family(value: Any) -> Optional[int]:
+    """返回IP地址的协议族（4或6），无效地址返回None"""
+    try:
+        return ipaddress.ip_address(str(value).strip()).version
+    except ValueError:
+        return None
+
+
+def get_interface_ipv6(ipv6_cfg: Dict[str, Any]) -> str:
+    """
+    从本机网卡获取IPv6地址
+
+    Linux 下读取 /proc/net/if_inet6，按 interface 过滤，优先选择非临时、未弃用的全局地址；
+    其它平台使用默认路由的出口地址。配置了 suffix 时，取地址的前 prefix_length 位
+    （运营商下发的前缀）与 suffix 的主机部分拼接，得到固定后缀的地址。
+    """
+    interface = ipv6_cfg.get("interface")
+    candidates = []
+    try:
+        with open("/proc/net/if_inet6", "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 6 or fields[3] != "00":
+                    continue
+                if interface and fields[5] != interface:
+                    continue
+                flags = int(fields[4], 16)
+                address = ipaddress.IPv6Address(int(fields[0], 16))
+                # IFA_F_TEMPORARY=0x01, IFA_F_DEPRECATED=0x20
+                candidates.append((bool(flags & 0x01), bool(flags & 0x20), address))
+    except (OSError, ValueError):
+        pass
+
+    if candidates:
+        candidates.sort(key=lambda c: (c[1], c[0]))
+        address = candidates[0][2]
+    else:
+        fallback = _route_source_address(socket.AF_INET6)
+        if not fallback:
+            return ""
+        address = ipaddress.IPv6Address(fallback)
+    if not address.is_global:
+        logger.warning(f"网卡上的IPv6地址 {address} 不是公网地址")
+
+    suffix = ipv6_cfg.get("suffix")
+    if suffix:
+        prefix_length = int(ipv6_cfg.get("prefix_length", 64))
+        host_mask = (1 << (128 - prefix_length)) - 1
+        suffix_value = int(ipaddress.IPv6Address(suffix))
+        address = ipaddress.IPv6Address((int(address) & ~host_mask) | (suffix_value & host_mask))
+    return str(address)
+
+
+def get_local_ip(config: Optional[Dict[str, Any]] = None, family: Optional[int] = None) -> str:
+    """
+    获取本机公网IP
+
+    family=6 时获取IPv6地址（来自网卡或IPv6提供方），否则获取IPv4地址。
+    get_local_ip_async 的同步封装（不能在事件循环内调用）。
+    """
+    return asyncio.run(get_local_ip_async(config, family))
+
+
+async def get_local_ip_async(config: Optional[Dict[str, Any]] = None, family: Optional[int] = None) -> str:
+    """获取本机公网IP（协程），各IP提供方在当前事件循环中竞速；未指定 family 时获取IPv4地址"""
+    family = 6 if family == 6 else 4
+    try:
+        if config is None:
+            try:
+                config = load_config()
+            except Exception:
+                config = {}
+
+        ipv6_cfg = config.get("ipv6") or {}
+        if family == 6 and ipv6_cfg.get("source") == "interface":
+            ip = get_interface_ipv6(ipv6_cfg)
+            if not ip:
+                logger.error("网卡上没有可用的IPv6地址")
+            return ip
+
+        pool = get_ip_provider_pool(config, family)
+
+        async def _lookup() -> str:
+            ip = await pool.lookup()
+            if not ip:
+                raise IPLookupError("所有IP提供方均未返回有效答案")
+            return ip
+
+        label = f"IPv{family}"
+        return await get_resilience(config).call_async("ip-lookup:6" if family == 6 else "ip-lookup", _lookup,
+                                                       description=f"{label}查询")
+    except IPLookupError:
+        return ""
+    except Exception as e:
+        logger.error(f"获取本机IP时发生未知错误: {e}")
+        return ""
+
+
+def get_local_ips(config: Dict[str, Any]) -> Dict[int, str]:
+    """双栈模式下并发获取IPv4与IPv6地址，返回 {4: ..., 6: ...}（失败的协议族为空字符串）"""
+    return asyncio.run(get_local_ips_async(config))
+
+
+async def get_local_ips_async(config: Dict[str, Any]) -> Dict[int, str]:
+    """get_local_ips 的协程版本"""
+    ipv4, ipv6 = await asyncio.gather(get_local_ip_async(config, 4), get_local_ip_async(config, 6))
+    return {4: ipv4, 6: ipv6}
+
+
+# 重试与熔断
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求被直接拒绝"""
+
+    def __init__(self, key: str, retry_in: float):
+        super().__init__(f"{key} 已熔断，{retry_in:.0f} 秒后重试")
+        self.code = "CircuitOpen"
+        self.message = str(self)
+        self.key = key
+        self.retry_in = retry_in
+
+
+class IPLookupError(Exception):
+    """所有IP提供方均未返回有效答案"""
+
+
+RETRYABLE_ESA_CODES = {
+    "Throttling", "ServiceUnavailable", "InternalError", "UnknownError",
+    "RequestTimeout", "ServiceBusy", "ServiceTimeout",
+}
+AUTH_ESA_CODE_PREFIXES = (
+    "InvalidAccessKeyId", "SignatureDoesNotMatch", "IncompleteSignature", "InvalidSecurityToken",
+    "Forbidden", "NoPermission", "InvalidAccessKeySecret",
+)
+
+
+def get_error_code(error: Exception) -> str:
+    """取ESA异常的错误码，非ESA异常返回异常类型名"""
+    return str(getattr(error, "code", None) or type(error).__name__)
+
+
+def classify_esa_error(error: Exception) -> str:
+    """
+    对ESA调用错误分类
+
+    返回 retryable（限流/服务端错误/网络错误，可退避重试）、
+    auth（凭证或权限错误，重试无意义且应熔断）或 fatal（其它客户端错误）。
+    """
+    if isinstance(error, CircuitOpenError):
+        return "fatal"
+    if isinstance(error, IPLookupError):
+        return "retryable"
+    code = str(getattr(error, "code", "") or "")
+    status = getattr(error, "statusCode", None) or getattr(error, "status_code", None)
+    if code.startswith(AUTH_ESA_CODE_PREFIXES) or status in (401, 403):
+        return "auth"
+    if code.split(".")[0] in RETRYABLE_ESA_CODES or status == 429 or (status and int(status) >= 500):
+        return "retryable"
+    if code:
+        return "fatal"
+    # Tea 异步请求把连接错误包装为 RetryError
+    if type(error).__name__ == "RetryError":
+        return "retryable"
+    # 没有错误码的一般是连接/超时等网络异常
+    # requests 尚未导入时不可能出现它的异常，避免为分类错误而导入
+    requests_module = sys.modules.get("requests")
+    network_errors = (OSError, requests_module.exceptions.RequestException) if requests_module else OSError
+    if isinstance(error, network_errors) or "Timeout" in type(error).__name__:
+        return "retryable"
+    return "fatal"
+
+
+class CircuitBreaker:
+    """
+    单个接入点的熔断器
+
+    连续 failure_threshold 次可重试失败后打开 reset_timeout 秒；凭证类错误立即打开
+    auth_reset_timeout 秒。打开期满后进入半开状态，只放行一个探测请求。
+    """
+
+    def __init__(self, key: str, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 auth_reset_timeout: float = 3600.0):
+        self.key = key
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.auth_reset_timeout = auth_reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._half_open_probe = False
+        self.state = "closed"
+
+    def allow(self):
+        """检查是否允许请求，不允许时抛出 CircuitOpenError"""
+        with self._lock:
+            if self.state == "closed":
+                return
+            now = time.monotonic()
+            if self.state == "open" and now >= self._open_until:
+                self.state = "half_open"
+                self._half_open_probe = False
+            if self.state == "half_open" and not self._half_open_probe:
+                self._half_open_probe = True
+                return
+            raise CircuitOpenError(self.key, max(0.0, self._open_until - now))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info(f"{self.key} 已恢复，熔断器关闭")
+            self.state = "closed"
+            self._failures = 0
+
+    def record_failure(self, kind: str):
+        with self._lock:
+            if kind == "fatal":
+                # 参数类错误说明服务端可用，不计入熔断
+                if self.state == "half_open":
+                    self.state = "closed"
+                self._failures = 0
+                return
+            self._failures += 1
+            if kind == "auth":
+                self._open(self.auth_reset_timeout, "凭证或权限错误")
+            elif self.state == "half_open" or self._failures >= self.failure_threshold:
+                self._open(self.reset_timeout, f"连续失败 {self._failures} 次")
+
+    def _open(self, seconds: float, reason: str):
+        self.state = "open"
+        self._open_until = time.monotonic() + seconds
+        logger.error(f"{self.key} 熔断器打开 {seconds:.0f} 秒: {reason}")
+
+
+class RetryBudget:
+    """
+    重试预算
+
+    每次调用存入 ratio 个令牌，每次重试消耗1个，余额上限为 capacity，
+    防止故障期间重试把请求量放大数倍。
+    """
+
+    def __init__(self, ratio: float = 0.2, capacity: float = 10.0):
+        self.ratio = ratio
+        self.capacity = capacity
+        self._balance = capacity
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self.capacity, self._balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+
+class Resilience:
+    """指数退避（全抖动）重试 + 按接入点熔断 + 按接入点的重试预算"""
+
+    def __init__(self, max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 10.0,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 auth_reset_timeout: float = 3600.0, budget_ratio: float = 0.2,
+                 budget_capacity: float = 10.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.auth_reset_timeout = auth_reset_timeout
+        self.budget_ratio = budget_ratio
+        self.budget_capacity = budget_capacity
+        self._budgets: Dict[str, RetryBudget] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]]) -> "Resilience":
+        cfg = (config or {}).get("resilience") or {}
+        return cls(
+            max_attempts=int(cfg.get("max_attempts", 4)),
+            base_delay=float(cfg.get("base_delay", 0.5)),
+            max_delay=float(cfg.get("max_delay", 10.0)),
+            failure_threshold=int(cfg.get("failure_threshold", 5)),
+            reset_timeout=float(cfg.get("reset_timeout", 30.0)),
+            auth_reset_timeout=float(cfg.get("auth_reset_timeout", 3600.0)),
+            budget_ratio=float(cfg.get("retry_budget_ratio", 0.2)),
+            budget_capacity=float(cfg.get("retry_budget_capacity", 10.0)),
+        )
+
+    def breaker(self, key: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(key, self.failure_threshold, self.reset_timeout,
+                                         self.auth_reset_timeout)
+                self._breakers[key] = breaker
+            return breaker
+
+    def budget(self, key: str) -> RetryBudget:
+        with self._lock:
+            budget = self._budgets.get(key)
+            if budget is None:
+                budget = self._budgets[key] = RetryBudget(self.budget_ratio, self.budget_capacity)
+            return budget
+
+    def reset(self, key: str):
+        """丢弃指定接入点的熔断状态（例如凭证已更换）"""
+        with self._lock:
+            self._breakers.pop(key, None)
+            self._budgets.pop(key, None)
+
+    def backoff(self, attempt: int) -> float:
+        """第 attempt 次重试前的等待时间（全抖动）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _retry_delay(self, error: Exception, attempt: int, breaker: CircuitBreaker, budget: RetryBudget,
+                     classify, description: str) -> float:
+        """记录失败并返回重试前的等待时间；不应重试时重新抛出 error"""
+        kind = classify(error)
+        breaker.record_failure(kind)
+        if kind != "retryable" or attempt + 1 >= self.max_attempts:
+            raise error
+        if not budget.withdraw():
+            logger.warning(f"{description} 重试预算已耗尽，放弃重试")
+            raise error
+        delay = self.backoff(attempt)
+        logger.warning(f"{description} 失败 ({get_error_code(error)})，"
+                       f"{delay:.2f} 秒后进行第 {attempt + 1} 次重试")
+        return delay
+
+    def call(self, key: str, func, classify=classify_esa_error, description: str = ""):
+        """执行 func，按错误分类决定是否退避重试"""
+        breaker = self.breaker(key)
+        budget = self.budget(key)
+        budget.deposit()
+        attempt = 0
+        while True:
+            breaker.allow()
+            try:
+                result = func()
+            except Exception as error:
+                time.sleep(self._retry_delay(error, attempt, breaker, budget, classify, description or key))
+                attempt += 1
+                continue
+            breaker.record_success()
+            return result
+
+    async def call_async(self, key: str, func, classify=classify_esa_error, description: str = ""):
+        """call 的异步版本，func 为协程函数，退避期间不占用线程"""
+        breaker = self.breaker(key)
+        budget = self.budget(key)
+        budget.deposit()
+        attempt = 0
+        while True:
+            breaker.allow()
+            try:
+                result = await func()
+            except Exception as error:
+                await asyncio.sleep(self._retry_delay(error, attempt, breaker, budget, classify, description or key))
+                attempt += 1
+                continue
+            breaker.record_success()
+            return result
+
+
+_resilience = Resilience()
+_resilience_key: Any = None
+_resilience_lock = threading.Lock()
+
+
+def get_resilience(config: Optional[Dict[str, Any]] = None) -> Resilience:
+    """返回全局重试/熔断配置；config 中的 resilience 配置变化时重建"""
+    global _resilience, _resilience_key
+    if config is None:
+        return _resilience
+    key = json.dumps((config or {}).get("resilience") or {}, sort_keys=True, default=str)
+    with _resilience_lock:
+        if _resilience_key != key:
+            _resilience = Resilience.from_config(config)
+            _resilience_key = key
+        return _resilience
+
+
+# 客户端限流
+class TokenBucket:
+    """
+    令牌桶限流器
+
+    以 rate 个/秒的速度补充令牌，最多积累 burst 个。等待者（线程与协程）按到达顺序
+    领取号码排队（先到先得），不会被后来者插队，也不会因限流而失败。
+    """
+
+    def __init__(self, rate: float, burst: float):
+        if rate <= 0:
+            raise ValueError("限流速率必须大于0")
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        # 已放弃排队的号码（等待中的协程被取消）
+        self._abandoned: set = set()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take_ticket(self) -> int:
+        ticket = self._next_ticket
+        self._next_ticket += 1
+        return ticket
+
+    def _advance(self):
+        """跳过已放弃的号码"""
+        while self._serving in self._abandoned:
+            self._abandoned.discard(self._serving)
+            self._serving += 1
+
+    def _try_take(self, ticket: int) -> Optional[float]:
+        """持有锁时调用：轮到 ticket 且有令牌时取走令牌并返回None，否则返回按排队位置估计的等待秒数"""
+        self._refill()
+        ahead = ticket - self._serving
+        if ahead == 0 and self._tokens >= 1:
+            self._tokens -= 1
+            self._serving += 1
+            self._advance()
+            self._cond.notify_all()
+            return None
+        return max(0.001, (ahead + 1 - self._tokens) / self.rate)
+
+    def acquire(self) -> float:
+        """取得一个令牌，返回排队等待的秒数"""
+        start = time.monotonic()
+        with self._cond:
+            ticket = self._take_ticket()
+            while True:
+                wait = self._try_take(ticket)
+                if wait is None:
+                    return time.monotonic() - start
+                # 排在后面的等待者由前一个取走令牌时唤醒
+                self._cond.wait(wait if ticket == self._serving else None)
+
+    async def acquire_async(self) -> float:
+        """acquire 的协程版本：与线程共用同一个队列，按号码位置在事件循环中等待"""
+        start = time.monotonic()
+        with self._cond:
+            ticket = self._take_ticket()
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_take(ticket)
+                if wait is None:
+                    return time.monotonic() - start
+                await asyncio.sleep(wait)
+        except BaseException:
+            # 被取消时让出号码，避免后面的等待者永远排不到
+            with self._cond:
+                if ticket >= self._serving:
+                    self._abandoned.add(ticket)
+                    self._advance()
+                    self._cond.notify_all()
+            raise
+
+    def drain(self):
+        """服务端返回限流时清空令牌，让后续请求自然放缓"""
+        with self._cond:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0)
+
+
+class RateLimiterRegistry:
+    """
+    按 (账号, 接口) 划分的限流器集合
+
+    配置示例：
+      rate_limit:
+        default: {rate: 10, burst: 10}
+        actions:
+          UpdateRecord: {rate: 5, burst: 5}
+    未配置 rate_limit 时不限流，但仍统计调用与被限流次数。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: Dict[tuple, Optional[TokenBucket]] = {}
+        self._stats: Dict[tuple, Dict[str, float]] = {}
+        self._config: Dict[str, Any] = {}
+        self._config_key: Any = None
+
+    def configure(self, rate_cfg: Optional[Dict[str, Any]]):
+        """更新限流配置，配置变化时重建令牌桶"""
+        key = json.dumps(rate_cfg or {}, sort_keys=True, default=str)
+        with self._lock:
+            if key == self._config_key:
+                return
+            self._config = rate_cfg or {}
+            self._config_key = key
+            self._buckets.clear()
+
+    def _bucket_config(self, account: str, action: str) -> Optional[Dict[str, Any]]:
+        account_cfg = (self._config.get("accounts") or {}).get(account) or {}
+        for source in (account_cfg, self._config):
+            action_cfg = (source.get("actions") or {}).get(action)
+            if action_cfg:
+                return action_cfg
+            if source.get("default"):
+                return source["default"]
+        return None
+
+    def bucket(self, account: str, action: str) -> Optional[TokenBucket]:
+        key = (account, action)
+        with self._lock:
+            if key not in self._buckets:
+                cfg = self._bucket_config(account, action)
+                self._buckets[key] = (TokenBucket(float(cfg["rate"]), float(cfg.get("burst", cfg["rate"])))
+                                      if cfg else None)
+            return self._buckets[key]
+
+    def _stat(self, account: str, action: str) -> Dict[str, float]:
+        return self._stats.setdefault((account, action),
+                                      {"calls": 0, "queued": 0, "wait_seconds": 0.0, "throttled": 0})
+
+    def acquire(self, account: str, action: str):
+        bucket = self.bucket(account, action)
+        self._count(account, action, bucket.acquire() if bucket else 0.0)
+
+    async def acquire_async(self, account: str, action: str):
+        """acquire 的异步版本：与同步调用方在同一队列中排队，等待期间不占用线程"""
+        bucket = self.bucket(account, action)
+        self._count(account, action, await bucket.acquire_async() if bucket else 0.0)
+
+    def _count(self, account: str, action: str, waited: float):
+        with self._lock:
+            stat = self._stat(account, action)
+            stat["calls"] += 1
+            if waited > 0.001:
+                stat["queued"] += 1
+                stat["wait_seconds"] += waited
+
+    def record_throttled(self, account: str, action: str):
+        bucket = self.bucket(account, action)
+        if bucket:
+            bucket.drain()
+        with self._lock:
+            self._stat(account, action)["throttled"] += 1
+        logger.warning(f"账号 {account} 的 {action} 请求被ESA限流")
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {f"{account}/{action}": dict(v) for (account, action), v in self._stats.items()}
+
+
+rate_limiters = RateLimiterRegistry()
+
+
+ESA_ACTION_METHODS = {
+    "GetRecord": "get_record_with_options",
+    "UpdateRecord": "update_record_with_options",
+    "ListRecords": "list_records_with_options",
+    "ListSites": "list_sites_with_options",
+}
+
+
+def esa_breaker_key(account: str, client: Any) -> str:
+    """熔断器与重试预算按 (账号, 接入点) 划分，一个账号的故障不影响其它账号"""
+    endpoint = getattr(client, "_endpoint", None) or DEFAULT_ESA_ENDPOINT
+    return f"esa:{account}@{endpoint}"
+
+
+def call_esa(client: ESA20240910Client, action: str, request):
+    """
+    统一的ESA接口调用入口
+
+    所有ESA请求都经过这里：按 (账号, 接口) 限流排队，按 (账号, 接入点) 应用重试与熔断。
+    """
+    method = getattr(client, ESA_ACTION_METHODS[action])
+    account = client_registry.account_of(client)
+
+    def _attempt():
+        # 每次尝试（包括重试）都需要取得令牌
+        rate_limiters.acquire(account, action)
+        try:
+            with span(f"esa.{action}", {"rpc.system": "aliyun", "rpc.method": action, "ddns.account": account},
+                      SPAN_KIND_CLIENT):
+                return method(request, util_models.RuntimeOptions())
+        except Exception as error:
+            if get_error_code(error).startswith("Throttling"):
+                rate_limiters.record_throttled(account, action)
+            raise
+
+    return get_resilience().call(esa_breaker_key(account, client), _attempt, description=f"ESA {action}")
+
+
+async def call_esa_async(client: ESA20240910Client, action: str, request, timeout: Optional[float] = None):
+    """
+    call_esa 的异步版本：使用SDK的 *_with_options_async 方法
+
+    timeout 为单次尝试的超时（秒），超时按网络错误退避重试；任务被取消时请求随之中止。
+    """
+    method = getattr(client, ESA_ACTION_METHODS[action] + "_async")
+    account = client_registry.account_of(client)
+    runtime = util_models.RuntimeOptions()
+    if timeout:
+        runtime.connect_timeout = runtime.read_timeout = int(timeout * 1000)
+
+    async def _attempt():
+        await rate_limiters.acquire_async(account, action)
+        try:
+            with span(f"esa.{action}", {"rpc.system": "aliyun", "rpc.method": action, "ddns.account": account},
+                      SPAN_KIND_CLIENT):
+                return await asyncio.wait_for(method(request, runtime), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"ESA {action} 请求超过 {timeout:g} 秒未完成") from None
+        except Exception as error:
+            if get_error_code(error).startswith("Throttling"):
+                rate_limiters.record_throttled(account, action)
+            raise
+
+    return await get_resilience().call_async(esa_breaker_key(account, client), _attempt,
+                                             description=f"ESA {action}")
+
+
+class RecordInfo:
+    """
+    ESA记录的精简表示
+
+    只保留更新流程用到的字段，直接从SDK的记录模型（GetRecord 的 RecordModel、
+    ListRecords 的 Records 项）读取，不再将整个响应转换为字典。
+    """
+
+    __slots__ = ("record_id", "name", "type", "value", "priority", "ttl", "proxied", "request_id")
+
+    def __init__(self, record_id: int, name: str = "", type: str = "A/AAAA", value: str = "",
+                 priority: Optional[int] = None, ttl: int = 1, proxied: bool = False,
+                 request_id: Optional[str] = None):
+        self.record_id = record_id
+        self.name = name
+        self.type = type
+        self.value = value
+        self.priority = priority
+        self.ttl = ttl
+        self.proxied = proxied
+        self.request_id = request_id
+
+    @classmethod
+    def from_model(cls, model: Any, request_id: Optional[str] = None) -> RecordInfo:
+        """从SDK记录模型构建"""
+        data = model.data
+        return cls(
+            record_id=int(model.record_id),
+            name=model.record_name or "",
+            type=model.record_type or "A/AAAA",
+            value=(data.value if data is not None else None) or "",
+            priority=data.priority if data is not None else None,
+            ttl=model.ttl or 1,
+            proxied=bool(model.proxied),
+            request_id=request_id,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"RecordInfo({self.record_id}, {self.name!r}, {self.type!r}, {self.value!r})"
+
+
+def _record_from_response(record_id: int, resp: Any) -> RecordInfo:
+    body = resp.body
+    if body is None or body.record_model is None:
+        raise ValueError(f"GetRecord 没有返回记录 {record_id}")
+    return RecordInfo.from_model(body.record_model, body.request_id)
+
+
+def get_record_info(record_id: int, client: Optional[ESA20240910Client] = None) -> RecordInfo:
+    """
+    获取域名记录详细信息
+    """
+    if client is None:
+        client = create_client()
+    get_record_request = esa20240910_models.GetRecordRequest(record_id=record_id)
+
+    try:
+        return _record_from_response(record_id, call_esa(client, "GetRecord", get_record_request))
+    except Exception as error:
+        # 可以记录日志或抛出更具体的异常
+        error_msg = getattr(error, 'message', str(error))
+        logger.error(f"获取记录信息失败: {error_msg}")
+
+        if hasattr(error, 'data') and error.data:
+            logger.error(f"诊断地址: {error.data.get('Recommend', '无')}")
+        raise error
+
+
+async def get_domain_record_async(record_id: int, client: Optional[ESA20240910Client] = None,
+                                  timeout: Optional[float] = None) -> Union[RecordInfo, Dict[str, Any]]:
+    """get_domain_record 的异步版本"""
+    if client is None:
+        client = create_client()
+    try:
+        resp = await call_esa_async(client, "GetRecord", esa20240910_models.GetRecordRequest(record_id=record_id),
+                                    timeout)
+        return _record_from_response(record_id, resp)
+    except Exception as error:
+        error_msg = getattr(error, 'message', str(error))
+        logger.error(f"获取记录信息失败: {error_msg}")
+        return {"error": error_msg, "error_code": get_error_code(error), "status": "failed"}
 
 
-def get_domain_record(record_id: int, extract_only: bool = True) -> Dict[str, Any]:
+def get_domain_record(record_id: int,
+                      client: Optional[ESA20240910Client] = None) -> Union[RecordInfo, Dict[str, Any]]:
     """
-    获取域名记录的便捷函数
+    获取域名记录的便捷函数，失败时返回包含 error 的字典
     """
     try:
-        response = get_record_info(record_id)
-        if extract_only:
-            return extract_record_data(response)
-        return response
+        return get_record_info(record_id, client=client)
     except Exception as e:
-        return {"error": str(e), "status": "failed"}
+        return {"error": str(e), "error_code": get_error_code(e), "status": "failed"}
 
 
 def update_domain_record(record_id: int, new_ip: str, priority: int = 10,
-                         proxied: bool = False, ttl: int = 1, record_type: str = 'A/AAAA') -> Dict[str, Any]:
+                         proxied: bool = False, ttl: int = 1, record_type: str = 'A/AAAA',
+                         client: Optional[ESA20240910Client] = None) -> Dict[str, Any]:
     """
     更新域名记录到指定的IP地址
     """
     logger.info(f"准备更新记录 {record_id} 到新IP: {new_ip}")
 
-    client = create_client()
+    if client is None:
+        client = create_client()
 
     # 构建data对象
     data = esa20240910_models.UpdateRecordRequestData(
@@ -710,27 +5468,60 @@ def update_domain_record(record_id: int, new_ip: str, priority: int = 10,
         type=record_type
     )
 
-    runtime = util_models.RuntimeOptions()
-
     try:
         logger.info("正在调用阿里云API更新记录...")
-        resp = client.update_record_with_options(update_record_request, runtime)
+        resp = call_esa(client, "UpdateRecord", update_record_request)
+        logger.info(f"记录 {record_id} 更新成功!")
+        return {
+            "success": True,
+            "record_id": record_id,
+            "new_ip": new_ip,
+            "request_id": resp.body.request_id if resp.body is not None else None
+        }
 
-        # 将响应转换为字典格式
-        if hasattr(resp, 'to_map'):
-            resp_dict = resp.to_map()
-        elif hasattr(resp, '__dict__'):
-            resp_dict = resp.__dict__
-        else:
-            resp_str = str(resp)
-            resp_dict = parse_response_string(resp_str)
+    except Exception as error:
+        error_msg = getattr(error, 'message', str(error))
+        logger.error(f"更新记录失败: {error_msg}")
+
+        if hasattr(error, 'data') and error.data:
+            logger.error(f"诊断地址: {error.data.get('Recommend', '无')}")
+
+        return {
+            "success": False,
+            "record_id": record_id,
+            "error": error_msg,
+            "error_code": get_error_code(error),
+            "status": "failed"
+        }
 
+
+async def update_domain_record_async(record_id: int, new_ip: str, priority: int = 10,
+                                     proxied: bool = False, ttl: int = 1, record_type: str = 'A/AAAA',
+                                     client: Optional[ESA20240910Client] = None,
+                                     timeout: Optional[float] = None) -> Dict[str, Any]:
+    """update_domain_record 的异步版本"""
+    logger.info(f"准备更新记录 {record_id} 到新IP: {new_ip}")
+
+    if client is None:
+        client = create_client()
+
+    update_record_request = esa20240910_models.UpdateRecordRequest(
+        data=esa20240910_models.UpdateRecordRequestData(value=new_ip, priority=priority),
+        proxied=proxied,
+        ttl=ttl,
+        record_id=record_id,
+        type=record_type
+    )
+
+    try:
+        logger.info("正在调用阿里云API更新记录...")
+        resp = await call_esa_async(client, "UpdateRecord", update_record_request, timeout)
         logger.info(f"记录 {record_id} 更新成功!")
         return {
             "success": True,
             "record_id": record_id,
             "new_ip": new_ip,
-            "response": resp_dict
+            "request_id": resp.body.request_id if resp.body is not None else None
         }
 
     except Exception as error:
@@ -744,29 +5535,290 @@ def update_domain_record(record_id: int, new_ip: str, priority: int = 10,
             "success": False,
             "record_id": record_id,
             "error": error_msg,
+            "error_code": get_error_code(error),
             "status": "failed"
         }
 
 
-def wait_until_next_hour():
-    """等待到下一个整点"""
-    now = datetime.now()
-    # 计算下一个整点的时间
-    next_hour = (now + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+# 传播检查：更新后向权威域名服务器查询记录，确认新值已经生效
+DNS_TYPES = {4: 1, 6: 28}  # A / AAAA
+DNS_RCODE_NXDOMAIN = 3
 
-    # 计算需要等待的秒数
-    wait_seconds = (next_hour - now).total_seconds()
 
-    logger.info(f"当前时间: {now.strftime('%Y-%m-%d %H:%M:%S')}")
-    logger.info(f"下次执行时间: {next_hour.strftime('%Y-%m-%d %H:%M:%S')}")
-    logger.info(f"等待 {wait_seconds:.1f} 秒 ({wait_seconds / 3600:.2f} 小时)")
+class DNSQueryError(Exception):
+    """DNS查询失败（超时、服务器拒绝等）"""
 
-    # 添加彩色输出
-    cprint(f"\n下次定时执行: {next_hour.strftime('%Y-%m-%d %H:%M:%S')}",
-           Colors.MAGENTA, bold=True)
-    cprint(f"等待时间: {wait_seconds / 3600:.2f} 小时", Colors.CYAN)
 
-    return wait_seconds
+def build_dns_query(name: str, qtype: int) -> tuple:
+    """构造DNS查询报文，返回 (查询ID, 报文)；设置 RD 位，配置为递归解析服务器时同样可用"""
+    query_id = random.getrandbits(16)
+    qname = b"".join(bytes([len(label)]) + label
+                     for label in name.rstrip(".").encode("idna").split(b".") if label) + b"\x00"
+    return query_id, struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0) + qname + struct.pack("!HH", qtype, 1)
+
+
+def _skip_dns_name(data: bytes, offset: int) -> int:
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += 1 + length
+        if length == 0:
+            return offset
+
+
+def parse_dns_response(data: bytes, query_id: int, qtype: int) -> tuple:
+    """解析DNS响应，返回 (是否被截断, 响应码, 该类型的记录值列表)"""
+    try:
+        response_id, flags, qdcount, ancount, _, _ = struct.unpack("!HHHHHH", data[:12])
+        if response_id != query_id or not flags & 0x8000:
+            raise DNSQueryError("DNS响应与查询不匹配")
+        offset = 12
+        for _ in range(qdcount):
+            offset = _skip_dns_name(data, offset) + 4
+        values = []
+        for _ in range(ancount):
+            offset = _skip_dns_name(data, offset)
+            rtype, _, _, rdlength = struct.unpack("!HHIH", data[offset:offset + 10])
+            offset += 10
+            rdata = data[offset:offset + rdlength]
+            if len(rdata) != rdlength:
+                raise IndexError
+            offset += rdlength
+            if rtype == qtype == 1 and rdlength == 4:
+                values.append(socket.inet_ntop(socket.AF_INET, rdata))
+            elif rtype == qtype == 28 and rdlength == 16:
+                values.append(socket.inet_ntop(socket.AF_INET6, rdata))
+    except (struct.error, IndexError):
+        raise DNSQueryError("DNS响应格式错误") from None
+    return bool(flags & 0x0200), flags & 0x000F, values
+
+
+class _DNSDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, query_id: int, future: asyncio.Future):
+        self.query_id = query_id
+        self.future = future
+
+    def datagram_received(self, data: bytes, addr):
+        # 忽略ID不匹配的报文（迟到的旧响应或伪造报文）
+        if not self.future.done() and data[:2] == struct.pack("!H", self.query_id):
+            self.future.set_result(data)
+
+    def error_received(self, exc: Exception):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+async def _dns_udp(server: tuple, packet: bytes, query_id: int) -> bytes:
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _DNSDatagramProtocol(query_id, future), remote_addr=server)
+    try:
+        transport.sendto(packet)
+        return await future
+    finally:
+        transport.close()
+
+
+async def _dns_tcp(server: tuple, packet: bytes) -> bytes:
+    reader, writer = await asyncio.open_connection(server[0], server[1])
+    try:
+        writer.write(struct.pack("!H", len(packet)) + packet)
+        await writer.drain()
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+        return await reader.readexactly(length)
+    finally:
+        writer.close()
+
+
+async def dns_query(server: tuple, name: str, qtype: int, timeout: float = DEFAULT_PROPAGATION_TIMEOUT) -> List[str]:
+    """
+    向指定服务器查询 name 的A/AAAA记录，返回记录值列表（名称不存在时为空）
+
+    先用UDP查询；响应被截断或UDP超时/失败时改用TCP。全部基于事件循环，不占用线程。
+    """
+    query_id, packet = build_dns_query(name, qtype)
+    try:
+        data = await asyncio.wait_for(_dns_udp(server, packet, query_id), timeout)
+        truncated, rcode, values = parse_dns_response(data, query_id, qtype)
+    except (asyncio.TimeoutError, OSError, DNSQueryError):
+        truncated = True
+    if truncated:
+        try:
+            data = await asyncio.wait_for(_dns_tcp(server, packet), timeout)
+        except asyncio.TimeoutError:
+            raise DNSQueryError(f"{server[0]} 查询超时") from None
+        except (OSError, asyncio.IncompleteReadError) as e:
+            raise DNSQueryError(f"{server[0]} 查询失败: {e}") from None
+        _, rcode, values = parse_dns_response(data, query_id, qtype)
+    if rcode not in (0, DNS_RCODE_NXDOMAIN):
+        raise DNSQueryError(f"{server[0]} 返回错误码 {rcode}")
+    return values
+
+
+def parse_nameserver(value: str) -> tuple:
+    """解析域名服务器地址：1.2.3.4、1.2.3.4:53、[::1]:5353、ns1.example.com"""
+    value = value.strip()
+    if value.startswith("["):
+        host, _, port = value[1:].partition("]")
+        return host, int(port.lstrip(":") or 53)
+    if value.count(":") == 1:
+        host, port = value.split(":")
+        return host, int(port)
+    return value, 53
+
+
+class PropagationChecker:
+    """
+    传播检查
+
+    更新成功后并发向所有配置的域名服务器查询记录，每隔 interval 秒重试尚未返回新值的服务器，
+    直到全部服务器都返回新值或超过 deadline。域名服务器的主机名只解析一次。
+    """
+
+    def __init__(self, nameservers: List[str], timeout: float = DEFAULT_PROPAGATION_TIMEOUT,
+                 deadline: float = DEFAULT_PROPAGATION_DEADLINE, interval: float = DEFAULT_PROPAGATION_INTERVAL,
+                 retries: int = 0):
+        self.nameservers = [parse_nameserver(ns) for ns in nameservers]
+        self.timeout = timeout
+        self.deadline = deadline
+        self.interval = interval
+        self.retries = retries
+        self._addresses: Dict[tuple, tuple] = {}
+
+    async def _address(self, server: tuple) -> tuple:
+        address = self._addresses.get(server)
+        if address is None:
+            if ip_family(server[0]) is None:
+                infos = await asyncio.get_running_loop().getaddrinfo(server[0], server[1], type=socket.SOCK_DGRAM)
+                address = (infos[0][4][0], server[1])
+            else:
+                address = server
+            self._addresses[server] = address
+        return address
+
+    async def wait(self, name: str, value: str) -> Dict[str, Any]:
+        """等待所有服务器返回 value，返回 {converged, seconds, servers: {服务器: 生效耗时或最后一次的结果}}"""
+        qtype = DNS_TYPES[ip_family(value) or 4]
+        started = time.monotonic()
+        pending = {f"{host}:{port}": (host, port) for host, port in self.nameservers}
+        servers: Dict[str, Any] = {}
+
+        async def _probe(label: str, server: tuple):
+            try:
+                values = await dns_query(await self._address(server), name, qtype, self.timeout)
+            except (DNSQueryError, OSError) as e:
+                servers[label] = str(e)
+                return
+            if value in values:
+                servers[label] = round(time.monotonic() - started, 3)
+                pending.pop(label, None)
+            else:
+                servers[label] = ", ".join(values) or "无记录"
+
+        while True:
+            await asyncio.gather(*(_probe(label, server) for label, server in list(pending.items())))
+            elapsed = time.monotonic() - started
+            if not pending or elapsed >= self.deadline:
+                return {"converged": not pending, "seconds": round(elapsed, 3), "servers": servers}
+            # 最后一轮恰好在期限到达时查询
+            await asyncio.sleep(min(self.interval, self.deadline - elapsed))
+
+
+_propagation_checker: Optional[PropagationChecker] = None
+_propagation_key: Any = None
+_propagation_lock = threading.Lock()
+
+
+def get_propagation_checker(config: Optional[Dict[str, Any]]) -> Optional[PropagationChecker]:
+    """根据配置返回传播检查器；未开启时返回 None"""
+    global _propagation_checker, _propagation_key
+    propagation_cfg = (config or {}).get("propagation") or {}
+    if not propagation_cfg.get("enabled") or not propagation_cfg.get("nameservers"):
+        return None
+    key = json.dumps(propagation_cfg, sort_keys=True, default=str)
+    with _propagation_lock:
+        if _propagation_key != key:
+            _propagation_checker = PropagationChecker(
+                list(propagation_cfg["nameservers"]),
+                timeout=float(propagation_cfg.get("timeout", DEFAULT_PROPAGATION_TIMEOUT)),
+                deadline=float(propagation_cfg.get("deadline", DEFAULT_PROPAGATION_DEADLINE)),
+                interval=float(propagation_cfg.get("interval", DEFAULT_PROPAGATION_INTERVAL)),
+                retries=int(propagation_cfg.get("retries", 0)),
+            )
+            _propagation_key = key
+        return _propagation_checker
+
+
+def propagation_text(propagation: Dict[str, Any]) -> str:
+    """传播检查结果的文字描述"""
+    if propagation.get("skipped"):
+        return f"已跳过（{propagation['skipped']}）"
+    if propagation.get("converged"):
+        return f"已生效，耗时 {propagation['seconds']:.1f} 秒"
+    waiting = [f"{server}: {state}" for server, state in propagation.get("servers", {}).items()
+               if not isinstance(state, (int, float))]
+    return f"{propagation['seconds']:.1f} 秒后仍未生效（{'; '.join(waiting)}）"
+
+
+async def verify_propagation(checker: PropagationChecker, result: Dict[str, Any], config: Dict[str, Any],
+                             call_timeout: Optional[float] = None):
+    """
+    更新成功后的传播检查，结果写入 result["propagation"]
+
+    超过期限仍未生效时按 retries 重新提交更新并再次等待；最终仍未生效则记录错误告警，
+    并清除本地状态缓存，使下个周期重新向ESA确认记录。
+    """
+    record_id = result["record_id"]
+    record_info: Optional[RecordInfo] = result.get("record")
+    name = result.get("record_name") or (record_info.name if record_info is not None else "")
+    if record_info is not None and record_info.proxied:
+        # 代理记录对外解析为边缘节点地址，无法按源站IP确认
+        result["propagation"] = {"skipped": "代理记录"}
+        return
+    if not name or name == "未知":
+        result["propagation"] = {"skipped": "记录名称未知"}
+        return
+
+    value = result["local_ip"]
+    attempts = 0
+    while True:
+        with metrics_stage("propagation"):
+            outcome = await checker.wait(name, value)
+        result["propagation"] = outcome
+        if outcome["converged"]:
+            PROPAGATION_TOTAL.inc(result="converged")
+            PROPAGATION_SECONDS.observe(outcome["seconds"])
+            logger.info(f"记录 {name} 的新值 {value} 已在全部域名服务器生效，耗时 {outcome['seconds']:.1f} 秒")
+            return
+        if attempts >= checker.retries:
+            break
+        attempts += 1
+        logger.warning(f"记录 {name} 的新值 {value} 在 {checker.deadline:g} 秒内未生效，"
+                       f"重新提交更新（第 {attempts} 次）")
+        coordinator = get_coordinator(config)
+        if coordinator is not None and not await asyncio.to_thread(coordinator.fenced, record_id):
+            break
+        retry = await update_domain_record_async(
+            record_id=record_id,
+            new_ip=value,
+            priority=record_info.priority if record_info is not None and record_info.priority is not None else 10,
+            proxied=False,
+            ttl=record_info.ttl if record_info is not None else 1,
+            record_type=record_info.type if record_info is not None else "A/AAAA",
+            client=create_client(config),
+            timeout=call_timeout,
+        )
+        if not retry.get("success"):
+            break
+
+    PROPAGATION_TOTAL.inc(result="timeout")
+    state_cache = get_state_cache(config)
+    if state_cache is not None:
+        state_cache.invalidate(record_id)
+    cprint(f"告警: 记录 {name} 的传播检查失败 - {propagation_text(result['propagation'])}", Colors.RED, bold=True)
+    logger.error(f"告警: 记录 {name} 的传播检查失败 - {propagation_text(result['propagation'])}")
 
 
 if __name__ == '__main__':
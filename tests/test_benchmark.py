@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import argparse
+import os
+
+import pytest
+
+import benchmark
+
+
+def _crash_entry(out_queue, base_url, size, args_dict):
+    # 模拟被 OOM killer 杀死：不写入结果直接退出
+    os._exit(3)
+
+
+def _ok_entry(out_queue, base_url, size, args_dict):
+    out_queue.put(("ok", [{"records": size}]))
+
+
+def test_run_isolated_reports_dead_child(monkeypatch):
+    monkeypatch.setattr(benchmark, "_scenario_entry", _crash_entry)
+    with pytest.raises(RuntimeError, match="退出码 3"):
+        benchmark.run_isolated("http://127.0.0.1:1", 1, argparse.Namespace())
+
+
+def test_run_isolated_returns_child_result(monkeypatch):
+    monkeypatch.setattr(benchmark, "_scenario_entry", _ok_entry)
+    assert benchmark.run_isolated("http://127.0.0.1:1", 7, argparse.Namespace()) == [{"records": 7}]
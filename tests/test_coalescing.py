@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def sched(monkeypatch):
+    """未启动主循环的调度器，与守护进程首次更新时的状态相同"""
+    target = main.Scheduler()
+    target.add_job(main.MANUAL_JOB, lambda: None)
+    monkeypatch.setattr(main, "scheduler", target)
+    return target
+
+
+def make_coalescer(mode: str, seconds: float = 5.0) -> main.WriteCoalescer:
+    coalescer = main.WriteCoalescer(seconds)
+    coalescer.mode = mode
+    return coalescer
+
+
+def test_daemon_mode_defers_before_scheduler_runs(sched):
+    coalescer = make_coalescer("daemon")
+    assert not sched.running
+
+    start = time.monotonic()
+    assert not asyncio.run(coalescer.wait_stable(1, "203.0.113.7"))
+    assert time.monotonic() - start < 1.0
+    assert main.MANUAL_JOB in sched._deferred
+
+
+def test_once_mode_waits_and_rechecks(sched, monkeypatch):
+    coalescer = make_coalescer("once", seconds=0.1)
+
+    async def fake_ip(config=None, family=None):
+        return "203.0.113.7"
+
+    monkeypatch.setattr(main, "get_local_ip_async", fake_ip)
+    assert asyncio.run(coalescer.wait_stable(1, "203.0.113.7"))
+    assert not sched._deferred
+
+
+def test_once_mode_drops_flapped_ip(sched, monkeypatch):
+    coalescer = make_coalescer("once", seconds=0.1)
+
+    async def fake_ip(config=None, family=None):
+        return "198.51.100.1"
+
+    monkeypatch.setattr(main, "get_local_ip_async", fake_ip)
+    assert not asyncio.run(coalescer.wait_stable(1, "203.0.113.7"))
+    assert coalescer.candidate(1) is None
+
+
+def test_worker_mode_returns_without_waiting(sched):
+    coalescer = make_coalescer("worker")
+
+    start = time.monotonic()
+    assert not asyncio.run(coalescer.wait_stable(1, "203.0.113.7"))
+    assert time.monotonic() - start < 1.0
+    # 工作进程不操作调度器，候选值交回主进程
+    assert not sched._deferred
+    assert coalescer.candidate(1)[0] == "203.0.113.7"
+
+
+def test_parent_adopts_worker_candidate_and_reschedules(sched):
+    parent = make_coalescer("daemon")
+    since = time.time() - 2
+    result = {"record_id": 1, "deferred": True, "candidate": ("203.0.113.7", since)}
+
+    main._adopt_worker_candidate(parent, result)
+
+    assert "candidate" not in result
+    assert parent.candidate(1) == ("203.0.113.7", since)
+    assert sched._deferred[main.MANUAL_JOB] == pytest.approx(since + 5.0, abs=0.5)
+    # 窗口从最早发现时算起，剩余时间不会被重新计算
+    assert parent.remaining(1, "203.0.113.7") == pytest.approx(3.0, abs=0.5)
+
+    # 工作进程写入完成后不再有候选值
+    main._adopt_worker_candidate(parent, {"record_id": 1, "update_performed": True})
+    assert parent.candidate(1) is None
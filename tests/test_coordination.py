@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""两个协调器共享同一租约后端，模拟主备两个实例"""
+import time
+
+import pytest
+
+import benchmark
+import main
+
+NEW_IP = "203.0.113.7"
+OLD_IP = "198.51.100.1"
+
+
+@pytest.fixture(params=["memory", "file"])
+def backends(request, tmp_path):
+    """两个实例各自的后端：内存后端共用一个对象，文件后端指向同一目录"""
+    if request.param == "memory":
+        shared = main.MemoryLeaseBackend()
+        return shared, shared
+    path = str(tmp_path / "leases")
+    return main.FileLeaseBackend(path), main.FileLeaseBackend(path)
+
+
+def pair(backends, ttl: float = 30.0, scope: str = "record"):
+    first, second = backends
+    return (main.Coordinator(first, "node-a", ttl=ttl, scope=scope),
+            main.Coordinator(second, "node-b", ttl=ttl, scope=scope))
+
+
+@pytest.fixture
+def fake():
+    state = benchmark.FakeESAState()
+    server = benchmark.start_fake_esa(state)
+    state.host = f"127.0.0.1:{server.server_address[1]}"
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+def test_only_holder_writes(backends, fake, monkeypatch):
+    leader, standby = pair(backends)
+    fake.seed(4, OLD_IP)
+    records = [{"record_id": record_id} for record_id in sorted(fake.records)]
+    config = {"aliyun": {"access_key_id": "test", "access_key_secret": "test", "region": "cn-hangzhou",
+                         "endpoint": fake.host, "protocol": "http"},
+              "resilience": {"max_attempts": 1}}
+    current = {"coordinator": leader}
+    monkeypatch.setattr(main, "get_coordinator", lambda config: current["coordinator"])
+
+    results = main.run_batch_update([dict(r) for r in records], config, new_ip=NEW_IP)
+    assert all((r.get("update_result") or {}).get("success") for r in results)
+    assert fake.calls["UpdateRecord"] == 4
+
+    # 备用实例不访问ESA，直接使用持有者发布的值
+    fake.calls.clear()
+    current["coordinator"] = standby
+    results = main.run_batch_update([dict(r) for r in records], config, new_ip=NEW_IP)
+    assert fake.calls == {}
+    assert all(r["standby"] and r["leader"] == "node-a" and r["record_ip"] == NEW_IP for r in results)
+    assert {r["Data"]["Value"] for r in fake.records.values()} == {NEW_IP}
+
+
+def test_partition_splits_records_between_instances(backends):
+    first, second = pair(backends, scope="shard")
+    records = [{"record_id": 100 + i} for i in range(20)]
+
+    leading_a, standby_a = first.partition(records)
+    leading_b, standby_b = second.partition(records)
+
+    # 先到的实例取得全部租约，另一个实例全部为备用
+    assert len(leading_a) == 20 and not standby_a
+    assert not leading_b and len(standby_b) == 20
+    assert all(first.fenced(r["record_id"]) for r in records)
+    assert not any(second.fenced(r["record_id"]) for r in records)
+
+
+def test_stale_holder_is_fenced_after_token_moves_on(backends):
+    first, second = pair(backends, ttl=0.2)
+    record = {"record_id": 42}
+
+    first.partition([record])
+    assert first.fenced(42)
+
+    # 持有者暂停超过租约时间，另一个实例接手，令牌加一
+    time.sleep(0.3)
+    leading, _ = second.partition([record])
+    assert leading == [record]
+    assert second.fenced(42)
+    assert not first.fenced(42)
+
+    # 旧持有者恢复后发布的值被拒绝
+    first.publish([{"record_id": 42, "record_ip": "192.0.2.1", "ip_changed": False}])
+    second.publish([{"record_id": 42, "record_ip": NEW_IP, "ip_changed": False}])
+    _, standby = first.partition([record])
+    assert main.standby_results(standby, None)[0]["record_ip"] == NEW_IP
+
+
+def test_standby_receives_published_values(backends):
+    first, second = pair(backends)
+    records = [{"record_id": 1, "name": "a.example.com"}, {"record_id": 2, "name": "b.example.com"},
+               {"record_id": 3, "name": "c.example.com"}]
+    first.partition(records)
+    first.publish([
+        {"record_id": 1, "record_name": "a.example.com", "record_ip": OLD_IP, "ip_changed": False},
+        {"record_id": 2, "record_name": "b.example.com", "record_ip": OLD_IP, "local_ip": NEW_IP,
+         "ip_changed": True, "update_performed": True, "update_result": {"success": True}},
+        # 写入失败的值不发布
+        {"record_id": 3, "record_name": "c.example.com", "record_ip": OLD_IP, "local_ip": NEW_IP,
+         "ip_changed": True, "update_performed": True, "update_result": {"success": False}},
+    ])
+
+    leading, standby = second.partition(records)
+    assert not leading
+    results = main.standby_results(standby, None)
+    assert [r["record_ip"] for r in results] == [OLD_IP, NEW_IP, ""]
+    assert [r["leader"] for r in results] == ["node-a"] * 3
+
+
+def test_release_hands_over_without_waiting(backends):
+    first, second = pair(backends, ttl=60.0)
+    record = {"record_id": 7}
+    first.partition([record])
+    first.release_all()
+
+    leading, _ = second.partition([record])
+    assert leading == [record]
+    assert second.fenced(7)
+    assert not first.fenced(7)
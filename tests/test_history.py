@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import main
+
+DAY = 86400
+HOUR = 3600
+NOOP = {"record_id": 1, "record_name": "home.example.com", "record_ip": "198.51.100.1",
+        "local_ip": "198.51.100.1", "duration": 0.01}
+
+
+@pytest.fixture
+def store(tmp_path):
+    history = main.HistoryStore(str(tmp_path / "history.db"), raw_days=1, retention_days=30)
+    yield history
+    history.close()
+
+
+def test_compact_keeps_rows_inside_raw_window(store):
+    now = 10 * DAY + 12 * HOUR
+    for hour in (8, 11, 13, 20):
+        store.append([NOOP], ts=9 * DAY + hour * HOUR)
+
+    assert store.compact(now=now) == {"merged": 2, "expired": 0}
+
+    rows = sorted((row["ts"], row["count"]) for row in store.query(record="1"))
+    # 08:00 与 11:00 早于原始记录保留期，合并为一行；13:00 与 20:00 原样保留
+    assert rows == [(9 * DAY + 11 * HOUR, 2), (9 * DAY + 13 * HOUR, 1), (9 * DAY + 20 * HOUR, 1)]
+    assert store.summary(record="1") == {"noop": 4}
+
+
+def test_compact_merges_again_as_window_moves(store):
+    for hour in (8, 11, 13, 20):
+        store.append([NOOP], ts=9 * DAY + hour * HOUR)
+    store.compact(now=10 * DAY + 12 * HOUR)
+
+    assert store.compact(now=11 * DAY) == {"merged": 3, "expired": 0}
+    rows = [(row["ts"], row["count"]) for row in store.query(record="1")]
+    assert rows == [(9 * DAY + 20 * HOUR, 4)]
+
+
+def test_compact_leaves_changes_and_expires_old_rows(store):
+    store.append([NOOP], ts=1 * HOUR)
+    store.append([{**NOOP, "record_ip": "198.51.100.1", "local_ip": "203.0.113.7", "ip_changed": True,
+                   "update_performed": True, "update_result": {"success": True}}], ts=40 * DAY + HOUR)
+    store.append([NOOP], ts=40 * DAY + 2 * HOUR)
+
+    assert store.compact(now=42 * DAY) == {"merged": 0, "expired": 1}
+    assert store.summary(record="1") == {"updated": 1, "noop": 1}
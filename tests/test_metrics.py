@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import re
+
+import main
+
+
+def test_histogram_le_labels_are_canonical_floats():
+    histogram = main.Histogram("test_seconds", "test", ("stage",), buckets=(5, 1, 0.25))
+    histogram.observe(0.5, stage="compare")
+    histogram.observe(3, stage="compare")
+
+    lines = histogram.samples()
+    assert lines[:4] == [
+        'test_seconds_bucket{stage="compare",le="0.25"} 0',
+        'test_seconds_bucket{stage="compare",le="1.0"} 1',
+        'test_seconds_bucket{stage="compare",le="5.0"} 2',
+        'test_seconds_bucket{stage="compare",le="+Inf"} 2',
+    ]
+    assert lines[4:] == ['test_seconds_sum{stage="compare"} 3.5', 'test_seconds_count{stage="compare"} 2']
+
+
+def test_registered_histograms_render_float_buckets():
+    main.PROPAGATION_SECONDS.observe(3.0)
+    text = main.metrics.render()
+
+    bounds = re.findall(r'ddns_propagation_seconds_bucket\{le="([^"]+)"\}', text)
+    assert bounds[:3] == ["1.0", "2.0", "5.0"] and bounds[-1] == "+Inf"
+    assert text.endswith("# EOF\n")
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""用本地的桩DNS服务器（UDP + TCP）测试传播检查"""
+import asyncio
+import logging
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import main
+
+NAME = "home.example.com"
+OLD_IP = "198.51.100.1"
+NEW_IP = "203.0.113.7"
+
+
+class StubDNS:
+    """
+    同一端口上的UDP与TCP桩DNS服务器
+
+    mode 为 udp（正常应答）、truncate（UDP只返回TC=1的空应答）或 tcponly（丢弃UDP查询）。
+    set(name, value, lag) 设置记录值，lag 秒内仍应答旧值，模拟尚未同步的服务器。
+    """
+
+    def __init__(self, mode: str = "udp"):
+        self.mode = mode
+        self.rcode = 0
+        self.queries = {"udp": 0, "tcp": 0}
+        self._records = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(("127.0.0.1", 0))
+        self.udp.settimeout(0.05)
+        self.port = self.udp.getsockname()[1]
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(("127.0.0.1", self.port))
+        self.tcp.listen(16)
+        self.tcp.settimeout(0.05)
+        self._threads = [threading.Thread(target=self._serve_udp, daemon=True),
+                         threading.Thread(target=self._serve_tcp, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def address(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    def set(self, name: str, value: str, lag: float = 0.0):
+        with self._lock:
+            old = self._value(name)
+            self._records[name] = (old, value, time.monotonic() + lag)
+
+    def _value(self, name: str):
+        old, new, switch_at = self._records.get(name, (None, None, 0.0))
+        return new if time.monotonic() >= switch_at else old
+
+    def close(self):
+        # 阻塞在 recvfrom/accept 中的线程不会因 close 返回，先停止服务线程再关闭
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self.udp.close()
+        self.tcp.close()
+
+    def _answer(self, query: bytes, truncated: bool = False) -> bytes:
+        query_id = struct.unpack("!H", query[:2])[0]
+        offset, labels = 12, []
+        while query[offset]:
+            labels.append(query[offset + 1:offset + 1 + query[offset]].decode())
+            offset += 1 + query[offset]
+        qtype = struct.unpack("!H", query[offset + 1:offset + 3])[0]
+        question = query[12:offset + 5]
+        with self._lock:
+            value = None if truncated else self._value(".".join(labels))
+        answer = b""
+        if value and qtype == 1:
+            # 名称使用指向问题部分的压缩指针
+            answer = b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 60, 4) + socket.inet_aton(value)
+        rcode = self.rcode or (0 if value or truncated else main.DNS_RCODE_NXDOMAIN)
+        flags = 0x8400 | (0x0200 if truncated else 0) | rcode
+        return struct.pack("!HHHHHH", query_id, flags, 1, 1 if answer else 0, 0, 0) + question + answer
+
+    def _serve_udp(self):
+        while not self._stopped.is_set():
+            try:
+                query, addr = self.udp.recvfrom(512)
+            except socket.timeout:
+                continue
+            self.queries["udp"] += 1
+            if self.mode != "tcponly":
+                self.udp.sendto(self._answer(query, truncated=self.mode == "truncate"), addr)
+
+    def _serve_tcp(self):
+        while not self._stopped.is_set():
+            try:
+                conn, _ = self.tcp.accept()
+            except socket.timeout:
+                continue
+            self.queries["tcp"] += 1
+            with conn:
+                conn.settimeout(None)
+                length = struct.unpack("!H", conn.recv(2))[0]
+                query = b""
+                while len(query) < length:
+                    query += conn.recv(length - len(query))
+                response = self._answer(query)
+                conn.sendall(struct.pack("!H", len(response)) + response)
+
+
+@pytest.fixture
+def stubs():
+    servers = []
+
+    def _make(mode: str = "udp") -> StubDNS:
+        server = StubDNS(mode)
+        servers.append(server)
+        return server
+
+    yield _make
+    for server in servers:
+        server.close()
+
+
+def response(query_id: int, answers: bytes = b"", ancount: int = 0, flags: int = 0x8180) -> bytes:
+    _, packet = main.build_dns_query(NAME, 1)
+    return struct.pack("!HHHHHH", query_id, flags, 1, ancount, 0, 0) + packet[12:] + answers
+
+
+def a_record(ip: str) -> bytes:
+    return b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 60, 4) + socket.inet_aton(ip)
+
+
+def test_build_query_encodes_question():
+    query_id, packet = main.build_dns_query("Home.Example.com.", 28)
+    assert struct.unpack("!HH", packet[:4]) == (query_id, 0x0100)
+    assert packet[12:] == b"\x04Home\x07Example\x03com\x00" + struct.pack("!HH", 28, 1)
+
+
+def test_parse_response_values_and_flags():
+    cname = b"\xc0\x0c" + struct.pack("!HHIH", 5, 1, 60, 2) + b"\xc0\x0c"
+    aaaa = b"\xc0\x0c" + struct.pack("!HHIH", 28, 1, 60, 16) + socket.inet_pton(socket.AF_INET6, "2001:db8::1")
+    data = response(7, cname + a_record(OLD_IP) + aaaa + a_record(NEW_IP), ancount=4)
+
+    # 只返回查询类型的记录，CNAME 与其它类型被跳过
+    assert main.parse_dns_response(data, 7, 1) == (False, 0, [OLD_IP, NEW_IP])
+    assert main.parse_dns_response(data, 7, 28) == (False, 0, ["2001:db8::1"])
+    assert main.parse_dns_response(response(7, flags=0x8183), 7, 1) == (False, 3, [])
+    assert main.parse_dns_response(response(7, flags=0x8380), 7, 1) == (True, 0, [])
+
+
+@pytest.mark.parametrize("data", [
+    response(8, a_record(OLD_IP), ancount=1),               # ID 不匹配
+    response(7, a_record(OLD_IP), ancount=1, flags=0x0100),  # 不是响应报文
+    response(7, a_record(OLD_IP), ancount=1)[:-3],           # 应答被截断
+    response(7, ancount=1),                                  # 声明的应答不存在
+    b"\x00\x07",                                             # 报文头不完整
+])
+def test_parse_response_rejects_malformed(data):
+    with pytest.raises(main.DNSQueryError):
+        main.parse_dns_response(data, 7, 1)
+
+
+@pytest.mark.parametrize("mode,queries", [
+    ("udp", {"udp": 1, "tcp": 0}),
+    ("truncate", {"udp": 1, "tcp": 1}),
+    ("tcponly", {"udp": 1, "tcp": 1}),
+])
+def test_dns_query_falls_back_to_tcp(stubs, mode, queries):
+    server = stubs(mode)
+    server.set(NAME, NEW_IP)
+
+    values = asyncio.run(main.dns_query(("127.0.0.1", server.port), NAME, 1, timeout=0.3))
+
+    assert values == [NEW_IP]
+    assert server.queries == queries
+
+
+def test_dns_query_nxdomain_and_server_errors(stubs):
+    server = stubs()
+    assert asyncio.run(main.dns_query(("127.0.0.1", server.port), "missing.example.com", 1, timeout=0.3)) == []
+
+    server.rcode = 2  # SERVFAIL
+    with pytest.raises(main.DNSQueryError, match="错误码 2"):
+        asyncio.run(main.dns_query(("127.0.0.1", server.port), NAME, 1, timeout=0.3))
+
+
+def test_parse_nameserver():
+    assert main.parse_nameserver("1.2.3.4") == ("1.2.3.4", 53)
+    assert main.parse_nameserver("1.2.3.4:5353") == ("1.2.3.4", 5353)
+    assert main.parse_nameserver("[2001:db8::1]:5353") == ("2001:db8::1", 5353)
+    assert main.parse_nameserver("[2001:db8::1]") == ("2001:db8::1", 53)
+    assert main.parse_nameserver("ns1.example.com") == ("ns1.example.com", 53)
+
+
+def test_checker_requeries_lagging_servers(stubs):
+    fast, slow = stubs(), stubs("truncate")
+    fast.set(NAME, NEW_IP)
+    slow.set(NAME, OLD_IP)
+    slow.set(NAME, NEW_IP, lag=0.5)
+    checker = main.PropagationChecker([fast.address, slow.address], timeout=0.3, deadline=3.0, interval=0.2)
+
+    outcome = asyncio.run(checker.wait(NAME, NEW_IP))
+
+    assert outcome["converged"]
+    assert 0.5 <= outcome["seconds"] < 2.0
+    # 已生效的服务器不再查询，未生效的按 interval 重试
+    assert fast.queries["udp"] == 1
+    assert slow.queries["tcp"] >= 2
+    assert outcome["servers"][fast.address] < outcome["servers"][slow.address]
+
+
+def test_checker_stops_at_deadline(stubs):
+    server = stubs()
+    server.set(NAME, OLD_IP)
+    checker = main.PropagationChecker([server.address], timeout=0.3, deadline=0.5, interval=0.2)
+
+    outcome = asyncio.run(checker.wait(NAME, NEW_IP))
+
+    assert not outcome["converged"]
+    # 最后一轮恰好在期限到达时查询，不会多等一个 interval
+    assert 0.5 <= outcome["seconds"] < 0.7
+    assert server.queries["udp"] == 4
+    assert outcome["servers"] == {server.address: OLD_IP}
+    assert main.propagation_text(outcome).endswith(f"仍未生效（{server.address}: {OLD_IP}）")
+
+
+def test_checker_reports_unreachable_server(stubs):
+    server = stubs()
+    server.close()
+    checker = main.PropagationChecker([server.address], timeout=0.2, deadline=0.0)
+
+    outcome = asyncio.run(checker.wait(NAME, NEW_IP))
+
+    assert not outcome["converged"]
+    assert outcome["servers"][server.address].startswith("127.0.0.1 查询")
+
+
+@pytest.fixture
+def updates(monkeypatch):
+    """记录传播检查重新提交的更新，不访问ESA"""
+    calls = []
+
+    async def fake_update(**kwargs):
+        calls.append(kwargs)
+        return {"success": True}
+
+    monkeypatch.setattr(main, "update_domain_record_async", fake_update)
+    monkeypatch.setattr(main, "create_client", lambda config=None: None)
+    return calls
+
+
+def check_result() -> dict:
+    record = main.RecordInfo(record_id=1, name=NAME, type="A/AAAA", value=OLD_IP, ttl=60, proxied=False)
+    return {"record_id": 1, "record_name": NAME, "local_ip": NEW_IP, "record": record}
+
+
+def timeouts() -> float:
+    return main.PROPAGATION_TOTAL._values.get(("timeout",), 0.0)
+
+
+def test_retry_then_alert(stubs, updates, caplog):
+    server = stubs()
+    server.set(NAME, OLD_IP)
+    checker = main.PropagationChecker([server.address], timeout=0.3, deadline=0.3, interval=0.1, retries=1)
+    result = check_result()
+    before = timeouts()
+
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(main.verify_propagation(checker, result, {}))
+
+    assert len(updates) == 1
+    assert updates[0]["record_id"] == 1 and updates[0]["new_ip"] == NEW_IP and updates[0]["ttl"] == 60
+    assert not result["propagation"]["converged"]
+    assert timeouts() == before + 1
+    assert any(r.levelno == logging.ERROR and "传播检查失败" in r.getMessage() for r in caplog.records)
+
+
+def test_retry_heals_without_alert(stubs, updates, caplog, monkeypatch):
+    server = stubs()
+    server.set(NAME, OLD_IP)
+    checker = main.PropagationChecker([server.address], timeout=0.3, deadline=0.3, interval=0.1, retries=2)
+    recorded = main.update_domain_record_async
+
+    async def update_and_sync(**kwargs):
+        # 重新提交后服务器同步到新值
+        server.set(NAME, NEW_IP)
+        return await recorded(**kwargs)
+
+    monkeypatch.setattr(main, "update_domain_record_async", update_and_sync)
+    result = check_result()
+    before = timeouts()
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(main.verify_propagation(checker, result, {}))
+
+    assert len(updates) == 1
+    assert result["propagation"]["converged"]
+    assert timeouts() == before
+    assert not any(r.levelno == logging.ERROR for r in caplog.records)
+
+
+def test_proxied_record_is_skipped(stubs, updates):
+    server = stubs()
+    checker = main.PropagationChecker([server.address], timeout=0.3, deadline=0.3)
+    result = check_result()
+    result["record"].proxied = True
+
+    asyncio.run(main.verify_propagation(checker, result, {}))
+
+    assert result["propagation"] == {"skipped": "代理记录"}
+    assert server.queries == {"udp": 0, "tcp": 0}
+    assert not updates
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+
+import pytest
+
+import main
+
+
+def start_thread(target) -> threading.Thread:
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    # 等待其领取号码后再让下一个调用方到达
+    time.sleep(0.02)
+    return thread
+
+
+def test_sync_and_async_callers_are_served_in_arrival_order():
+    bucket = main.TokenBucket(rate=20, burst=1)
+    bucket.acquire()
+    order = []
+
+    def sync_caller(name):
+        def _run():
+            bucket.acquire()
+            order.append(name)
+        return _run
+
+    def async_caller(name):
+        async def _acquire():
+            await bucket.acquire_async()
+            order.append(name)
+        return lambda: asyncio.run(_acquire())
+
+    threads = [start_thread(sync_caller("thread-1")), start_thread(async_caller("coroutine-1")),
+               start_thread(sync_caller("thread-2")), start_thread(async_caller("coroutine-2"))]
+    for thread in threads:
+        thread.join(timeout=5)
+
+    # 协程不会插到已在排队的线程前面
+    assert order == ["thread-1", "coroutine-1", "thread-2", "coroutine-2"]
+
+
+def test_async_callers_are_paced_by_rate():
+    bucket = main.TokenBucket(rate=50, burst=2)
+
+    async def _run():
+        return await asyncio.gather(*(bucket.acquire_async() for _ in range(7)))
+
+    start = time.monotonic()
+    waits = asyncio.run(_run())
+
+    # 前 burst 个立即通过，其余每 1/rate 秒一个
+    assert waits[0] < 0.01 and waits[1] < 0.01
+    assert time.monotonic() - start == pytest.approx(5 / 50, abs=0.05)
+    assert waits[2:] == sorted(waits[2:])
+
+
+def test_cancelled_coroutine_gives_up_its_place():
+    bucket = main.TokenBucket(rate=2, burst=1)
+    bucket.acquire()
+
+    async def _cancel_waiter():
+        task = asyncio.ensure_future(bucket.acquire_async())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(_cancel_waiter())
+    # 被取消的号码被跳过，之后的调用方只需等待令牌补充
+    assert bucket.acquire() < 0.6
+
+
+def test_drain_slows_following_requests():
+    bucket = main.TokenBucket(rate=20, burst=5)
+    bucket.drain()
+
+    assert bucket.acquire() == pytest.approx(1 / 20, abs=0.03)
+
+
+def test_drain_delays_queued_coroutine():
+    bucket = main.TokenBucket(rate=10, burst=2)
+
+    async def _run():
+        await bucket.acquire_async()
+        bucket.drain()
+        return await bucket.acquire_async()
+
+    # 剩余的令牌被清空，需要等待补充
+    assert asyncio.run(_run()) == pytest.approx(1 / 10, abs=0.04)
+
+
+def test_registry_counts_calls_queueing_and_throttling():
+    registry = main.RateLimiterRegistry()
+    registry.configure({"default": {"rate": 20, "burst": 1}, "actions": {"UpdateRecord": {"rate": 5}}})
+
+    registry.acquire("acct", "GetRecord")
+    asyncio.run(registry.acquire_async("acct", "GetRecord"))
+    registry.record_throttled("acct", "GetRecord")
+    registry.acquire("acct", "GetRecord")
+    registry.acquire("other", "ListRecords")
+
+    stats = registry.stats()
+    assert stats["acct/GetRecord"]["calls"] == 3
+    assert stats["acct/GetRecord"]["queued"] == 2
+    assert stats["acct/GetRecord"]["throttled"] == 1
+    assert stats["acct/GetRecord"]["wait_seconds"] == pytest.approx(2 / 20, abs=0.04)
+    assert stats["other/ListRecords"] == {"calls": 1, "queued": 0, "wait_seconds": 0.0, "throttled": 0}
+    assert registry.bucket("acct", "UpdateRecord").rate == 5
+
+
+def test_unconfigured_registry_counts_without_limiting():
+    registry = main.RateLimiterRegistry()
+    registry.configure(None)
+
+    for _ in range(50):
+        registry.acquire("acct", "GetRecord")
+    registry.record_throttled("acct", "GetRecord")
+
+    assert registry.bucket("acct", "GetRecord") is None
+    assert registry.stats()["acct/GetRecord"] == {"calls": 50, "queued": 0, "wait_seconds": 0.0, "throttled": 1}
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""用 benchmark.py 的模拟ESA服务驱动重试、熔断与重试预算"""
+import time
+
+import pytest
+
+import benchmark
+import main
+
+RECORD_ID = benchmark.BASE_RECORD_ID
+
+
+@pytest.fixture
+def fake():
+    state = benchmark.FakeESAState()
+    state.seed(1, "198.51.100.1")
+    server = benchmark.start_fake_esa(state)
+    host = f"127.0.0.1:{server.server_address[1]}"
+    state.client = main.create_client({"aliyun": {"access_key_id": "test", "access_key_secret": "test",
+                                                  "region": "cn-hangzhou", "endpoint": host, "protocol": "http"}})
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+def use_resilience(monkeypatch, **kwargs) -> main.Resilience:
+    """替换全局重试配置，退避以毫秒计，测试无需真实等待"""
+    params = {"max_attempts": 4, "base_delay": 0.01, "max_delay": 0.05, "failure_threshold": 3,
+              "reset_timeout": 0.2, "auth_reset_timeout": 60.0}
+    params.update(kwargs)
+    resilience = main.Resilience(**params)
+    monkeypatch.setattr(main, "_resilience", resilience)
+    return resilience
+
+
+def breaker_of(resilience: main.Resilience, state) -> main.CircuitBreaker:
+    key = main.esa_breaker_key(main.client_registry.account_of(state.client), state.client)
+    return resilience.breaker(key)
+
+
+@pytest.mark.parametrize("code,status", [("Throttling.User", 429), ("ServiceUnavailable", 503)])
+def test_retryable_errors_heal_within_backoff(fake, monkeypatch, code, status):
+    resilience = use_resilience(monkeypatch)
+    fake.inject(code, status, times=2)
+
+    start = time.monotonic()
+    record = main.get_record_info(RECORD_ID, fake.client)
+    elapsed = time.monotonic() - start
+
+    assert record.value == "198.51.100.1"
+    assert fake.calls["GetRecord"] == 3
+    assert fake.faults == {code: 2}
+    # 两次退避的上限为 0.01 + 0.02 秒，余量留给本地请求
+    assert elapsed < 1.0
+    assert breaker_of(resilience, fake).state == "closed"
+
+
+def test_auth_error_is_not_retried_and_opens_breaker(fake, monkeypatch):
+    resilience = use_resilience(monkeypatch)
+    fake.inject("InvalidAccessKeyId.NotFound", 403)
+
+    with pytest.raises(Exception) as info:
+        main.get_record_info(RECORD_ID, fake.client)
+
+    assert main.get_error_code(info.value) == "InvalidAccessKeyId.NotFound"
+    assert fake.calls["GetRecord"] == 1
+    assert breaker_of(resilience, fake).state == "open"
+    # 熔断期间的请求不会到达服务端
+    with pytest.raises(main.CircuitOpenError):
+        main.get_record_info(RECORD_ID, fake.client)
+    assert fake.calls["GetRecord"] == 1
+
+
+def test_fatal_error_is_not_retried_and_keeps_breaker_closed(fake, monkeypatch):
+    resilience = use_resilience(monkeypatch)
+
+    with pytest.raises(Exception) as info:
+        main.get_record_info(RECORD_ID + 1, fake.client)
+
+    assert main.get_error_code(info.value) == "Record.NotExist"
+    assert fake.calls["GetRecord"] == 1
+    assert breaker_of(resilience, fake).state == "closed"
+
+
+def test_breaker_opens_after_threshold_and_half_opens_after_cooldown(fake, monkeypatch):
+    resilience = use_resilience(monkeypatch, max_attempts=1, failure_threshold=3, reset_timeout=0.2)
+    breaker = breaker_of(resilience, fake)
+    fake.inject("ServiceUnavailable", 503, times=4)
+
+    for _ in range(3):
+        with pytest.raises(Exception):
+            main.get_record_info(RECORD_ID, fake.client)
+    assert breaker.state == "open"
+    with pytest.raises(main.CircuitOpenError):
+        main.get_record_info(RECORD_ID, fake.client)
+    assert fake.calls["GetRecord"] == 3
+
+    # 冷却期满后半开，探测失败则重新打开
+    time.sleep(0.25)
+    with pytest.raises(Exception) as info:
+        main.get_record_info(RECORD_ID, fake.client)
+    assert not isinstance(info.value, main.CircuitOpenError)
+    assert breaker.state == "open"
+    assert fake.calls["GetRecord"] == 4
+
+    # 再次冷却后探测成功，熔断器关闭
+    time.sleep(0.25)
+    assert main.get_record_info(RECORD_ID, fake.client).value == "198.51.100.1"
+    assert breaker.state == "closed"
+    assert fake.calls["GetRecord"] == 5
+
+
+def test_half_open_admits_single_probe():
+    breaker = main.CircuitBreaker("probe", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure("retryable")
+    assert breaker.state == "open"
+    time.sleep(0.06)
+
+    breaker.allow()
+    assert breaker.state == "half_open"
+    with pytest.raises(main.CircuitOpenError):
+        breaker.allow()
+
+
+def test_retry_budget_caps_retries(fake, monkeypatch):
+    use_resilience(monkeypatch, max_attempts=10, failure_threshold=100, budget_ratio=0.0, budget_capacity=2)
+    fake.inject("ServiceUnavailable", 503, times=10)
+
+    with pytest.raises(Exception):
+        main.get_record_info(RECORD_ID, fake.client)
+    # 1 次调用 + 预算内的 2 次重试
+    assert fake.calls["GetRecord"] == 3
+
+    # 预算耗尽后不再重试
+    with pytest.raises(Exception):
+        main.get_record_info(RECORD_ID, fake.client)
+    assert fake.calls["GetRecord"] == 4
+
+
+def test_retry_budget_refills_by_ratio():
+    budget = main.RetryBudget(ratio=0.5, capacity=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()